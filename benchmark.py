@@ -0,0 +1,240 @@
+"""
+End-to-end throughput benchmark of the queue loop.
+
+Runs robot_framework.queue_framework.run_queue over N synthetic VejmanFakturering rows with
+every system around the robot replaced by the stand-ins in benchmarks.local_services: SQL by
+LocalSql, Vejman and PEZ by LocalHttpServices, OpenOrchestrator by LocalOrchestrator and the
+mail server for error reports by LocalSmtpServer. SAP is replaced by fake_sap.FakeSapGui.
+Each of them can have an injected latency, set from the command line.
+
+Reports throughput, p50/p95 latency per queue element (from taken off the queue to marked
+done) and the run's per-stage breakdown, and writes it all to a JSON file in --out, so runs
+can be compared over time. The previous result with the same parameters is shown next to it.
+
+    python benchmark.py --elements 500 --batch-size 10 --sessions 3 --label "3 sessions"
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import glob
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+
+from OpenOrchestrator.database.queues import QueueStatus
+
+from fake_sap import FakeLatency, FakeSapGui
+from benchmarks.local_services import LocalCredential, LocalHttpServices, LocalOrchestrator, LocalSmtpServer, LocalSql
+from pez_client import PEZConfig
+from update_vejman import VejmanConfig
+from robot_framework import config
+from robot_framework import queue_framework
+from generate_invoice_csv import TEKSTER_CACHE
+import sap_sessions
+import spans
+
+SAP_USER = "ROBOT"
+
+# Toptekst/Forklaring per TilladelsesType, written the way they are stored in VejmanFakturaTekster
+FAKTURATEKSTER = [
+    {"Fakturalinje": "Stilladser", "Fordringstype": "VEJ01", "PSPElement": "XG-5200000001-00001", "MaterialeNrOpus": "110000",
+     "Toptekst": 'f"Tilladelse {Tilladelsesnr}: stillads på {FørsteSted} fra {short_start_date} til {short_end_date}"',
+     "Forklaring": 'f"{length} m a {unit_price} kr. pr. dag i {days_period_formatted} dage, i alt {total_calculated_price} kr."'},
+    {"Fakturalinje": "Containere", "Fordringstype": "VEJ02", "PSPElement": "XG-5200000001-00002", "MaterialeNrOpus": "110001",
+     "Toptekst": 'f"Tilladelse {Tilladelsesnr}: container på {FørsteSted}"',
+     "Forklaring": 'f"Container i perioden {short_start_date} - {short_end_date} ({days_period_formatted} dage)"'},
+    {"Fakturalinje": "Materiel", "Fordringstype": "VEJ03", "PSPElement": "XG-5200000001-00003", "MaterialeNrOpus": "110002",
+     "Toptekst": 'f"Materiel på {FørsteSted}, att. {kunde_ref_id}"',
+     "Forklaring": 'f"{length} m materiel, {opus_price} kr."'},
+]
+
+
+def make_cvr(rng: random.Random) -> str:
+    """A random CVR number that passes the modulus-11 check."""
+    while True:
+        digits = [rng.randint(1, 9)] + [rng.randint(0, 9) for _ in range(6)]
+        check = -sum(d * w for d, w in zip(digits, (2, 7, 6, 5, 4, 3, 2))) % 11
+        if check < 10:
+            return "".join(map(str, digits + [check]))
+
+
+def make_rows(count: int, debitors: list[str], pez_share: float, rng: random.Random, *, first_id: int = 1,
+              status: str = "TilFakturering") -> list[dict]:
+    """Synthetic VejmanFakturering rows; a pez_share of them are PEZ cases (VejmanID 'Henstilling')."""
+    rows = []
+    for sql_id in range(first_id, first_id + count):
+        start = datetime(2026, rng.randint(1, 12), rng.randint(1, 28))
+        days = rng.randint(1, 60)
+        meter = round(rng.uniform(1, 40), 1)
+        unit_price = rng.choice([3.25, 5.0, 12.5])
+        pez = rng.random() < pez_share
+        rows.append({
+            "ID": sql_id, "VejmanID": "Henstilling" if pez else str(500000 + sql_id),
+            "FørsteSted": f"Testvej {sql_id % 200 + 1}, 8000 Aarhus C", "Tilladelsesnr": f"T-{sql_id:06}",
+            "Ansøger": f"Ansøger {sql_id}", "CvrNr": rng.choice(debitors), "Enhedspris": unit_price, "Meter": meter,
+            "Startdato": start.strftime("%Y-%m-%d"), "Slutdato": (start + timedelta(days=days - 1)).strftime("%Y-%m-%d"), "AntalDage": days,
+            "TotalPris": round(meter * unit_price * days, 2), "ATT": f"Ref {sql_id}",
+            "TilladelsesType": FAKTURATEKSTER[sql_id % len(FAKTURATEKSTER)]["Fakturalinje"],
+            "PEZUUID": str(uuid.UUID(int=rng.getrandbits(128))) if pez else None,
+            "FakturaStatus": status, "FakturaDato": None, "Ordrenummer": None,
+        })
+    return rows
+
+
+def percentile(ordered: list[float], p: float) -> float | None:
+    """The p'th percentile (0-100) of sorted values, by nearest rank."""
+    if not ordered:
+        return None
+    rank = max(1, round(p / 100 * len(ordered) + 0.5 - 1e-9))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Run the queue loop once against the local stand-ins and return the result."""
+    rng = random.Random(args.seed)
+    debitors = [make_cvr(rng) for _ in range(args.debitors)]
+    known = debitors[:round(len(debitors) * args.known_share)]
+
+    with tempfile.TemporaryDirectory() as folder, LocalHttpServices({
+        "getcase": args.http_ms / 1000, "setcase": args.http_ms / 1000, "comment": args.http_ms / 1000,
+        "login": args.http_ms / 1000, "initiate_login": args.http_ms / 1000, "token": args.http_ms / 1000,
+    }) as http, LocalSmtpServer() as smtp:
+        sql = LocalSql(os.path.join(folder, "vejmankassen.sqlite3"), args.sql_ms / 1000)
+        sql.insert("VejmanFakturaTekster", FAKTURATEKSTER)
+        rows = make_rows(args.elements, debitors, args.pez_share, rng)
+        sql.insert("VejmanFakturering", rows)
+        # An invoiced row per debitor SAP knows, so the robot's debitor store is seeded with them
+        history = make_rows(len(known), known, 0, rng, first_id=args.elements + 1, status="Faktureret")
+        for row, cvr in zip(history, known):
+            row["CvrNr"] = cvr
+        sql.insert("VejmanFakturering", history)
+
+        sap = FakeSapGui(SAP_USER, FakeLatency(args.sap_call_ms / 1000, args.sap_screen_ms / 1000, args.sap_record_ms / 1000), known)
+        previous_provider = sap_sessions.set_provider(sap)
+
+        orchestrator = LocalOrchestrator(
+            credentials={"OpusBruger": LocalCredential(SAP_USER, "-"), "VejmanToken": LocalCredential("-", "local-token"),
+                         "PEZUI": LocalCredential("robot", "-")},
+            constants={config.ERROR_EMAIL: "robot@localhost"}, echo=args.verbose)
+        orchestrator.add_queue_elements([{"ID": row["ID"], "VejmanID": row["VejmanID"]} for row in rows])
+
+        # The run's settings, in files under the temporary folder
+        config.MAX_TASK_COUNT = args.elements
+        config.BATCH_SIZE = args.batch_size
+        config.SAP_SESSION_COUNT = args.sessions
+        config.PIPELINE_QUEUE_SIZE = args.queue_size
+        config.SEND_INTERVAL_SECONDS = args.send_interval
+        config.KNOWN_DEBITORS_FILE = os.path.join(folder, "known_debitors.json")
+        config.OUTBOX_FILE = os.path.join(folder, "outbox.sqlite3")
+        config.WORKSPACE_FOLDER = os.path.join(folder, "workspace")
+        config.PEZ_TOKEN_FILE = None
+        # The spans go into the result instead of a report of their own
+        config.PERFORMANCE_REPORT_FOLDER = None
+        TEKSTER_CACHE.invalidate()
+        spans.reset()
+        config.SMTP_SERVER, config.SMTP_PORT = smtp.address
+        config.SMTP_STARTTLS = False
+
+        started = time.perf_counter()
+        try:
+            stats = queue_framework.run_queue(orchestrator, sql.connect, VejmanConfig(base_url=http.base_url),
+                                              PEZConfig(base_url=http.base_url))
+        finally:
+            wall = time.perf_counter() - started
+            sap_sessions.set_provider(previous_provider)
+
+        timings = list(orchestrator.timings.values())
+        done = sorted(t.finished_at - t.taken_at for t in timings if t.status == QueueStatus.DONE)
+        failed = [t.message for t in timings if t.status == QueueStatus.FAILED]
+        invoiced = sql.count("VejmanFakturering", f"FakturaStatus = 'Faktureret' AND ID <= {args.elements}")
+        return {
+            "label": args.label,
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "parameters": {name: value for name, value in vars(args).items() if name not in ("label", "out", "verbose")},
+            "elements": args.elements,
+            "done": len(done),
+            "failed": len(failed),
+            "invoiced_rows": invoiced,
+            "notifications": {"vejman": len(http.updated_cases), "pez": len(http.comments)},
+            "wall_s": round(wall, 3),
+            "throughput_per_min": round(len(done) / wall * 60, 1) if wall else None,
+            "latency_s": {
+                "p50": round(percentile(done, 50), 3) if done else None,
+                "p95": round(percentile(done, 95), 3) if done else None,
+                "max": round(done[-1], 3) if done else None,
+                "mean": round(sum(done) / len(done), 3) if done else None,
+            },
+            "stages": stats["stages"],
+            "spans": stats["spans"],
+            "queues": stats["queues"],
+            "sap": sap.stats(),
+            "sql_statements": sql.statements,
+            "http_requests": http.stats(),
+            "error_reports": stats["error_reports"],
+            "error_mails": smtp.stats(),
+            "run": stats["run"],
+            "prefetch": stats["prefetch"],
+            "errors": stats["errors"],
+            "returned_to_queue": stats["returned_to_queue"],
+            "first_failures": failed[:5],
+        }
+
+
+def previous_result(out: str, parameters: dict) -> dict | None:
+    """The newest earlier result in out with the same parameters."""
+    for path in sorted(glob.glob(os.path.join(out, "*.json")), reverse=True):
+        with open(path, encoding="utf-8") as file:
+            result = json.load(file)
+        if result.get("parameters") == parameters:
+            return result
+    return None
+
+
+def main() -> None:
+    """Run the benchmark with the command line's parameters, print the result and write it to --out."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0].strip())
+    parser.add_argument("--elements", type=int, default=200, help="Queue elements (VejmanFakturering rows) to process")
+    parser.add_argument("--batch-size", type=int, default=config.BATCH_SIZE)
+    parser.add_argument("--sessions", type=int, default=config.SAP_SESSION_COUNT)
+    parser.add_argument("--queue-size", type=int, default=config.PIPELINE_QUEUE_SIZE)
+    parser.add_argument("--send-interval", type=float, default=config.SEND_INTERVAL_SECONDS)
+    parser.add_argument("--debitors", type=int, default=50, help="Distinct debitors among the rows")
+    parser.add_argument("--known-share", type=float, default=0.8, help="Share of the debitors SAP already knows")
+    parser.add_argument("--pez-share", type=float, default=0.2, help="Share of the rows that are PEZ cases")
+    parser.add_argument("--sap-call-ms", type=float, default=1.0, help="Latency of each SAP GUI scripting call")
+    parser.add_argument("--sap-screen-ms", type=float, default=300.0, help="Time SAP is busy after each action")
+    parser.add_argument("--sap-record-ms", type=float, default=50.0, help="Extra busy time per invoice or debitor in a file")
+    parser.add_argument("--sql-ms", type=float, default=2.0, help="Latency of each SQL statement")
+    parser.add_argument("--http-ms", type=float, default=80.0, help="Latency of each Vejman/PEZ request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="Free text stored with the result")
+    parser.add_argument("--out", default="benchmark_results", help="Folder for the JSON results")
+    parser.add_argument("--verbose", action="store_true", help="Print the robot's log")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    os.makedirs(args.out, exist_ok=True)
+    before = previous_result(args.out, result["parameters"])
+    path = os.path.join(args.out, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2, ensure_ascii=False)
+
+    latency = result["latency_s"]
+    print(f"{result['done']}/{result['elements']} done, {result['failed']} failed in {result['wall_s']} s: "
+          f"{result['throughput_per_min']} per minute, latency p50 {latency['p50']} s, p95 {latency['p95']} s")
+    for stage in result["stages"]:
+        print(f"  {stage}")
+    print("  " + spans.format_summary(result["spans"]).replace("\n", "\n  "))
+    if before is not None:
+        print(f"Previous ({before['started_at']} {before['label']}): {before['throughput_per_min']} per minute, "
+              f"p95 {before['latency_s']['p95']} s")
+    print(f"Result written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Local stand-ins for the systems around the robot, used by benchmark.py and the tests."""
@@ -0,0 +1,542 @@
+"""
+Local stand-ins for the systems around the robot, to run the queue loop without them.
+
+- LocalSql: VejmanKassen on SQLite, behind a pyodbc-style connection that understands the
+  robot's T-SQL statements.
+- LocalHttpServices: Vejman and PEZ on one local HTTP server, with the endpoints the clients call.
+- LocalOrchestrator: an OpenOrchestrator connection with an in-memory queue, credentials
+  and constants, which records when each queue element was taken and finished.
+- LocalSmtpServer: a mail server that keeps the error reports sent to it.
+
+Each of them can add latency, so a benchmark can model the real round trips. SAP itself
+is covered by fake_sap.
+"""
+
+from collections import defaultdict
+from contextlib import closing
+from dataclasses import dataclass, field
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+VEJMANFAKTURERING_COLUMNS = (
+    ("ID", "INTEGER PRIMARY KEY"), ("VejmanID", "TEXT"), ("FørsteSted", "TEXT"), ("Tilladelsesnr", "TEXT"),
+    ("Ansøger", "TEXT"), ("CvrNr", "TEXT"), ("Enhedspris", "REAL"), ("Meter", "REAL"), ("Startdato", "TEXT"),
+    ("Slutdato", "TEXT"), ("AntalDage", "INTEGER"), ("TotalPris", "REAL"), ("ATT", "TEXT"),
+    ("TilladelsesType", "TEXT"), ("PEZUUID", "TEXT"), ("FakturaStatus", "TEXT"), ("FakturaDato", "TEXT"),
+    ("Ordrenummer", "TEXT"),
+)
+VEJMANFAKTURATEKSTER_COLUMNS = (
+    ("Fakturalinje", "TEXT"), ("Fordringstype", "TEXT"), ("PSPElement", "TEXT"), ("MaterialeNrOpus", "TEXT"),
+    ("Toptekst", "TEXT"), ("Forklaring", "TEXT"),
+)
+
+# T-SQL the robot sends, rewritten to SQLite. SQLite accepts [bracketed] names, but not database/schema prefixes.
+_SQL_REWRITES = (
+    (re.compile(r"\[VejmanKassen\]\.\[dbo\]\.|\[dbo\]\."), ""),
+    (re.compile(r"CAST\(GETDATE\(\) AS date\)", re.IGNORECASE), "date('now')"),
+    (re.compile(r"CHECKSUM_AGG\(BINARY_CHECKSUM\(\*\)\)", re.IGNORECASE), "TOTAL(LENGTH(Toptekst) + LENGTH(Forklaring))"),
+)
+
+
+class LocalRow(tuple):
+    """A result row that can be read by column name as well as by index, like pyodbc.Row."""
+
+    columns: dict[str, int] = {}
+
+    def __getattr__(self, name: str):
+        try:
+            return self[self.columns[name]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class LocalSqlCursor:
+    """A pyodbc-style cursor: parameters are passed to execute() one by one."""
+
+    def __init__(self, sql: "LocalSql", cursor: sqlite3.Cursor):
+        self._sql = sql
+        self._cursor = cursor
+        self.fast_executemany = False
+
+    def execute(self, statement: str, *params) -> "LocalSqlCursor":
+        """Run one statement with its parameters."""
+        self._sql.round_trip()
+        self._cursor.execute(self._sql.translate(statement), params)
+        return self
+
+    def executemany(self, statement: str, seq_of_params) -> None:
+        """Run a statement once per set of parameters, in one round trip as with fast_executemany."""
+        self._sql.round_trip()
+        self._cursor.executemany(self._sql.translate(statement), list(seq_of_params))
+
+    @property
+    def rowcount(self) -> int:
+        """The number of rows the last statement changed, as with pyodbc."""
+        return self._cursor.rowcount
+
+    def fetchone(self) -> LocalRow | None:
+        """The next row, or None."""
+        row = self._cursor.fetchone()
+        return None if row is None else self._row_type()(row)
+
+    def fetchall(self) -> list[LocalRow]:
+        """The remaining rows."""
+        row_type = self._row_type()
+        return [row_type(row) for row in self._cursor.fetchall()]
+
+    def _row_type(self) -> type:
+        names = tuple(column[0] for column in self._cursor.description or ())
+        return self._sql.row_type(names)
+
+
+class LocalSqlConnection:
+    """A pyodbc-style connection to the SQLite file."""
+
+    def __init__(self, sql: "LocalSql"):
+        self._sql = sql
+        self._db = sqlite3.connect(sql.path, timeout=30, check_same_thread=False)
+
+    def cursor(self) -> LocalSqlCursor:
+        """A new cursor on the connection."""
+        return LocalSqlCursor(self._sql, self._db.cursor())
+
+    def commit(self) -> None:
+        """Commit the transaction, which costs a round trip."""
+        self._sql.round_trip()
+        self._db.commit()
+
+    def rollback(self) -> None:
+        """Roll the transaction back."""
+        self._db.rollback()
+
+    def close(self) -> None:
+        """Close the connection."""
+        self._db.close()
+
+
+class LocalSql:
+    """
+    VejmanFakturering and VejmanFakturaTekster in a SQLite file.
+    connect() returns a new connection and can be given to ConnectionManager. Every statement
+    and commit takes `latency` seconds on top of SQLite's own time, like a round trip to SQL Server.
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        self.path = path
+        self.latency = latency
+        self.statements = 0
+        self._row_types: dict[tuple, type] = {}
+        self._translations: dict[str, str] = {}
+        self._lock = threading.Lock()
+        with closing(sqlite3.connect(path)) as db:
+            with db:
+                db.execute("PRAGMA journal_mode=WAL")
+                for table, columns in (("VejmanFakturering", VEJMANFAKTURERING_COLUMNS), ("VejmanFakturaTekster", VEJMANFAKTURATEKSTER_COLUMNS)):
+                    db.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(f'{name} {kind}' for name, kind in columns)})")
+
+    def connect(self) -> LocalSqlConnection:
+        """A new connection to the file."""
+        return LocalSqlConnection(self)
+
+    def insert(self, table: str, rows: list[dict]) -> None:
+        """Add rows given as dicts of column -> value."""
+        if not rows:
+            return
+        names = list(rows[0])
+        with closing(sqlite3.connect(self.path)) as db:
+            with db:
+                db.executemany(
+                    f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                    [[row[name] for name in names] for row in rows],
+                )
+
+    def count(self, table: str, where: str = "1 = 1") -> int:
+        """The number of rows in table that match the where clause."""
+        with closing(sqlite3.connect(self.path)) as db:
+            return db.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}").fetchone()[0]
+
+    def translate(self, statement: str) -> str:
+        """The robot's T-SQL statement rewritten to SQLite, cached per statement."""
+        translated = self._translations.get(statement)
+        if translated is None:
+            translated = statement
+            for pattern, replacement in _SQL_REWRITES:
+                translated = pattern.sub(replacement, translated)
+            self._translations[statement] = translated
+        return translated
+
+    def row_type(self, names: tuple) -> type:
+        """A LocalRow subclass for the given column names, cached per set of names."""
+        row_type = self._row_types.get(names)
+        if row_type is None:
+            row_type = type("LocalRow", (LocalRow,), {"columns": {name: index for index, name in enumerate(names)}})
+            self._row_types[names] = row_type
+        return row_type
+
+    def round_trip(self) -> None:
+        """Count a statement and take the time a round trip costs."""
+        with self._lock:
+            self.statements += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class LocalHttpServices:  # pylint: disable=too-many-instance-attributes
+    """
+    Vejman and PEZ on one local HTTP server, for VejmanConfig/PEZConfig(base_url=services.base_url).
+
+    latency maps an endpoint (getcase, setcase, login, initiate_login, token, comment) to the
+    seconds it takes to answer. Requests are counted per endpoint, and setcase/comment
+    calls are kept so a benchmark can check every case was notified.
+    """
+
+    ROUTES = (
+        ("GET", re.compile(r"^/permissions/getcase$"), "getcase"),
+        ("POST", re.compile(r"^/permissions/setcase$"), "setcase"),
+        ("GET", re.compile(r"^/login$"), "login"),
+        ("POST", re.compile(r"^/rest/public/initiate-login$"), "initiate_login"),
+        ("POST", re.compile(r"^/rest/oauth/token$"), "token"),
+        ("POST", re.compile(r"^/rest/tickets/cases/([^/]+)/comments$"), "comment"),
+    )
+    ACCESS_TOKEN = "local-access-token"
+
+    def __init__(self, latency: dict[str, float] | None = None, token_lifetime: int = 3600):
+        self.latency = latency or {}
+        self.token_lifetime = token_lifetime
+        self.requests: dict[str, int] = defaultdict(int)
+        self.updated_cases: list[str] = []
+        self.comments: list[tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """The URL the server answers on."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        """Serve in a background thread and return the base URL."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="local-http", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "LocalHttpServices":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def stats(self) -> dict:
+        """The number of requests per endpoint."""
+        with self._lock:
+            return dict(self.requests)
+
+    def answer(self, method: str, url: str, headers, body: bytes) -> tuple[int, object]:
+        """The status and content (a str of HTML or a JSON value) the server answers a request with.
+        A subclass can override it, e.g. to fail some requests."""
+        parsed = urllib.parse.urlsplit(url)
+        for route_method, pattern, name in self.ROUTES:
+            match = pattern.match(parsed.path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {"error": f"No route for {method} {parsed.path}"}
+
+        with self._lock:
+            self.requests[name] += 1
+        if self.latency.get(name):
+            time.sleep(self.latency[name])
+
+        return getattr(self, f"_{name}")(match, urllib.parse.parse_qs(parsed.query), headers, body)
+
+    # --- Endpoints, called with the route's match, the query, the headers and the body ---
+
+    def _getcase(self, _match, query, _headers, _body) -> tuple[int, object]:
+        case_id = query["caseid"][0]
+        return 200, {"data": {"id": case_id, "type": "Gravetilladelse", "state": "Aktiv", "year": 2026,
+                              "serial_number": case_id, "authority_reference_number": ""}}
+
+    def _setcase(self, _match, _query, _headers, body) -> tuple[int, object]:
+        data = json.loads(urllib.parse.parse_qs(body.decode("utf-8"))["data"][0])
+        with self._lock:
+            self.updated_cases.append(str(data["id"]))
+        return 200, {"data": {"id": data["id"]}}
+
+    def _login(self, *_request) -> tuple[int, object]:
+        return 200, "<html><body>PEZ</body></html>"
+
+    def _initiate_login(self, *_request) -> tuple[int, object]:
+        return 200, {}
+
+    def _token(self, *_request) -> tuple[int, object]:
+        return 200, {"access_token": self.ACCESS_TOKEN, "expires_in": self.token_lifetime}
+
+    def _comment(self, match, _query, headers, body) -> tuple[int, object]:
+        if headers.get("authorization") != f"Bearer {self.ACCESS_TOKEN}":
+            return 401, {"error": "invalid_token"}
+        with self._lock:
+            self.comments.append((match.group(1), json.loads(body)["comment"]))
+        return 201, {}
+
+    def _handler_class(self) -> type:
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers every request with LocalHttpServices.answer."""
+            # Keep-alive, so the clients' connection pools are exercised like against the real servers
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, content = services.answer(self.command, self.path, self.headers, body)
+                raw = content.encode("utf-8") if isinstance(content, str) else json.dumps(content).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "text/html" if isinstance(content, str) else "application/json")
+                    self.send_header("Content-Length", str(len(raw)))
+                    self.end_headers()
+                    self.wfile.write(raw)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client timed out and closed the connection
+                    self.close_connection = True
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+                """Keep the requests out of the output."""
+
+        return Handler
+
+
+@dataclass
+class LocalQueueElement:
+    """The parts of an OpenOrchestrator QueueElement the robot reads."""
+    id: str
+    data: str
+    reference: str | None = None
+
+
+@dataclass
+class LocalCredential:
+    """A credential as OrchestratorConnection.get_credential returns it."""
+    username: str
+    password: str
+
+
+@dataclass
+class LocalConstant:
+    """A constant as OrchestratorConnection.get_constant returns it."""
+    value: str
+
+
+@dataclass
+class ElementTiming:
+    """When a queue element was taken from the queue and when it got its final status."""
+    taken_at: float
+    finished_at: float | None = None
+    status: object = None
+    message: str | None = None
+
+
+@dataclass
+class LocalOrchestrator:  # pylint: disable=too-many-instance-attributes
+    """
+    Stands in for OrchestratorConnection: a queue in memory, fixed credentials and constants,
+    and logs kept in lists (printed too with echo). Timestamps are time.perf_counter().
+    """
+    credentials: dict[str, LocalCredential]
+    constants: dict[str, str]
+    process_name: str = "LocalRobot"
+    echo: bool = False
+    queue: list[LocalQueueElement] = field(default_factory=list)
+    timings: dict[str, ElementTiming] = field(default_factory=dict)
+    logs: dict[str, list[str]] = field(default_factory=lambda: defaultdict(list))
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def add_queue_elements(self, payloads: list[dict]) -> None:
+        """Add a queue element per payload, with the payload as JSON data."""
+        for payload in payloads:
+            self.queue.append(LocalQueueElement(str(len(self.queue) + 1), json.dumps(payload)))
+
+    def get_next_queue_element(self, queue_name: str) -> LocalQueueElement | None:  # pylint: disable=unused-argument
+        """Take the next element of the one queue, or None when it's empty."""
+        with self._lock:
+            if self._next >= len(self.queue):
+                return None
+            element = self.queue[self._next]
+            self._next += 1
+            self.timings[element.id] = ElementTiming(time.perf_counter())
+            return element
+
+    def set_queue_element_status(self, element_id: str, status, message: str | None = None) -> None:
+        """Record the element's status and when it was set."""
+        with self._lock:
+            timing = self.timings[element_id]
+            timing.finished_at = time.perf_counter()
+            timing.status = status
+            timing.message = message
+
+    def get_credential(self, name: str) -> LocalCredential:
+        """The credential with the given name."""
+        return self.credentials[name]
+
+    def update_credential(self, name: str, username: str, password: str) -> None:
+        """Replace the credential with the given name."""
+        self.credentials[name] = LocalCredential(username, password)
+
+    def get_constant(self, name: str) -> LocalConstant:
+        """The constant with the given name."""
+        return LocalConstant(self.constants[name])
+
+    def log_trace(self, message: str) -> None:
+        """Keep a trace message."""
+        self._log("trace", message)
+
+    def log_info(self, message: str) -> None:
+        """Keep an info message."""
+        self._log("info", message)
+
+    def log_error(self, message: str) -> None:
+        """Keep an error message."""
+        self._log("error", message)
+
+    def _log(self, level: str, message: str) -> None:
+        with self._lock:
+            self.logs[level].append(message)
+        if self.echo:
+            print(f"[{level}] {message}")
+
+
+class LocalSmtpServer:
+    """
+    A plain SMTP server (no STARTTLS) for config.SMTP_SERVER/SMTP_PORT = server.address.
+
+    Received mails are kept in messages as (sender, recipients, EmailMessage). latency is the
+    time it takes to accept a mail, and a connection idle for idle_timeout seconds is closed
+    with a 421, as real servers do, so clients that keep a connection open have to reconnect.
+    """
+
+    def __init__(self, latency: float = 0.0, idle_timeout: float | None = None):
+        self.latency = latency
+        self.idle_timeout = idle_timeout
+        self.messages: list[tuple[str, list[str], EmailMessage]] = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """The (host, port) the server listens on."""
+        return self._server.server_address[:2]
+
+    def start(self) -> tuple[str, int]:
+        """Serve in a background thread and return (host, port)."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="local-smtp", daemon=True)
+        self._thread.start()
+        return self.address
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "LocalSmtpServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def stats(self) -> dict:
+        """The number of connections and of received mails, and their size."""
+        with self._lock:
+            return {"connections": self.connections, "messages": len(self.messages),
+                    "bytes": sum(len(message.as_bytes()) for _, _, message in self.messages)}
+
+    def connected(self) -> None:
+        """Count a new connection."""
+        with self._lock:
+            self.connections += 1
+
+    def receive(self, sender: str, recipients: list[str], data: bytes) -> None:
+        """Keep a mail, after the time accepting it takes."""
+        if self.latency:
+            time.sleep(self.latency)
+        message = BytesParser(policy=policy.default).parsebytes(data)
+        with self._lock:
+            self.messages.append((sender, recipients, message))
+
+    def _handler_class(self) -> type:
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Speaks enough SMTP for smtplib to send a mail, on one connection."""
+
+            def reply(self, line: str) -> None:
+                """Send one reply line."""
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self) -> None:
+                """Answer the commands of one connection until QUIT or the idle timeout."""
+                server.connected()
+                self.connection.settimeout(server.idle_timeout)
+                self.reply("220 localhost ESMTP")
+                sender, recipients = "", []
+                try:
+                    for raw in self.rfile:
+                        command, _, argument = raw.decode("utf-8").rstrip("\r\n").partition(" ")
+                        command = command.upper()
+                        if command == "EHLO":
+                            self.reply("250-localhost")
+                            self.reply("250 8BITMIME")
+                        elif command == "MAIL":
+                            sender, recipients = argument.partition(":")[2].strip("<> "), []
+                            self.reply("250 OK")
+                        elif command == "RCPT":
+                            recipients.append(argument.partition(":")[2].strip("<> "))
+                            self.reply("250 OK")
+                        elif command == "DATA":
+                            self.reply("354 End data with <CR><LF>.<CR><LF>")
+                            lines = []
+                            for line in self.rfile:
+                                if line in (b".\r\n", b".\n"):
+                                    break
+                                lines.append(line[1:] if line.startswith(b".") else line)
+                            server.receive(sender, recipients, b"".join(lines))
+                            self.reply("250 OK")
+                        elif command in ("HELO", "RSET", "NOOP"):
+                            self.reply("250 OK")
+                        elif command == "QUIT":
+                            self.reply("221 Bye")
+                            return
+                        else:
+                            self.reply("502 Command not implemented")
+                except socket.timeout:
+                    self.reply("421 Idle timeout, closing connection")
+
+        return Handler
@@ -1,10 +1,14 @@
-import win32com.client
-import time
 import re
 import csv
+import io
 import os
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 
+from sap_screen import ScreenSnapshot
+from sap_messages import parse_zfi_test, parse_zfi_update, debitor_test_ok, parse_debitor_update, DEBITOR_CREATED
+from sap_wait import wait_for_element, wait_ready
+from sap_sessions import get_session
+
 def is_cvr(cvr: str) -> bool:
     """
     Validates a Danish CVR number using modulus-11.
@@ -47,32 +51,24 @@ def generate_row(debitornummer):
     ]
 
 def generate_csv(debitors, output_filename):
+    buffer = io.StringIO(newline='')
+    writer = csv.writer(buffer, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    #writer.writerow(header)
+    writer.writerows(generate_row(debitornummer) for debitornummer in debitors)
     with open(output_filename, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        #writer.writerow(header)
-        for debitornummer in debitors:
-            row = generate_row(debitornummer)
-            writer.writerow(row)
+        file.write(buffer.getvalue())
     return os.path.abspath(output_filename)
         
 
 
-def wait_for_element(session, element_id, timeout=10):
-    """Wait dynamically for an element to be available."""
-    for _ in range(timeout * 10):
-        try:
-            el = session.findById(element_id)
-            return el
-        except:
-            time.sleep(0.1)
-    raise TimeoutError(f"Element {element_id} not found after {timeout} seconds")
-
-
-def run_zfi_fakturagrundlag(filepath, orchestrator_connection: OrchestratorConnection):
-    SapGuiAuto = win32com.client.GetObject("SAPGUI")
-    application = SapGuiAuto.GetScriptingEngine
-    connection = application.Children(0)
-    session = connection.Children(0)
+def run_zfi_fakturagrundlag(filepath, orchestrator_connection: OrchestratorConnection, session=None, test: bool = True):
+    """
+    Uploads an invoice file with ZFI_FAKTURAGRUNDLAG on the given SAP session, or the first one.
+    The file is run in test mode first, unless test is False because its debitors are known to
+    exist; SAP then lists the same errors instead of saving, and they are handled like a failed test.
+    Returns (True, order numbers) when the orders are saved, and (False, inactive debitors) otherwise.
+    """
+    session = session or get_session()
 
 
     # Navigate to transaction
@@ -86,162 +82,166 @@ def run_zfi_fakturagrundlag(filepath, orchestrator_connection: OrchestratorConne
     path_field.caretPosition = len(filepath)
     session.findById("wnd[0]").sendVKey(0)  # Confirm path
 
-    # Set test mode (radio button)
-    test_radio = wait_for_element(session, "wnd[0]/usr/radP_TEST")
-    test_radio.select()  # more semantic than .setFocus + VKey
-
-    # Execute (F8)
-    execute_button = wait_for_element(session, "wnd[0]/tbar[1]/btn[8]")
-    execute_button.press()
-
-    container = session.findById("/app/con[0]/ses[0]/wnd[0]/usr")
-    texts = []
-    for child in container.Children:
-        if "lbl" in child.Id:  # filter only labels
-            try:
-                text = child.Text.strip()
-                texts.append(text)
-            except:
-                continue 
-    combined = " | ".join(texts)
-    orchestrator_connection.log_info(f"All label texts combined:\n{combined}")
-
-    if "Input filen er fejlfri - klar til opdatering.".strip().lower() in combined.lower():
-        orchestrator_connection.log_info("Fejlfri test, opretter fakturaen")
-        session.findById("wnd[0]/tbar[0]/btn[12]").press()
+    test_result = None
+    if test:
+        # Set test mode (radio button)
+        test_radio = wait_for_element(session, "wnd[0]/usr/radP_TEST")
+        test_radio.select()  # more semantic than .setFocus + VKey
+
+        # Execute (F8)
+        execute_button = wait_for_element(session, "wnd[0]/tbar[1]/btn[8]")
+        execute_button.press()
+        wait_ready(session, step="ZFI_FAKTURAGRUNDLAG test")
+
+        container = session.findById("wnd[0]/usr")
+        texts = ScreenSnapshot.capture(container).labels()  # filter only labels
+        combined = " | ".join(texts)
+        orchestrator_connection.log_info(f"All label texts combined:\n{combined}")
+
+        test_result = parse_zfi_test(texts)
+        if test_result.ok:
+            orchestrator_connection.log_info("Fejlfri test, opretter fakturaen")
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+
+    if test_result is None or test_result.ok:
         opret_radio = wait_for_element(session, "wnd[0]/usr/radP_OPDAT")
         opret_radio.select()  # more semantic than .setFocus + VKey
         execute_button = wait_for_element(session, "wnd[0]/tbar[1]/btn[8]")
         execute_button.press()
-        container = session.findById("/app/con[0]/ses[0]/wnd[0]/usr")
+        wait_ready(session, step="ZFI_FAKTURAGRUNDLAG opdatering")
+        container = session.findById("wnd[0]/usr")
 
         # Collect all label texts in order
-        texts = []
-        for child in container.Children:
-            if "lbl" in child.Id:  # SAP GUI labels usually have 'lbl' in their Id
-                try:
-                    texts.append((child.Id, (child.Text or "").strip()))
-                except Exception:
-                    continue
-
-        # Convenience: just the text values
-        labels = [t for _, t in texts]
+        labels = ScreenSnapshot.capture(container).labels()
         orchestrator_connection.log_info("All label texts combined:\n" + " | ".join(labels))
 
-        # Find the split point
-        try:
-            split_idx = labels.index("Række Fejltekst")
-        except ValueError:
-            orchestrator_connection.log_error("Kunne ikke finde 'Række Fejltekst' i labels; kan ikke validere.")
-            raise RuntimeError("Kunne ikke finde 'Række Fejltekst' i labels; kan ikke validere.")
-
-        after = labels[split_idx + 1 :]
+        update_result = parse_zfi_update(labels)
+        if test or update_result.order_ids:
+            if not update_result.found_header:
+                orchestrator_connection.log_error("Kunne ikke finde 'Række Fejltekst' i labels; kan ikke validere.")
+                raise RuntimeError("Kunne ikke finde 'Række Fejltekst' i labels; kan ikke validere.")
 
-        # Pattern: "KMD Standardordre <digits> gemt"
-        pat = re.compile(r"^KMD\s+Standardordre\s+(\d+)\s+gemt$", re.IGNORECASE)
+            # If any non-empty entry didn't match, that's an error
+            if update_result.unexpected:
+                raise RuntimeError(
+                    "Uventet tekst efter 'Række Fejltekst' (skal være 'KMD Standardordre <xyz> gemt' eller tom). "
+                    f"Fandt i stedet: {update_result.unexpected}"
+                )
 
-        standardordre_ids = []
-        bad_entries = []
+            # At this point, everything non-empty was valid and we've captured all xyz values
+            standardordre_ids = update_result.order_ids
+            orchestrator_connection.log_info(f"Valideret. Fangede {len(standardordre_ids)} Standardordre-id(s): {standardordre_ids}")
 
-        for text in after:
-            if text == "":  # empty is allowed, skip it
-                continue
-            m = pat.match(text)
-            if m:
-                standardordre_ids.append(m.group(1))
-            else:
-                bad_entries.append(text)
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
 
-        # If any non-empty entry didn't match, that's an error
-        if bad_entries:
-            raise RuntimeError(
-                "Uventet tekst efter 'Række Fejltekst' (skal være 'KMD Standardordre <xyz> gemt' eller tom). "
-                f"Fandt i stedet: {bad_entries}"
-            )
+            return True, standardordre_ids
 
-        # At this point, everything non-empty was valid and we've captured all xyz values
-        orchestrator_connection.log_info(f"Valideret. Fangede {len(standardordre_ids)} Standardordre-id(s): {standardordre_ids}")
-        
-        session.findById("wnd[0]/tbar[0]/btn[12]").press()
-        session.findById("wnd[0]/tbar[0]/btn[12]").press()
-
-        return True, standardordre_ids
+        # Without a test run SAP shows the error list instead of saving, e.g. for a debitor that isn't active after all
+        orchestrator_connection.log_info("Opdatering uden test gemte ingen ordrer, læser fejllisten")
+        test_result = parse_zfi_test(labels)
 
-    items = [p.strip() for p in combined.split('|') if p.strip()]
-
-    # Explicitly remove header line if present
-    if items and "fejlliste vedr. indlæsning" in items[0].lower():
-        items = items[1:]
-    
-    if items and "række fejltekst" in items[1].lower():
-        items = items[2:]
-
-    # Group into [row, (optional blank), message]
-    rows = []
-    i = 0
-    while i + 1 < len(items):
-        row_num = items[i]
-        message = items[i + 1]
-        rows.append((row_num, message))
-        i += 2
-
-    if i < len(items):
-        leftover = items[i]
-        orchestrator_connection.log_error(f"Uventet uparret fejltekst i slutningen:\n{leftover}")
-        raise ValueError(f"Uventet uparret fejltekst i slutningen:\n{leftover}")
-    
-    # Accepted error formats
-    valid_patterns = [
-        r"^Ordregiver\s+(\d{10,})\s+er ikke aktiv i Salgsområde\s+\d+(?:\s\d+)*\.?$",
-        r"^Fakturamodtager\s+(\d{10,})\s+er ikke aktiv i Salgsområde\s+\d+(?:\s\d+)*\.?$"
-    ]
-
-    extracted_ids = set()
-    invalid_rows = []
-
-    for row_number, message in rows:
-        matched = False
-        for pattern in valid_patterns:
-            match = re.match(pattern, message)
-            if match:
-                raw_id = match.group(1)
-                clean_id = raw_id[2:] if raw_id.startswith("00") else raw_id
-                extracted_ids.add(clean_id)
-                matched = True
-                break
-        if not matched:
-            invalid_rows.append(f"Række {row_number}: {message}")
+    if test_result.unpaired is not None:
+        orchestrator_connection.log_error(f"Uventet uparret fejltekst i slutningen:\n{test_result.unpaired}")
+        raise ValueError(f"Uventet uparret fejltekst i slutningen:\n{test_result.unpaired}")
 
     #Exit current screen
     session.findById("wnd[0]/tbar[0]/btn[12]").press()
     session.findById("wnd[0]/tbar[0]/btn[12]").press()
 
-    if invalid_rows:
-        orchestrator_connection.log_error("Uventede fejlmeddelelser:\n" + "\n".join(invalid_rows))
-        raise ValueError("Uventede fejlmeddelelser:\n" + "\n".join(invalid_rows))
+    if test_result.unexpected_rows:
+        orchestrator_connection.log_error("Uventede fejlmeddelelser:\n" + "\n".join(test_result.unexpected_rows))
+        raise ValueError("Uventede fejlmeddelelser:\n" + "\n".join(test_result.unexpected_rows))
     
-    if not extracted_ids:
+    if not test_result.inactive_debitors:
         orchestrator_connection.log_error("Ingen gyldige CVR-numre blev fundet.")
         raise ValueError("Ingen gyldige CVR-numre blev fundet.")
     
-    return False, list(extracted_ids)
+    return False, list(test_result.inactive_debitors)
  
     
-def create_debitors(file_path, orchestrator_connection: OrchestratorConnection):
-    # Start SAP GUI scripting engine
-    SapGuiAuto = win32com.client.GetObject("SAPGUI")
-    application = SapGuiAuto.GetScriptingEngine
-    connection = application.Children(0)
-    session = connection.Children(0)
+class OrderMappingError(RuntimeError):
+    """
+    ZFI_FAKTURAGRUNDLAG has saved orders for a file, but they can't be paired with its rows.
+    The orders exist in SAP while the rows are still TilFakturering, so the rows must be fixed by
+    hand. The message lists the saved orders and the row IDs in file order for that.
+    """
+
+    def __init__(self, reason, order_numbers, sql_ids):
+        self.order_numbers = list(order_numbers)
+        self.sql_ids = list(sql_ids)
+        super().__init__(
+            f"{reason}. Ordrer gemt i SAP: {self.order_numbers}. SQL række-ID'er i filens rækkefølge: {self.sql_ids}. "
+            "Rækkerne skal opdateres manuelt, før de køres igen."
+        )
+
+
+def duplicate_ids(sql_ids):
+    """The IDs that occur more than once, in the order they first repeat."""
+    seen, duplicates = set(), []
+    for sql_id in sql_ids:
+        key = str(sql_id)
+        if key in seen and key not in duplicates:
+            duplicates.append(key)
+        seen.add(key)
+    return duplicates
+
+
+def map_order_numbers(order_numbers, sql_ids):
+    """
+    Pairs the order numbers saved by ZFI_FAKTURAGRUNDLAG with the SQL rows in the uploaded file.
+    SAP saves one order per H record and reports them in file order, so the n'th
+    "KMD Standardordre <n> gemt" line belongs to the n'th invoice in the file.
+    The result lines don't name the row they belong to, so the pairing is only accepted when
+    there is exactly one distinct order per distinct row; anything else raises OrderMappingError.
+    """
+    duplicates = duplicate_ids(sql_ids)
+    if duplicates:
+        raise OrderMappingError(f"SQL række-ID'er forekommer flere gange i filen: {duplicates}", order_numbers, sql_ids)
+    if len(order_numbers) != len(sql_ids):
+        raise OrderMappingError(
+            f"Forventede {len(sql_ids)} ordrenummer/-numre, men fandt {len(order_numbers)}", order_numbers, sql_ids
+        )
+    repeated_orders = duplicate_ids(order_numbers)
+    if repeated_orders:
+        raise OrderMappingError(f"SAP meldte de samme ordrenumre flere gange: {repeated_orders}", order_numbers, sql_ids)
+    return dict(zip(sql_ids, order_numbers))
+
+
+def map_debitor_results(debitors, lines):
+    """
+    Pairs each debitor in a ZFIE_OPRETDEB file with the result line that mentions it.
+    If no line mentions a debitor number but there is one line per debitor, they are paired in file order.
+    Returns a dict of debitor -> line for the debitors that could be paired.
+    """
+    results = {}
+    for debitor in debitors:
+        pattern = re.compile(rf"(?<!\d)0*{re.escape(str(debitor))}(?!\d)")
+        for line in lines:
+            if pattern.search(line):
+                results[debitor] = line
+                break
+    if not results and len(lines) == len(debitors):
+        results = dict(zip(debitors, lines))
+    return results
+
+
+def create_debitors(file_path, orchestrator_connection: OrchestratorConnection, debitors=None, session=None):
+    """
+    Creates the debitors in the CSV file with ZFIE_OPRETDEB, first in test mode and then for real.
+    If the debitors in the file are given, returns a dict of debitor -> result line for the ones
+    the result list could be tied to. Runs on the given SAP session, or the first one.
+    """
+    session = session or get_session()
 
 
 
     # Enter transaction code
-    session.findById("wnd[0]/tbar[0]/okcd").text = "ZFIE_OPRETDEB"
+    wait_for_element(session, "wnd[0]/tbar[0]/okcd").text = "ZFIE_OPRETDEB"
     session.findById("wnd[0]").sendVKey(0)
 
     # Set checkbox P_TEST to True
-    checkbox = session.findById("wnd[0]/usr/chkP_TEST")
+    checkbox = wait_for_element(session, "wnd[0]/usr/chkP_TEST")
     if not checkbox.selected:
         checkbox.selected = True
 
@@ -250,74 +250,64 @@ def create_debitors(file_path, orchestrator_connection: OrchestratorConnection):
 
     # Press F8 (Execute)
     session.findById("wnd[0]").sendVKey(8)
-    
-    
+    wait_ready(session, step="ZFIE_OPRETDEB test")
+
+
     # Get the usr container
     usr_container = session.findById("wnd[0]/usr")
 
-    # Loop through all children and combine text from GuiLabel elements
-    combined_text = ""
-    for child in usr_container.Children:
-        if child.Type == "GuiLabel":
-            text = child.Text.strip()
-            if text:  # skip empty labels
-                combined_text += text + "\n"
-    orchestrator_connection.log_info(combined_text)
+    # Text of the GuiLabel elements, without the empty ones
+    label_texts = [text for text in ScreenSnapshot.capture(usr_container).texts_of_type("GuiLabel") if text]
+    orchestrator_connection.log_info("".join(text + "\n" for text in label_texts))
     
-    if "alt er ok" in combined_text.lower() and not "ikke korrekt" in combined_text.lower():
+    if debitor_test_ok(label_texts):
         orchestrator_connection.log_info(f"Debitor oprettes")
         session.findById("wnd[0]/tbar[0]/btn[12]").press()
-        checkbox = session.findById("wnd[0]/usr/chkP_TEST")
+        checkbox = wait_for_element(session, "wnd[0]/usr/chkP_TEST")
         if checkbox.selected:
             checkbox.selected = False
         session.findById("wnd[0]").sendVKey(8)
-        container = session.findById("/app/con[0]/ses[0]/wnd[0]/usr")
+        wait_ready(session, step="ZFIE_OPRETDEB opdatering")
+        container = session.findById("wnd[0]/usr")
 
         # Grab all lbl texts in order
-        labels = []
-        for child in container.Children:
-            if "lbl" in child.Id:
-                try:
-                    text = (child.Text or "").strip()
-                except Exception:
-                    text = ""
-                labels.append(text)
-
-        orchestrator_connection.log_info("Labels found:\n" + "\n".join(labels))        # Locate the marker line ("      1")
-        try:
-            marker_index = labels.index("1")  # "      1" will be stripped to "1"
-        except ValueError:
+        labels = ScreenSnapshot.capture(container).labels()
+
+        orchestrator_connection.log_info("Labels found:\n" + "\n".join(labels))
+        update_result = parse_debitor_update(labels)
+        if not update_result.found_marker:
             orchestrator_connection.log_error("Marker '      1' not found in labels.")
             raise RuntimeError("Marker '      1' not found in labels.")
 
         # Lines after the marker
-        after_lines = labels[marker_index + 1 :]
+        after_lines = update_result.lines
         
         if not after_lines:
             orchestrator_connection.log_error("Ingen linjer fundet efter overskrift, debitoroprettelse er muligvis fejlet.")
             raise RuntimeError("Ingen linjer fundet efter overskrift, debitoroprettelse er muligvis fejlet.")
 
-        # Required phrase
-        required_phrase = "Følgende debitorer er operttet korrekt"
-
         # Validate all lines after marker contain the phrase
-        bad_lines = [line for line in after_lines if required_phrase not in line]
+        bad_lines = update_result.not_created
 
         if bad_lines:
             orchestrator_connection.log_error(
-                f"Nogle linjer efter står ikke som oprettet korrekt, da de mangler teksten '{required_phrase}':\n" +
+                f"Nogle linjer efter står ikke som oprettet korrekt, da de mangler teksten '{DEBITOR_CREATED}':\n" +
                 "\n".join(repr(l) for l in bad_lines)
             )
             raise RuntimeError(
-                f"Nogle linjer efter står ikke som oprettet korrekt, da de mangler teksten '{required_phrase}':\n" +
+                f"Nogle linjer efter står ikke som oprettet korrekt, da de mangler teksten '{DEBITOR_CREATED}':\n" +
                 "\n".join(repr(l) for l in bad_lines)
             )
 
         orchestrator_connection.log_info("Alle linjer indeholder den krævede tekst.")
         session.findById("wnd[0]/tbar[0]/btn[12]").press()
         session.findById("wnd[0]/tbar[0]/btn[12]").press()
-        
+        return map_debitor_results(debitors or [], after_lines)
+
     else:
+        # Leave the test list and the transaction so the session is back at the start screen
+        session.findById("wnd[0]/tbar[0]/btn[12]").press()
+        session.findById("wnd[0]/tbar[0]/btn[12]").press()
         raise Exception("Fejl i debitoroprettelse, stopper kørsel.")
     
     
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""
+Danish number formatting without the locale module.
+
+Invoices used to set LC_NUMERIC to da_DK for every row and format through locale.format_string,
+which is slow and changes process-wide state under the threads that now build invoices.
+These functions give the same text from plain str formatting: ',' as decimal separator
+and, when grouping, '.' between thousands.
+"""
+
+# Swaps the separators of Python's "1,234.50" into the Danish "1.234,50" in one pass
+_DANISH_SEPARATORS = str.maketrans(",.", ".,")
+
+
+def format_number(value: float, decimals: int, grouping: bool = False) -> str:
+    """value with a fixed number of decimals, e.g. 1234.5 -> "1234,50" or "1.234,50" when grouping."""
+    if grouping:
+        return f"{value:,.{decimals}f}".translate(_DANISH_SEPARATORS)
+    return f"{value:.{decimals}f}".replace(".", ",")
+
+
+def format_decimal(value, decimals=None, none: str = "") -> str:
+    """
+    DK formatting, as locale.format_string with da_DK and no grouping gave it. If decimals is None:
+      - ints => no decimals
+      - floats => 2 decimals unless it's an integer-like value
+    If decimals given => force that many.
+    Anything that isn't a number is returned as str(value), and None as `none`.
+    """
+    if isinstance(value, int):
+        if decimals is None:
+            return f"{value:d}"
+        return format_number(value, decimals)
+    if isinstance(value, float):
+        if value.is_integer() and decimals is None:
+            return f"{int(value):d}"
+        return format_number(value, 2 if decimals is None else decimals)
+    return none if value is None else str(value)
+
+
+def format_amount(value, decimals: int = 2) -> str:
+    """An amount with thousands separators, e.g. "1.234,50". Accepts numbers and strings like "1234,5"."""
+    return format_number(float(str(value).replace(",", ".")), decimals, grouping=True)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the old locale path. The output is checked in tests/test_danish_numbers.py.
+    import locale
+    import timeit
+
+    def locale_format_decimal(value, decimals=None):
+        """The old implementation from generate_invoice_csv."""
+        if isinstance(value, int):
+            if decimals is None:
+                return str(locale.format_string("%d", value, grouping=False))
+            return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
+        if isinstance(value, float):
+            if value.is_integer() and decimals is None:
+                return str(locale.format_string("%d", int(value), grouping=False))
+            if decimals is None:
+                return str(locale.format_string("%.2f", value, grouping=False))
+            return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
+        return "" if value is None else str(value)
+
+    for name in ("da_DK", "da_DK.UTF-8", "Danish_Denmark.1252"):
+        try:
+            locale.setlocale(locale.LC_NUMERIC, name)
+            break
+        except locale.Error:
+            continue
+    else:
+        raise SystemExit("No Danish locale installed, nothing to compare the locale path against")
+
+    SAMPLES = [(12.5, None), (3.25, None), (31, 3), (40.62, 2), (19.0, None)]
+    NUMBER = 100_000
+    locale_time = timeit.timeit(lambda: [locale_format_decimal(v, d) for v, d in SAMPLES], number=NUMBER)
+    plain_time = timeit.timeit(lambda: [format_decimal(v, d) for v, d in SAMPLES], number=NUMBER)
+    per_call = NUMBER * len(SAMPLES)
+    print(f"locale: {locale_time / per_call * 1e6:.2f} µs per number")
+    print(f"plain:  {plain_time / per_call * 1e6:.2f} µs per number ({locale_time / plain_time:.1f}x faster)")
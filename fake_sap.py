@@ -0,0 +1,659 @@
+"""
+A SAP GUI stand-in in pure Python, to run the SAP steps where there is no SAP, e.g. on Linux.
+
+FakeSapGui is a session provider for sap_sessions.set_provider(). Its scripting engine models
+the part of the SAP GUI scripting API the robot uses: findById, Children, Busy, ActiveWindow,
+Info.User, sendVKey, text/caret fields, check boxes, radio buttons, toolbar buttons with their
+tooltips and list screens of labels at lbl[col,row]. Property names are case-insensitive, as over COM.
+
+The transactions ZFI_FAKTURAGRUNDLAG, ZFIE_OPRETDEB and ZVF04 are scripted against a small
+SAP backend: the files the robot uploads are read, debitors SAP doesn't know are reported as
+not active, orders get numbers and ZVF04 lists and sends them. The result screens have the
+texts the parsers in sap_messages and send_invoices were written against.
+
+Latency is configurable: every property read, write and method call on a GUI object costs
+FakeLatency.call seconds, like a COM round trip, and after each action the session is Busy
+for FakeLatency.screen seconds plus FakeLatency.per_record for every invoice or debitor in
+the file it worked on.
+"""
+
+from dataclasses import dataclass
+from datetime import date
+import csv
+import itertools
+import ntpath
+import threading
+import time
+
+
+class FakeSapError(Exception):
+    """What a failing scripting call raises, in place of pywintypes.com_error."""
+
+
+class FakeSapAttributeError(FakeSapError, AttributeError):
+    """An unknown property or method, which COM reports as an AttributeError too."""
+
+
+@dataclass
+class FakeLatency:
+    """Seconds the fake SAP takes. call: per property or method access. screen: Busy after an action.
+    per_record: Busy per invoice or debitor when a transaction runs a file."""
+    call: float = 0.0
+    screen: float = 0.0
+    per_record: float = 0.0
+
+
+# Tooltips of the toolbar buttons, as SAP shows them in Danish. The button number is the VKey it sends.
+TOOLBAR = {
+    "tbar[0]": {0: "Enter   (Enter)", 3: "Tilbage   (F3)", 11: "Gem   (Ctrl+S)", 12: "Annuller   (F12)"},
+    "tbar[1]": {5: "Marker alle   (F5)", 8: "Udfør   (F8)"},
+}
+TRANSACTIONS = {
+    "ZFI_FAKTURAGRUNDLAG": "Indlæsning af fakturagrundlag",
+    "ZFIE_OPRETDEB": "Oprettelse af debitorer",
+    "ZVF04": "Afsendelse af fakturaer",
+}
+EASY_ACCESS = "SAP Easy Access"
+ZVF04_COLUMNS = ((1, "Ordre"), (14, "Debitor"), (27, "Opret. d."), (40, "Oprettet af"), (54, "Fejl"))
+
+
+def _debitor(value: str) -> str:
+    """A debitor number the way the backend keys it, without leading zeros."""
+    return value.strip().lstrip("0")
+
+
+class FakeObject:
+    """A scripting object. Public properties live in _props under their lowercase name;
+    methods are the _do_<name> methods. Both are looked up case-insensitively and cost a call.
+    prop() and set_prop() read and write a property without the cost, for the fake's own use."""
+
+    def __init__(self, session: "FakeSession | None", **props):
+        object.__setattr__(self, "_session", session)
+        object.__setattr__(self, "_props", {name.lower(): value for name, value in props.items()})
+
+    def prop(self, key: str):
+        """A property by its lowercase name, without a scripting call."""
+        return self._props[key]
+
+    def set_prop(self, key: str, value) -> None:
+        """Set a property by its lowercase name, without a scripting call or its side effects."""
+        self._props[key] = value
+
+    def _latency(self) -> None:
+        if self._session is not None:
+            self._session.system.com_call()
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        key = name.lower()
+        self._latency()
+        if key in self._props:
+            return self._props[key]
+        method = getattr(self, f"_do_{key}", None)
+        if method is None:
+            raise FakeSapAttributeError(f"{type(self).__name__} has no property or method '{name}'")
+        return method
+
+    def __setattr__(self, name: str, value) -> None:
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+            return
+        key = name.lower()
+        self._latency()
+        if key not in self._props:
+            raise FakeSapAttributeError(f"{type(self).__name__} has no property '{name}'")
+        self._set(key, value)
+
+    def _set(self, key: str, value) -> None:
+        self._props[key] = value
+
+
+class FakeCollection(list):
+    """A GuiComponentCollection: Count, called with an index, and iterable."""
+
+    @property
+    def Count(self) -> int:  # pylint: disable=invalid-name
+        """The number of objects in the collection."""
+        return len(self)
+
+    def __call__(self, index: int):
+        return self[index]
+
+    Item = __call__
+
+
+class FakeElement(FakeObject):
+    """A control on a screen. name is its last id segment, e.g. "ctxtP_PATH" or "lbl[1,3]"."""
+
+    def __init__(self, session, parent_id: str, name: str, type_: str, text: str = "", **props):
+        super().__init__(session, id=f"{parent_id}/{name}", name=name, type=type_, text=text, **props)
+        self._children = {}
+
+    def add(self, element: "FakeElement") -> "FakeElement":
+        """Add a child control, replacing one with the same name."""
+        self._children[element.prop("name")] = element
+        return element
+
+    def child(self, name: str) -> "FakeElement":
+        """The child control with the given name, or the error findById gives."""
+        try:
+            return self._children[name]
+        except KeyError:
+            raise FakeSapError(f"The control could not be found by id: {self._props['id']}/{name}") from None
+
+    @property
+    def Children(self) -> FakeCollection:  # pylint: disable=invalid-name
+        """The child controls."""
+        self._latency()
+        return FakeCollection(self._children.values())
+
+    def _do_setfocus(self) -> None:
+        pass
+
+
+class FakeField(FakeElement):
+    """A text field (txt/ctxt/pwd)."""
+
+    def __init__(self, session, parent_id: str, name: str, type_: str, text: str = ""):
+        super().__init__(session, parent_id, name, type_, text, caretposition=0)
+
+
+class FakeCheckBox(FakeElement):
+    """A check box."""
+
+    def __init__(self, session, parent_id: str, name: str, selected: bool):
+        super().__init__(session, parent_id, name, "GuiCheckBox", selected=selected)
+
+
+class FakeRadioButton(FakeElement):
+    """A radio button. Selecting it clears the others in its group."""
+
+    def __init__(self, session, parent_id: str, name: str, group: list, selected: bool):
+        super().__init__(session, parent_id, name, "GuiRadioButton", selected=selected)
+        self._group = group
+        group.append(self)
+
+    def _do_select(self) -> None:
+        for button in self._group:
+            button.set_prop("selected", button is self)
+
+    def _set(self, key: str, value) -> None:
+        if key == "selected" and value:
+            self._do_select()
+        else:
+            super()._set(key, value)
+
+
+class FakeButton(FakeElement):
+    """A toolbar button. Pressing btn[n] sends VKey n to its window."""
+
+    def __init__(self, session, parent_id: str, vkey: int, tooltip: str, window: "FakeWindow"):
+        super().__init__(session, parent_id, f"btn[{vkey}]", "GuiButton", tooltip=tooltip)
+        self._vkey = vkey
+        self._window = window
+
+    def _do_press(self) -> None:
+        self._session.send_key(self._window, self._vkey)
+
+
+class FakeWindow(FakeElement):
+    """wnd[0], the main window, or a popup on top of it."""
+
+    def __init__(self, session, index: int, title: str):
+        super().__init__(session, session.prop("id"), f"wnd[{index}]", "GuiMainWindow" if index == 0 else "GuiModalWindow", title)
+        window_id = self._props["id"]
+        for toolbar_name, buttons in TOOLBAR.items():
+            toolbar = self.add(FakeElement(session, window_id, toolbar_name, "GuiToolbar"))
+            for vkey, tooltip in buttons.items():
+                toolbar.add(FakeButton(session, f"{window_id}/{toolbar_name}", vkey, tooltip, self))
+        if index == 0:
+            self.child("tbar[0]").add(FakeField(session, f"{window_id}/tbar[0]", "okcd", "GuiOkCodeField"))
+
+    def find(self, element_id: str) -> FakeElement:
+        """findById below the window, without a scripting call."""
+        element = self
+        for name in element_id.strip("/").split("/"):
+            element = element.child(name)
+        return element
+
+    def _do_sendvkey(self, vkey: int) -> None:
+        self._session.send_key(self, vkey)
+
+    def _do_findbyid(self, element_id: str) -> FakeElement:
+        return self.find(element_id)
+
+
+class _Screen:
+    """One screen on the session's stack: a selection screen with fields, or a list of labels."""
+
+    def __init__(self, transaction: str | None, title: str, kind: str):
+        self.transaction = transaction
+        self.title = title
+        self.kind = kind  # "easy_access", "selection" or "list"
+        self.fields: dict[str, FakeElement] = {}
+        self.labels: list[tuple[int, int, str]] = []
+        self.marked = False
+        self.orders: list[str] = []
+
+
+class FakeSession(FakeObject):
+    """A session: the windows and the screen stack of one SAP GUI mode."""
+
+    def __init__(self, connection: "FakeConnection", index: int, user: str, popups=()):
+        super().__init__(None, id=f"{connection.prop('id')}/ses[{index}]", name=f"ses[{index}]", type="GuiSession")
+        self._session = self
+        object.__setattr__(self, "connection", connection)
+        object.__setattr__(self, "system", connection.system)
+        self._busy_until = 0.0
+        self._screens = [_Screen(None, EASY_ACCESS, "easy_access")]
+        self._props["info"] = FakeObject(self, user=user, systemname="P01", client="100", transaction="SESSION_MANAGER")
+        self._windows = [FakeWindow(self, 0, EASY_ACCESS)]
+        self._windows += [FakeWindow(self, i, title) for i, title in enumerate(popups, start=1)]
+        self._show()
+
+    @property
+    def Busy(self) -> bool:  # pylint: disable=invalid-name
+        """Whether SAP is still working on the last action."""
+        self._latency()
+        return time.monotonic() < self._busy_until
+
+    @property
+    def ActiveWindow(self) -> FakeWindow:  # pylint: disable=invalid-name
+        """The top popup, or wnd[0] if there is none."""
+        self._latency()
+        return self._windows[-1]
+
+    @property
+    def Children(self) -> FakeCollection:  # pylint: disable=invalid-name
+        """The session's windows."""
+        self._latency()
+        return FakeCollection(self._windows)
+
+    def find(self, element_id: str) -> FakeObject:
+        """findById below the session, without a scripting call."""
+        own_id = self._props["id"]
+        if element_id.startswith(own_id):
+            element_id = element_id[len(own_id):]
+        first, _, rest = element_id.strip("/").partition("/")
+        if not first:
+            return self
+        window = next((w for w in self._windows if w.prop("name") == first), None)
+        if window is None:
+            raise FakeSapError(f"The control could not be found by id: {own_id}/{element_id.strip('/')}")
+        return window.find(rest) if rest else window
+
+    def _do_findbyid(self, element_id: str) -> FakeObject:
+        return self.find(element_id)
+
+    def _do_createsession(self) -> None:
+        self.connection.new_session()
+
+    def _do_endtransaction(self) -> None:
+        del self._screens[1:]
+        self._show()
+
+    def _do_sendcommand(self, command: str) -> None:
+        self._command(command)
+
+    # --- Screen flow ---
+
+    def send_key(self, window: FakeWindow, vkey: int) -> None:
+        """A VKey sent to one of the session's windows, by sendVKey or a toolbar button."""
+        # A call to a busy session returns when SAP is done, like over COM
+        remaining = self._busy_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        if window is not self._windows[0]:
+            # Any key on a popup confirms it
+            self._windows.remove(window)
+            self._busy()
+            return
+        screen = self._screens[-1]
+        okcd = window.find("tbar[0]/okcd")
+        command = okcd.prop("text").strip()
+        okcd.set_prop("text", "")
+        if command:
+            self._command(command)
+        elif vkey in (3, 12):
+            if len(self._screens) > 1:
+                self._screens.pop()
+        elif vkey == 8 and screen.kind == "selection":
+            self._execute(screen)
+        elif vkey == 5 and screen.kind == "list" and screen.transaction == "ZVF04":
+            screen.marked = True
+        elif vkey == 11 and screen.kind == "list" and screen.transaction == "ZVF04" and screen.marked:
+            self.system.send_orders(screen.orders)
+        self._busy()
+        self._show()
+
+    def _busy(self, records: int = 0) -> None:
+        latency = self.system.latency
+        self._busy_until = time.monotonic() + latency.screen + latency.per_record * records
+
+    def _command(self, command: str) -> None:
+        transaction = command.upper()
+        if transaction.startswith("/N"):
+            transaction = transaction[2:]
+            del self._screens[1:]
+        if not transaction:
+            self._show()
+            return
+        if transaction not in TRANSACTIONS:
+            raise FakeSapError(f"Transaktion {transaction} findes ikke")
+        del self._screens[1:]
+        self._screens.append(self._selection_screen(transaction))
+        self._busy()
+        self._show()
+
+    def _selection_screen(self, transaction: str) -> _Screen:
+        screen = _Screen(transaction, TRANSACTIONS[transaction], "selection")
+        usr_id = f"{self._windows[0].prop('id')}/usr"
+        fields = screen.fields
+        if transaction == "ZFI_FAKTURAGRUNDLAG":
+            group = []
+            fields["ctxtP_PATH"] = FakeField(self, usr_id, "ctxtP_PATH", "GuiCTextField")
+            fields["radP_TEST"] = FakeRadioButton(self, usr_id, "radP_TEST", group, True)
+            fields["radP_OPDAT"] = FakeRadioButton(self, usr_id, "radP_OPDAT", group, False)
+        elif transaction == "ZFIE_OPRETDEB":
+            fields["ctxtP_FILNAM"] = FakeField(self, usr_id, "ctxtP_FILNAM", "GuiCTextField")
+            fields["chkP_TEST"] = FakeCheckBox(self, usr_id, "chkP_TEST", True)
+        else:
+            fields["ctxtP_FKDAT"] = FakeField(self, usr_id, "ctxtP_FKDAT", "GuiCTextField")
+            fields["txtS_ERNAM-LOW"] = FakeField(self, usr_id, "txtS_ERNAM-LOW", "GuiTextField")
+        return screen
+
+    def _execute(self, selection: _Screen) -> None:
+        fields = selection.fields
+        screen = _Screen(selection.transaction, selection.title, "list")
+        records = 0
+        if selection.transaction == "ZFI_FAKTURAGRUNDLAG":
+            test = fields["radP_TEST"].prop("selected")
+            screen.labels, records = self.system.zfi_fakturagrundlag(fields["ctxtP_PATH"].prop("text"), test, self._props["info"].prop("user"))
+        elif selection.transaction == "ZFIE_OPRETDEB":
+            screen.labels, records = self.system.zfie_opretdeb(fields["ctxtP_FILNAM"].prop("text"), fields["chkP_TEST"].prop("selected"))
+        else:
+            screen.orders = self.system.open_orders(fields["ctxtP_FKDAT"].prop("text"), fields["txtS_ERNAM-LOW"].prop("text"))
+            screen.labels = self.system.zvf04_list(screen.orders)
+            records = len(screen.orders)
+        self._screens.append(screen)
+        self._busy(records)
+
+    def _show(self) -> None:
+        """Put the top screen in wnd[0]/usr."""
+        window = self._windows[0]
+        screen = self._screens[-1]
+        window.set_prop("text", screen.title)
+        self._props["info"].set_prop("transaction", screen.transaction or "SESSION_MANAGER")
+        usr = FakeElement(self, window.prop("id"), "usr", "GuiUserArea")
+        for field in screen.fields.values():
+            usr.add(field)
+        for col, row, text in screen.labels:
+            usr.add(FakeElement(self, usr.prop("id"), f"lbl[{col},{row}]", "GuiLabel", text))
+        window.add(usr)
+
+
+class FakeConnection(FakeObject):
+    """A connection to the SAP system; new sessions open in it."""
+
+    def __init__(self, system: "FakeSapGui", index: int):
+        super().__init__(None, id=f"/app/con[{index}]", name=f"con[{index}]", type="GuiConnection")
+        object.__setattr__(self, "system", system)
+        self._sessions = FakeCollection()
+
+    @property
+    def Children(self) -> FakeCollection:  # pylint: disable=invalid-name
+        """The connection's sessions."""
+        self.system.com_call()
+        return FakeCollection(self._sessions)
+
+    def new_session(self, popups=()) -> FakeSession:
+        """Open a session with the lowest free number, like in SAP, at most six per connection."""
+        if len(self._sessions) >= 6:
+            raise FakeSapError("Det maksimale antal sessioner er nået")
+        taken = {s.prop("name") for s in self._sessions}
+        index = next(i for i in itertools.count() if f"ses[{i}]" not in taken)
+        session = FakeSession(self, index, self.system.user, popups)
+        self._sessions.append(session)
+        return session
+
+    def find(self, element_id: str) -> FakeObject:
+        """findById below the connection, without a scripting call."""
+        own_id = self._props["id"]
+        if element_id.startswith(own_id):
+            element_id = element_id[len(own_id):]
+        first, _, rest = element_id.strip("/").partition("/")
+        session = next((s for s in self._sessions if s.prop("name") == first), None)
+        if session is None:
+            raise FakeSapError(f"The control could not be found by id: {own_id}/{element_id.strip('/')}")
+        return session.find(rest) if rest else session
+
+    def _do_closesession(self, session_id: str) -> None:
+        self._sessions.remove(self.find(session_id))
+
+    def _do_findbyid(self, element_id: str) -> FakeObject:
+        return self.find(element_id)
+
+
+class FakeApplication(FakeObject):
+    """The scripting engine (GuiApplication)."""
+
+    def __init__(self, system: "FakeSapGui"):
+        super().__init__(None, id="/app", name="app", type="GuiApplication")
+        object.__setattr__(self, "system", system)
+        self._connections = FakeCollection()
+
+    @property
+    def Children(self) -> FakeCollection:  # pylint: disable=invalid-name
+        """The open connections."""
+        self.system.com_call()
+        return FakeCollection(self._connections)
+
+    def open_connection(self) -> FakeConnection:
+        """Open a new connection without sessions."""
+        connection = FakeConnection(self.system, len(self._connections))
+        self._connections.append(connection)
+        return connection
+
+    def _do_findbyid(self, element_id: str) -> FakeObject:
+        first, _, rest = element_id.removeprefix("/app").strip("/").partition("/")
+        connection = next((c for c in self._connections if c.prop("name") == first), None)
+        if connection is None:
+            raise FakeSapError(f"The control could not be found by id: {element_id}")
+        return connection.find(rest) if rest else connection
+
+
+class FakeSapGui:
+    """
+    A session provider with a scripted SAP behind it, logged in as user on one connection.
+
+    Args:
+        user: The SAP user the sessions are logged in as; ZVF04 lists the orders it created.
+        latency: How slow the fake is, see FakeLatency.
+        debitors: Debitor numbers SAP already knows.
+        invalid_debitors: Debitor numbers ZFIE_OPRETDEB refuses to create.
+        popups: Titles of popups open on top of the first session, e.g. a login notice.
+        logged_in: Whether the connection is open. If not, there is nothing until login().
+    """
+
+    def __init__(self, user: str = "ROBOT", latency: FakeLatency | None = None, debitors=(), invalid_debitors=(),
+                 popups=(), logged_in: bool = True):
+        self.user = user
+        self.latency = latency or FakeLatency()
+        self.debitors = {_debitor(d) for d in debitors}
+        self.invalid_debitors = {_debitor(d) for d in invalid_debitors}
+        # order number -> (created by, created on dd.mm.yyyy, sent)
+        self.orders: dict[str, list] = {}
+        # The ZVF04 list's columns as (label column, header), e.g. to rename a header
+        self.zvf04_columns = ZVF04_COLUMNS
+        self.counts = {"calls": 0, "uploads": 0, "invoices": 0, "debitors_created": 0, "sent": 0}
+        self._order_numbers = itertools.count(4500000000)
+        self._lock = threading.Lock()
+        self._application = FakeApplication(self)
+        if logged_in:
+            self.login(popups)
+
+    # --- Provider ---
+
+    def application(self) -> FakeApplication:
+        """The scripting engine."""
+        return self._application
+
+    def init_thread(self) -> None:
+        """Nothing to set up; the fake isn't bound to a thread like COM."""
+
+    def error_types(self) -> tuple[type, ...]:
+        """What failing scripting calls raise."""
+        return (FakeSapError, AttributeError)
+
+    def login(self, popups=()) -> FakeSession:
+        """Open a connection with one session, like launching a .sap shortcut."""
+        return self._application.open_connection().new_session(popups)
+
+    def com_call(self) -> None:
+        """Count a scripting call and take the time it costs."""
+        with self._lock:
+            self.counts["calls"] += 1
+        if self.latency.call:
+            time.sleep(self.latency.call)
+
+    def stats(self) -> dict:
+        """The counters, and the number of orders not sent yet."""
+        with self._lock:
+            return dict(self.counts, open_orders=sum(1 for *_, sent in self.orders.values() if not sent))
+
+    # --- Backend ---
+
+    def zfi_fakturagrundlag(self, path: str, test: bool, user: str) -> tuple[list, int]:
+        """The list screen of ZFI_FAKTURAGRUNDLAG for an invoice file, and the number of invoices in it."""
+        try:
+            with open(path, encoding="windows-1252", newline="") as file:
+                headers = [record for record in csv.reader(file, delimiter=";") if record and record[0] == "H"]
+        except OSError:
+            return [(1, 1, f"Filen {path} kan ikke åbnes")], 0
+
+        with self._lock:
+            inactive = [
+                (number, record[1]) for number, record in enumerate(headers, start=1)
+                if _debitor(record[1]) not in self.debitors
+            ]
+            if inactive:
+                labels = [(1, 1, "Fejlliste vedr. indlæsning"), (1, 2, ""), (1, 3, f"Fil: {ntpath.basename(path)}"),
+                          (1, 4, "Række Fejltekst")]
+                row = 5
+                for number, debitor in inactive:
+                    for role in ("Ordregiver", "Fakturamodtager"):
+                        labels += [(1, row, str(number)), (8, row, f"{role} {debitor} er ikke aktiv i Salgsområde 0020 20 20.")]
+                        row += 1
+                return labels, len(headers)
+            if test:
+                return [(1, 1, "Input filen er fejlfri - klar til opdatering."), (1, 2, "")], len(headers)
+
+            labels = [(1, 1, "Opdatering"), (1, 2, "Række Fejltekst")]
+            created_on = date.today().strftime("%d.%m.%Y")
+            for row, record in enumerate(headers, start=3):
+                order = str(next(self._order_numbers))
+                self.orders[order] = [user.upper(), created_on, record[1], False]
+                labels.append((1, row, f"KMD Standardordre {order} gemt"))
+            labels.append((1, len(labels) + 1, ""))
+            self.counts["uploads"] += 1
+            self.counts["invoices"] += len(headers)
+        return labels, len(headers)
+
+    def zfie_opretdeb(self, path: str, test: bool) -> tuple[list, int]:
+        """The list screen of ZFIE_OPRETDEB for a debitor file, and the number of debitors in it."""
+        try:
+            with open(path, encoding="utf-8", newline="") as file:
+                debitors = [record[0] for record in csv.reader(file, delimiter=";") if record]
+        except OSError:
+            return [(1, 1, f"Filen {path} kan ikke åbnes")], 0
+
+        with self._lock:
+            invalid = [debitor for debitor in debitors if _debitor(debitor) in self.invalid_debitors]
+            if test:
+                labels = [(1, 1, "Test af debitorfil")]
+                if invalid:
+                    labels += [(1, row, f"Debitor {debitor} er ikke korrekt") for row, debitor in enumerate(invalid, start=2)]
+                else:
+                    labels.append((1, 2, "Alt er OK"))
+                return labels, len(debitors)
+
+            labels = [(1, 1, "Debitoroprettelse"), (6, 2, "      1")]
+            for row, debitor in enumerate(debitors, start=3):
+                if debitor in invalid:
+                    labels.append((1, row, f"Debitor {debitor} kunne ikke oprettes"))
+                else:
+                    self.debitors.add(_debitor(debitor))
+                    self.counts["debitors_created"] += 1
+                    labels.append((1, row, f"Følgende debitorer er operttet korrekt: {debitor}"))
+        return labels, len(debitors)
+
+    def open_orders(self, created_on: str, user: str) -> list[str]:
+        """The unsent orders user created on created_on (dd.mm.yyyy), which ZVF04 lists."""
+        with self._lock:
+            return [
+                order for order, (creator, day, _, sent) in self.orders.items()
+                if not sent and day == created_on.strip() and creator == user.strip().upper()
+            ]
+
+    def zvf04_list(self, orders: list[str]) -> list:
+        """The ZVF04 table: headers in row 1 and one order per odd row from 3."""
+        labels = [(col, 1, title) for col, title in self.zvf04_columns]
+        with self._lock:
+            for row, order in zip(itertools.count(3, 2), orders):
+                creator, day, debitor, _ = self.orders[order]
+                labels += [(col, row, text) for (col, _), text in zip(self.zvf04_columns, (order, debitor, day, creator, ""))]
+        return labels
+
+    def send_orders(self, orders: list[str]) -> None:
+        """Mark orders as sent, as ZVF04 does when saving the marked list."""
+        with self._lock:
+            for order in orders:
+                if not self.orders[order][3]:
+                    self.orders[order][3] = True
+                    self.counts["sent"] += 1
+
+
+def _demo() -> None:
+    """Run the SAP steps of one batch against the fake."""
+    # pylint: disable=import-outside-toplevel
+    import os
+    import tempfile
+
+    import sap_sessions
+    from sap_screen import ScreenSnapshot
+    from sap_messages import parse_zfi_test, parse_zfi_update
+
+    sap = FakeSapGui(latency=FakeLatency(call=0.0005, screen=0.05, per_record=0.01), popups=("Information",))
+    sap_sessions.set_provider(sap)
+    session = sap_sessions.get_session()
+    session.ActiveWindow.FindById("tbar[0]/btn[0]").Press()
+    assert session.ActiveWindow.Text == EASY_ACCESS
+
+    with tempfile.TemporaryDirectory() as folder:
+        invoice_file = os.path.join(folder, "fakturaer.csv")
+        with open(invoice_file, "w", encoding="windows-1252", newline="") as out:
+            csv.writer(out, delimiter=";").writerows([["H", "0012345678"], ["L", "x"], ["H", "0087654321"], ["L", "y"]])
+
+        def upload(test: bool) -> list[str]:
+            session.findById("wnd[0]/tbar[0]/okcd").text = "ZFI_FAKTURAGRUNDLAG"
+            session.findById("wnd[0]").sendVKey(0)
+            session.findById("wnd[0]/usr/ctxtP_PATH").text = invoice_file
+            session.findById("wnd[0]/usr/radP_TEST" if test else "wnd[0]/usr/radP_OPDAT").select()
+            session.findById("wnd[0]/tbar[1]/btn[8]").press()
+            while session.Busy:
+                time.sleep(0.01)
+            labels = ScreenSnapshot.capture(session.findById("wnd[0]/usr")).labels()
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+            return labels
+
+        assert sorted(parse_zfi_test(upload(True)).inactive_debitors) == ["12345678", "87654321"]
+        sap.debitors |= {"12345678", "87654321"}
+        assert parse_zfi_test(upload(True)).ok
+        print("Orders:", parse_zfi_update(upload(False)).order_ids)
+    print(sap.stats())
+
+
+if __name__ == "__main__":
+    _demo()
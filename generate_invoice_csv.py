@@ -3,66 +3,118 @@
 # - No emails
 # - No DB updates
 
+from __future__ import annotations
+
 import os
 import csv
-import locale
+import io
 from datetime import datetime, timedelta
 import re
 import math
 import time
-import pyodbc
+from typing import TYPE_CHECKING
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 
+from invoice_templates import compile_template
+from danish_numbers import format_decimal
+
+if TYPE_CHECKING:
+    import pyodbc
+
 # ---------- Helpers ----------
 
-def format_decimal(value, decimals=None):
+class FakturaTeksterCache:
     """
-    DK formatting. If decimals is None:
-      - ints => no decimals
-      - floats => 2 decimals unless it's an integer-like value
-    If decimals given => force that many.
+    In-process cache of VejmanFakturaTekster keyed by Fakturalinje.
+    The whole table is loaded on first use. Once ttl_seconds have passed, the next lookup
+    asks SQL Server for a checksum of the table and only reloads if it has changed.
+    A lookup for an unknown Fakturalinje also reloads, in case the text was just added.
+    The compiled Toptekst/Forklaring templates are cached alongside the rows.
     """
-    if isinstance(value, int):
-        if decimals is None:
-            return str(locale.format_string("%d", value, grouping=False))
-        else:
-            return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
-    elif isinstance(value, float):
-        if value.is_integer() and decimals is None:
-            return str(locale.format_string("%d", int(value), grouping=False))
-        else:
-            if decimals is None:
-                return str(locale.format_string("%.2f", value, grouping=False))
-            else:
-                return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
-    else:
-        return "" if value is None else str(value)
-    
-    
 
-        
-def generate_invoice_csv(orchestrator_connection: OrchestratorConnection, conn: pyodbc.Connection, cursor: pyodbc.Cursor, row: pyodbc.Row):
-    locale.setlocale(locale.LC_NUMERIC, 'da_DK')
+    def __init__(self, ttl_seconds: float = 300):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._rows = None
+        self._templates = {}
+        self._version = None
+        self._checked_at = 0.0
 
+    def get(self, conn: pyodbc.Connection, cursor: pyodbc.Cursor, fakturalinje: str) -> pyodbc.Row:
+        """The VejmanFakturaTekster row for a Fakturalinje. Raises RuntimeError if the table has none, even after a reload."""
+        if self._rows is None:
+            self._load(conn, cursor)
+        elif time.monotonic() - self._checked_at >= self.ttl_seconds:
+            if self._fetch_version(conn, cursor) != self._version:
+                self._load(conn, cursor)
 
-    tilladelsestype = row.TilladelsesType
-    # Fetch the matching fakturatekster row
+        fakturarow = self._rows.get(fakturalinje)
+        if fakturarow is not None:
+            self.hits += 1
+            return fakturarow
+
+        self.misses += 1
+        self._load(conn, cursor)
+        fakturarow = self._rows.get(fakturalinje)
+        if fakturarow is None:
+            raise RuntimeError(f"Ingen fakturatekst fundet i VejmanFakturaTekster for Fakturalinje '{fakturalinje}'")
+        return fakturarow
+
+    def templates(self, fakturarow: pyodbc.Row):
+        """The compiled (Toptekst, Forklaring) templates for a row returned by get()."""
+        templates = self._templates.get(fakturarow.Fakturalinje)
+        if templates is None:
+            templates = (compile_template(fakturarow.Toptekst), compile_template(fakturarow.Forklaring))
+            self._templates[fakturarow.Fakturalinje] = templates
+        return templates
 
-    conn.commit()
+    def invalidate(self) -> None:
+        """Drop the cached table so the next lookup reloads it."""
+        self._rows = None
+        self._templates = {}
+        self._version = None
 
-    cursor.execute("""
-        SELECT TOP (1) *
-        FROM [dbo].[VejmanFakturaTekster]
-        WHERE Fakturalinje = ?
-    """, (tilladelsestype,))
-    fakturarow = cursor.fetchone()
+    def stats(self) -> dict:
+        """Lookups served from the cache, lookups that reloaded, table loads and cached rows."""
+        return {"hits": self.hits, "misses": self.misses, "loads": self.loads, "rows": len(self._rows or {})}
+
+    def _fetch_version(self, conn: pyodbc.Connection, cursor: pyodbc.Cursor):
+        # Commit first so the check is not served from an open transaction's snapshot
+        conn.commit()
+        cursor.execute("SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)), COUNT(*) FROM [dbo].[VejmanFakturaTekster]")
+        self._checked_at = time.monotonic()
+        return tuple(cursor.fetchone())
+
+    def _load(self, conn: pyodbc.Connection, cursor: pyodbc.Cursor) -> None:
+        version = self._fetch_version(conn, cursor)
+        cursor.execute("SELECT * FROM [dbo].[VejmanFakturaTekster]")
+        rows = {}
+        for fakturarow in cursor.fetchall():
+            rows.setdefault(fakturarow.Fakturalinje, fakturarow)  # first row wins, like TOP (1)
+        self._rows = rows
+        self._templates = {}
+        self._version = version
+        self.loads += 1
+
+
+# One cache per robot run
+TEKSTER_CACHE = FakturaTeksterCache()
+
+
+def build_invoice_rows(conn: pyodbc.Connection, cursor: pyodbc.Cursor, row: pyodbc.Row):
+    """Builds the H (header) and L (line) records for one VejmanFakturering row."""
+
+    tilladelsestype = row.TilladelsesType
+    # Fetch the matching fakturatekster row
+    fakturarow = TEKSTER_CACHE.get(conn, cursor, tilladelsestype)
     Fakturalinje = fakturarow.Fakturalinje
     fordringstype = fakturarow.Fordringstype
     psp_element = fakturarow.PSPElement
     materiale_nr_opus = fakturarow.MaterialeNrOpus
     formatted_material_number = f'{int(materiale_nr_opus):018}'
-    top_text = fakturarow.Toptekst
-    forklaring = fakturarow.Forklaring
+    top_template, forklaring_template = TEKSTER_CACHE.templates(fakturarow)
     SAP_NOTE = (
         "Bemærk: Forfaldsdatoen angiver periodens start og er ikke betalingsfristen. Betalingsfristen fremgår øverst på fakturaen."
     )
@@ -89,30 +141,6 @@ def generate_invoice_csv(orchestrator_connection: OrchestratorConnection, conn:
     AntalDage = int(AntalDage) if AntalDage is not None else None
     
     
-    def format_decimal(value, decimals=None):
-        if isinstance(value, int):
-            if decimals is None:
-                # Format the integer without decimal places
-                return str(locale.format_string("%d", value, grouping=False))
-            else:
-                # Force formatting with the specified number of decimals
-                return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
-        elif isinstance(value, float):
-            # Check if the value is a whole number and decimals is None (e.g., 19.0 should be formatted as 19)
-            if value.is_integer() and decimals is None:
-                return str(locale.format_string("%d", int(value), grouping=False))
-            else:
-                # Format the float with the specified number of decimal places
-                if decimals is None:
-                    return str(locale.format_string("%.2f", value, grouping=False))
-                else:
-                    # Force formatting with the specified number of decimals
-                    return str(locale.format_string(f"%.{decimals}f", value, grouping=False))
-        else:
-            # If it's not a number, return the original value
-            return str(value)
-
-    
     formatted_cvr_number = f'{int(CvrNr):010}'
     
     
@@ -125,11 +153,26 @@ def generate_invoice_csv(orchestrator_connection: OrchestratorConnection, conn:
     opus_price = format_decimal(round(Meter*Enhedspris,2),2)
     unit_price = format_decimal(Enhedspris)
     length = format_decimal(Meter)
-    days_period_formatted = format_decimal(AntalDage,3)
-    total_calculated_price = format_decimal(TotalPris)
-        # Use eval to evaluate them as f-strings
-    top_text_evaluated = eval(top_text)
-    forklaring_evaluated = eval(forklaring)
+    # A missing value has always been shown as "None" in the invoice texts
+    days_period_formatted = format_decimal(AntalDage, 3, none="None")
+    total_calculated_price = format_decimal(TotalPris, none="None")
+
+    # Render the precompiled Toptekst/Forklaring templates with the variables eval() used to see
+    template_variables = {
+        "row": row, "fakturarow": fakturarow, "top_text": fakturarow.Toptekst, "forklaring": fakturarow.Forklaring,
+        "SAP_NOTE": SAP_NOTE, "materiale_nr_opus": materiale_nr_opus, "Startdato": Startdato, "Slutdato": Slutdato,
+        "Fakturalinje": Fakturalinje, "tilladelsestype": tilladelsestype, "fordringstype": fordringstype,
+        "psp_element": psp_element, "ID": ID, "VejmanID": VejmanID, "FørsteSted": FørsteSted,
+        "Tilladelsesnr": Tilladelsesnr, "Ansøger": Ansøger, "CvrNr": CvrNr, "kunde_ref_id": kunde_ref_id,
+        "Enhedspris": Enhedspris, "Meter": Meter, "AntalDage": AntalDage, "TotalPris": TotalPris,
+        "formatted_cvr_number": formatted_cvr_number, "formatted_material_number": formatted_material_number,
+        "today": today, "future_date": future_date,
+        "short_start_date": short_start_date, "short_end_date": short_end_date,
+        "opus_price": opus_price, "unit_price": unit_price, "length": length,
+        "days_period_formatted": days_period_formatted, "total_calculated_price": total_calculated_price,
+    }
+    top_text_evaluated = top_template.render(template_variables)
+    forklaring_evaluated = forklaring_template.render(template_variables)
 
     
     # Prepare rows for writing
@@ -145,15 +188,43 @@ def generate_invoice_csv(orchestrator_connection: OrchestratorConnection, conn:
         '', SAP_NOTE, forklaring_evaluated,
         '', '', '', '', '', '', '', '', '','', '', '', '', '', '', '', '', '', '', '', '', '', ''
     ]
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")[:-3]  # milliseconds
-    csvname = f"{timestamp}_Fakturaer_{ID}.csv"
+    return row_H, row_L
 
-    full_path = os.path.abspath(csvname)  # get absolute path in current working dir
-    
-    # Write to the CSV
-    with open(full_path, mode='a', newline='', encoding='windows-1252') as file:
-        writer = csv.writer(file, delimiter=';')
-        writer.writerow(row_H)
-        writer.writerow(row_L)
+
+def write_invoice_csv(records, csvname, folder=None):
+    """
+    Writes H/L records to a new CSV file in folder (default: the current working directory)
+    and returns its absolute path. The records are formatted in memory and written in one call.
+    """
+    full_path = os.path.abspath(os.path.join(folder or os.getcwd(), csvname))
+
+    buffer = io.StringIO(newline='')
+    csv.writer(buffer, delimiter=';').writerows(records)
+    with open(full_path, mode='w', newline='', encoding='windows-1252') as file:
+        file.write(buffer.getvalue())
     return full_path
 
+
+def generate_invoice_csv(orchestrator_connection: OrchestratorConnection, conn: pyodbc.Connection, cursor: pyodbc.Cursor, row: pyodbc.Row, folder=None):
+    row_H, row_L = build_invoice_rows(conn, cursor, row)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")[:-3]  # milliseconds
+    csvname = f"{timestamp}_Fakturaer_{row.ID}.csv"
+    return write_invoice_csv([row_H, row_L], csvname, folder)
+
+
+def generate_batch_invoice_csv(orchestrator_connection: OrchestratorConnection, conn: pyodbc.Connection, cursor: pyodbc.Cursor, rows: list[pyodbc.Row], folder=None):
+    """
+    Writes one multi-record CSV with an H/L pair per row, in the order given.
+    SAP reports the saved orders in file order, which is what lets the caller
+    map each order number back to its row.
+    """
+    if len(rows) == 1:
+        return generate_invoice_csv(orchestrator_connection, conn, cursor, rows[0], folder)
+
+    records = []
+    for row in rows:
+        records.extend(build_invoice_rows(conn, cursor, row))
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")[:-3]  # milliseconds
+    csvname = f"{timestamp}_Fakturaer_{rows[0].ID}_batch_{len(rows)}.csv"
+    orchestrator_connection.log_info(f"Samlet fakturafil med {len(rows)} fakturaer: {csvname}")
+    return write_invoice_csv(records, csvname, folder)
@@ -10,7 +10,13 @@ import string
 import time
 import psutil
 import os
-import win32com.client
+import json
+import shutil
+import subprocess
+
+from sap_sessions import get_application, return_to_start, scripting_errors
+from spans import span
+from sap_wait import wait_ready
 
 
 def download_sap(driver: webdriver.Chrome, downloads_folder, orchestrator_connection, parent_tab): 
@@ -35,7 +41,84 @@ def download_sap(driver: webdriver.Chrome, downloads_folder, orchestrator_connec
 
     
     
-def initialize_sap(orchestrator_connection: OrchestratorConnection):
+class ShortcutCache:
+    """
+    Keeps the last .sap logon shortcut downloaded from the Opus portal, so later logins can open it
+    directly instead of going through Chrome. The shortcut is trusted for validity_seconds after download.
+    """
+
+    def __init__(self, folder: str, validity_seconds: float):
+        self.folder = folder
+        self.validity_seconds = validity_seconds
+        self.meta_path = os.path.join(folder, "shortcut.json")
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def valid_path(self):
+        """The cached shortcut, or None if there is none or it has expired."""
+        meta = self._read_meta()
+        if time.time() - meta.get("downloaded_at", 0) > self.validity_seconds or not os.path.exists(meta.get("path", "")):
+            return None
+        return meta["path"]
+
+    def store(self, downloaded_path: str) -> str:
+        """Move a freshly downloaded shortcut into the cache and return its new path."""
+        os.makedirs(self.folder, exist_ok=True)
+        self.invalidate()
+        cached_path = os.path.join(os.path.abspath(self.folder), os.path.basename(downloaded_path))
+        shutil.move(downloaded_path, cached_path)
+        with open(self.meta_path, "w", encoding="utf-8") as file:
+            json.dump({"path": cached_path, "downloaded_at": time.time()}, file)
+        return cached_path
+
+    def invalidate(self) -> None:
+        """Forget the cached shortcut, e.g. when SAP has rejected it."""
+        path = self._read_meta().get("path")
+        for file_path in (path, self.meta_path):
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+
+
+@span("initialize_sap.login")
+def initialize_sap(orchestrator_connection: OrchestratorConnection, shortcut_cache: ShortcutCache | None = None):
+    """
+    Logs in to SAP. A cached logon shortcut is tried first. If there is none or SAP rejects it,
+    a new shortcut is downloaded from the Opus portal with Chrome.
+    """
+    if shortcut_cache:
+        cached_path = shortcut_cache.valid_path()
+        if cached_path:
+            orchestrator_connection.log_info("Opening cached SAP shortcut")
+            # A shortcut SAP rejects fails to open (OSError), never reaches Easy Access (TimeoutError)
+            # or leaves the scripting engine unusable; anything else is a real error and propagates
+            try:
+                if launch_sap(cached_path):
+                    return True
+            except (OSError, psutil.Error, *scripting_errors()) as e:
+                orchestrator_connection.log_info(f"Cached SAP shortcut was rejected: {e!r}")
+            shortcut_cache.invalidate()
+            kill_sap()
+
+    filepath = download_shortcut(orchestrator_connection)
+    if shortcut_cache:
+        filepath = shortcut_cache.store(filepath)
+    return launch_sap(filepath)
+
+
+def kill_sap():
+    """Close SAP Logon after a failed login, so the next attempt starts clean."""
+    subprocess.call("taskkill /F /IM saplogon.exe /T", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True)
+    subprocess.call("taskkill /F /IM sapgui.exe /T", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True)
+
+
+@span("initialize_sap.download_shortcut")
+def download_shortcut(orchestrator_connection: OrchestratorConnection):
+    """Logs in to the Opus portal with Chrome, changing the password if required, and downloads a .sap shortcut."""
     # Opus bruger
     OpusLogin = orchestrator_connection.get_credential("OpusBruger")
     OpusUser = OpusLogin.username
@@ -118,7 +201,12 @@ def initialize_sap(orchestrator_connection: OrchestratorConnection):
         
     filepath = download_sap(driver, downloads_folder, orchestrator_connection, parent_tab)
     driver.quit()
-    
+    return filepath
+
+
+@span("initialize_sap.launch")
+def launch_sap(filepath):
+    """Opens a .sap shortcut and waits for SAP Easy Access. Raises TimeoutError if SAP doesn't get there."""
     success = False
     timeout = 30
     start_time = time.time()
@@ -137,6 +225,36 @@ def initialize_sap(orchestrator_connection: OrchestratorConnection):
     dismiss_until_easy_access(30)
     return success
 
+@span("initialize_sap.probe")
+def probe_sap_session(expected_user: str, timeout=10):
+    """
+    Checks whether SAP GUI already has a usable session, so a reset can skip the full relogin.
+    The session must answer over the scripting engine, be logged in as expected_user and have no
+    popup open. It is then sent back to SAP Easy Access with /n. The other sessions of the
+    connection are reset by SessionPool.open().
+    Returns the session, or None if it isn't healthy.
+    """
+    try:
+        application = get_application()
+        if application.Children.Count == 0:
+            return None
+        connection = application.Children(0)
+        if connection.Children.Count == 0:
+            return None
+        session = connection.Children(0)
+
+        if session.Info.User.strip().upper() != expected_user.strip().upper():
+            return None
+        if not return_to_start(session, timeout):
+            return None
+        if not session.ActiveWindow.Text.strip().startswith("SAP Easy Access"):
+            return None
+        return session
+    except scripting_errors():
+        return None
+
+
+@span("initialize_sap.dismiss_popups")
 def dismiss_until_easy_access(timeout=30):
     start_time = time.time()
 
@@ -144,8 +262,7 @@ def dismiss_until_easy_access(timeout=30):
     session = None
     while time.time() - start_time < timeout:
         try:
-            sap_gui_auto = win32com.client.GetObject("SAPGUI")
-            application = sap_gui_auto.GetScriptingEngine
+            application = get_application()
 
             if application.Children.Count > 0:
                 connection = application.Children(0)
@@ -175,6 +292,7 @@ def dismiss_until_easy_access(timeout=30):
                 try:
                     btn = active_window.FindById("tbar[0]/btn[0]")
                     btn.Press()
+                    wait_ready(session, timeout=max(0.0, timeout - (time.time() - start_time)), step="SAP login dialog")
                     print(f"Dismissed window '{window_title}' using btn[0]")
                 except Exception as e:
                     print(f"Could not dismiss '{window_title}': {e}")
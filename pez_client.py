@@ -2,29 +2,91 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from typing import Optional
+import json
+import os
+import threading
+import time
 import requests
 from datetime import datetime
 
+from danish_numbers import format_amount
+import spans
+
 
 @dataclass
 class PEZConfig:
     base_url: str = "https://pez.giantleap.net"
     x_bpid: str = "bp_aarhus"
     x_locale: str = "da"
+    # Log in again this many seconds before the token expires
+    refresh_margin: float = 60.0
+
+
+class TokenStore:
+    """
+    Holds the access token and when it expires (from the OAuth expires_in).
+    - With a path the token is kept in a JSON file, so the next run can skip the login.
+    - Without a path it only lives as long as the instance.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.access_token: Optional[str] = None
+        self.expires_at: Optional[float] = None  # epoch seconds, None if the server didn't say
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as file:
+                    data = json.load(file)
+                self.access_token = data.get("access_token")
+                self.expires_at = data.get("expires_at")
+            except (OSError, ValueError):
+                self.clear()
+
+    def valid(self, margin: float = 0.0) -> bool:
+        """Whether there is a token that is good for at least margin seconds more."""
+        if not self.access_token:
+            return False
+        return self.expires_at is None or time.time() + margin < self.expires_at
+
+    def set(self, access_token: str, expires_in: Optional[float]) -> None:
+        """Keep a new token that expires in expires_in seconds (never, if the server didn't say)."""
+        self.access_token = access_token
+        self.expires_at = time.time() + float(expires_in) if expires_in else None
+        self._save()
+
+    def clear(self) -> None:
+        """Forget the token, e.g. after the server rejected it."""
+        self.access_token = None
+        self.expires_at = None
+        self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"access_token": self.access_token, "expires_at": self.expires_at}, file)
+        os.replace(tmp_path, self.path)
 
 
 class PEZClient:
     """
-    Stateful PEZ client:
+    Stateful PEZ client, meant to be shared by the whole robot run:
     - Holds one requests.Session() for the lifetime of the instance (cookies, keep-alive, headers).
-    - Logs in once and caches the access token.
-    - Each call uses per-request headers like your old code, but session-level defaults still apply.
+    - Keeps the access token in a TokenStore and logs in again just before it expires.
+    - A 401 response causes one new login and one retry.
+    - Safe to use from several threads; only one of them logs in at a time.
+    - Counts logins; every comment request is timed into the spans histogram pez.http.comment.
     """
 
-    def __init__(self, username: str, password: str, config: Optional[PEZConfig] = None) -> None:
+    def __init__(self, username: str, password: str, config: Optional[PEZConfig] = None,
+                 token_store: Optional[TokenStore] = None) -> None:
         self.username = username
         self.password = password
         self.config = config or PEZConfig()
+        self.token_store = token_store or TokenStore()
+        self.login_count = 0
+        self._login_lock = threading.Lock()
 
         self.session = requests.Session()
         # Browser-like defaults (same idea as your old code)
@@ -40,19 +102,18 @@ class PEZClient:
             ),
         })
 
-        self._access_token: Optional[str] = None
-
     # ---------- Internal helpers ----------
 
     def _url(self, path: str) -> str:
         return f"{self.config.base_url}{path}"
 
     def _auth_headers(self) -> dict:
-        if not self._access_token:
+        token = self.token_store.access_token
+        if not token:
             raise RuntimeError("PEZ client is not authenticated. Call login() first.")
         return {
             "accept": "application/json, text/plain, */*",
-            "authorization": f"Bearer {self._access_token}",
+            "authorization": f"Bearer {token}",
             "x-bpid": self.config.x_bpid,
             "x-gltlocale": self.config.x_locale,
         }
@@ -62,8 +123,9 @@ class PEZClient:
     def login(self) -> str:
         """
         Mimics your login flow and stores token + cookies in the session.
-        Call once per robot run (or lazy-call from other methods).
+        Called lazily by ensure_login(); the token and its expiry go to the token store.
         """
+        self.login_count += 1
         # 1) Load login page
         r = self.session.get(
             self._url("/login"),
@@ -110,32 +172,50 @@ class PEZClient:
         token = data.get("access_token")
         if not token:
             raise RuntimeError("PEZ login succeeded but access_token missing in response.")
-        self._access_token = token
+        self.token_store.set(token, data.get("expires_in"))
         return token
 
-    def ensure_login(self) -> None:
-        """Lazy-login helper."""
-        if not self._access_token:
-            self.login()
+    def ensure_login(self, rejected_token: Optional[str] = None) -> None:
+        """
+        Lazy-login helper. Logs in if there is no token, it is about to expire,
+        or it is the token PEZ just rejected (unless another thread has replaced it meanwhile).
+        """
+        with self._login_lock:
+            token = self.token_store.access_token
+            if (rejected_token and token == rejected_token) or not self.token_store.valid(self.config.refresh_margin):
+                self.login()
 
     def add_internal_comment(self, case_uuid: str, comment: str) -> None:
         """
         Adds a single internal comment to a case.
         Uses same session (cookies) and same token (Authorization) every time.
+        If PEZ answers 401 the client logs in again and retries once.
         """
-        self.ensure_login()
-
         url = self._url(f"/rest/tickets/cases/{case_uuid}/comments")
         payload = {"comment": comment, "isInternal": True}
 
-        headers = {
-            **self._auth_headers(),
-            "content-type": "application/json;charset=UTF-8",
-            "priority": "u=1, i",
-        }
+        self.ensure_login()
+        for attempt in range(2):
+            headers = {
+                **self._auth_headers(),
+                "content-type": "application/json;charset=UTF-8",
+                "priority": "u=1, i",
+            }
+            with spans.span("pez.http.comment"):
+                r = self.session.post(url, headers=headers, json=payload, timeout=30)
+            if r.status_code == 401 and attempt == 0:
+                self.ensure_login(rejected_token=headers["authorization"].removeprefix("Bearer "))
+                continue
+            r.raise_for_status()
+            return
 
-        r = self.session.post(url, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
+    def stats(self) -> dict:
+        """Number of logins. Comment counts and latencies are in the pez.http.comment span."""
+        return {"logins": self.login_count}
+
+    def close(self) -> None:
+        """Close the session's pooled connections."""
+        self.session.close()
 
 
     @staticmethod
@@ -153,8 +233,7 @@ class PEZClient:
         price_txt = "ukendt pris"
         if totalpris is not None:
             try:
-                p = float(str(totalpris).replace(",", "."))
-                price_txt = f"{p:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+                price_txt = format_amount(totalpris)
             except Exception:
                 price_txt = str(totalpris)
 
@@ -10,6 +10,17 @@ FAIL_ROBOT_ON_TOO_MANY_ERRORS = True
 SMTP_SERVER = "smtp.adm.aarhuskommune.dk"
 SMTP_PORT = 25
 SCREENSHOT_SENDER = "vejmankassen@aarhus.dk"
+SMTP_STARTTLS = True
+# Screenshots are scaled down to this width and sent as JPEG
+SCREENSHOT_MAX_WIDTH = 1280
+SCREENSHOT_JPEG_QUALITY = 70
+# Only the first occurrence of an error is mailed with a screenshot. Repeats are mailed
+# together in a digest this often, and when the run ends.
+ERROR_DIGEST_INTERVAL_SECONDS = 15 * 60
+
+# SAP logon shortcut cache. A downloaded .sap shortcut is reused until it is this old or SAP rejects it.
+SAP_SHORTCUT_CACHE_FOLDER = "sap_shortcut_cache"
+SAP_SHORTCUT_VALIDITY_SECONDS = 6 * 60 * 60
 
 # Constant/Credential names
 ERROR_EMAIL = "Error Email"
@@ -24,4 +35,50 @@ QUEUE_NAME = "VejmanKassenSAP"
 # The limit on how many queue elements to process
 MAX_TASK_COUNT = 1000
 
+# How many queue elements to invoice together in one ZFI_FAKTURAGRUNDLAG upload.
+# 1 processes each queue element on its own.
+BATCH_SIZE = 1
+
+# How many SAP sessions to work on at once, each with its own batch (at most 6).
+# 1 keeps all SAP work on the first session.
+SAP_SESSION_COUNT = 1
+
+# How many queue elements to pull and fetch SQL rows for ahead of processing,
+# and how old a prefetched row may be before it is checked again.
+PREFETCH_LOOKAHEAD = 10
+PREFETCH_MAX_AGE_SECONDS = 60
+
+# How many prepared batches (invoice files written) and finished batches may wait between
+# the pipeline stages. The prepare stage works ahead of SAP by at most this many batches.
+PIPELINE_QUEUE_SIZE = 2
+
+# How long created invoices may wait before they are sent in one ZVF04 pass.
+# 0 sends once after every batch.
+SEND_INTERVAL_SECONDS = 0
+
+# Local file with the debitors known to exist in SAP, kept between runs
+KNOWN_DEBITORS_FILE = "known_debitors.json"
+
+# Folder for the invoice and debitor files. Each run works in its own subfolder, which is removed
+# when the run ends; folders left by crashed runs are cleaned up by the next run.
+# With KEEP_FAILED_FILES the files of failed steps are kept in <folder>/failed for replay.
+WORKSPACE_FOLDER = "workspace"
+KEEP_FAILED_FILES = False
+
+# Local SQLite outbox for the Vejman/PEZ notifications sent after an invoice.
+# Unsent notifications survive a crash and are sent by the next run.
+OUTBOX_FILE = "notification_outbox.sqlite3"
+OUTBOX_CONCURRENCY = 2
+OUTBOX_MAX_ATTEMPTS = 5
+# How long the robot waits for the outbox to empty before it shuts down
+OUTBOX_DRAIN_SECONDS = 120
+
+# Local file to keep the PEZ access token in between runs, so a run can skip the login
+# while the token is still valid. None keeps the token in memory only.
+PEZ_TOKEN_FILE = None
+
+# Folder for the performance report of each run: <run>.json with the timing spans of the run,
+# and spans.csv with one row per span and run for comparing runs. None only logs the report.
+PERFORMANCE_REPORT_FOLDER = "performance_reports"
+
 # ----------------------
@@ -0,0 +1,80 @@
+"""This module keeps track of the debitors (CVR/CPR numbers) that are known to exist in SAP."""
+
+import json
+import os
+
+
+class DebitorStore:
+    """A persistent set of debitor numbers the robot has created or seen SAP accept.
+
+    The set is seeded from VejmanFakturering at startup, since every row that has been
+    invoiced proves its debitor exists, and saved to a local JSON file between runs.
+    Lookups are counted so the hit rate can be reported per run.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        # Debitors the robot has tried to create up front this run, successfully or not
+        self.attempted: set[str] = set()
+        self._known: set[str] = set()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self._known.update(json.load(file))
+
+    def seed_from_sql(self, cursor) -> None:
+        """Add the debitor of every row that has already been invoiced."""
+        cursor.execute("""
+            SELECT DISTINCT CvrNr
+            FROM [VejmanKassen].[dbo].[VejmanFakturering]
+            WHERE FakturaStatus = 'Faktureret' AND CvrNr IS NOT NULL
+        """)
+        for (cvr,) in cursor.fetchall():
+            try:
+                self._known.add(normalize_debitor(cvr))
+            except ValueError:
+                continue
+
+    def unknown(self, debitors, count: bool = True) -> list[str]:
+        """Return the debitors that are not known to exist, counting hits and misses unless count is False."""
+        missing = [debitor for debitor in debitors if debitor not in self._known]
+        if count:
+            self.misses += len(missing)
+            self.hits += len(debitors) - len(missing)
+        return missing
+
+    def add(self, debitors, created: bool = False) -> None:
+        """Remember debitors that were created or accepted by SAP."""
+        new = set(debitors) - self._known
+        if not new:
+            return
+        self._known.update(new)
+        if created:
+            self.created += len(new)
+        self.save()
+
+    def save(self) -> None:
+        """Write the set to disk, if the store has a path."""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(sorted(self._known), file)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> dict:
+        """Counters for the run."""
+        lookups = self.hits + self.misses
+        return {
+            "known": len(self._known), "hits": self.hits, "misses": self.misses, "created": self.created,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+def normalize_debitor(cvr) -> str:
+    """Normalize a CvrNr to the debitor number SAP reports and ZFIE_OPRETDEB expects.
+    The number is padded to 10 digits like in the invoice file, and a leading '00' is dropped again."""
+    padded = f"{int(cvr):010}"
+    return padded[2:] if padded.startswith("00") else padded
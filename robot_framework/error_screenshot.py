@@ -1,53 +1,269 @@
-"""This module has functionality to send error screenshots via smtp."""
+"""This module has functionality to send error screenshots via smtp.
 
-import smtplib
+The first time an error is seen it is mailed with a screenshot, scaled down and sent as JPEG.
+Errors are told apart by a fingerprint of the exception type, its message with numbers ignored
+and the code locations in its trace, so the same failure on the next queue element is a repeat.
+Repeats are only counted, and mailed together as a digest every ERROR_DIGEST_INTERVAL_SECONDS
+and when the run ends. The mails are sent by a background thread over one SMTP connection,
+so the error path only pays for taking the screenshot.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
 from email.message import EmailMessage
-import base64
-import traceback
+from html import escape
 from io import BytesIO
+import hashlib
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+import traceback
 
-from PIL import ImageGrab
+from PIL import Image, ImageGrab
 
 from robot_framework import config
 
+# Parts of an error message that differ between queue elements: numbers and UUIDs
+_VARIABLE_PARTS = re.compile(r"[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}|\d+")
+_DIGEST = object()
+_STOP = object()
+
+
+def fingerprint(exception: BaseException) -> str:
+    """Identify an error by its type, its message with numbers ignored and the code locations in its trace."""
+    parts = [type(exception).__qualname__, _VARIABLE_PARTS.sub("#", str(exception))]
+    parts += [f"{os.path.basename(frame.filename)}:{frame.name}:{frame.lineno}"
+              for frame in traceback.extract_tb(exception.__traceback__)]
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def encode_screenshot(screenshot: Image.Image) -> bytes:
+    """Scale a screenshot down to SCREENSHOT_MAX_WIDTH and encode it as JPEG."""
+    if screenshot.width > config.SCREENSHOT_MAX_WIDTH:
+        screenshot = screenshot.copy()
+        screenshot.thumbnail((config.SCREENSHOT_MAX_WIDTH, screenshot.height))
+    buffer = BytesIO()
+    screenshot.convert("RGB").save(buffer, format="JPEG", quality=config.SCREENSHOT_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+@dataclass
+class ErrorRecord:
+    """An error seen by the reporter. pending counts the repeats not yet mailed in a digest."""
+    fingerprint: str
+    to_address: str | list[str]
+    process_name: str
+    error_type: str
+    message: str
+    first_seen: datetime
+    last_seen: datetime
+    count: int = 1
+    pending: int = 0
+
+
+class ErrorReporter:
+    """Mails error reports in a background thread: a screenshot mail for the first occurrence
+    of an error and periodic digests of the repeats."""
+
+    def __init__(self):
+        self._errors: dict[str, ErrorRecord] = {}
+        self._lock = threading.Lock()
+        self._outgoing: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._smtp: smtplib.SMTP | None = None
+        self.counts = {"errors": 0, "repeats": 0, "screenshot_mails": 0, "digest_mails": 0, "failed_mails": 0,
+                       "smtp_connections": 0, "screenshot_bytes": 0}
+        self.last_failure: str | None = None
+
+    def report(self, to_address: str | list[str], exception: Exception, process_name: str) -> bool:
+        """Report an error. Returns True if it is mailed with a screenshot, False if it is a repeat
+        that goes into the next digest."""
+        key = fingerprint(exception)
+        now = datetime.now()
+        with self._lock:
+            outgoing = self._start()
+            record = self._errors.get(key)
+            if record is not None:
+                record.count += 1
+                record.pending += 1
+                record.last_seen = now
+                self.counts["repeats"] += 1
+                return False
+            self._errors[key] = record = ErrorRecord(key, to_address, process_name, type(exception).__name__,
+                                                     str(exception), now, now)
+            self.counts["errors"] += 1
+
+        # The screen is grabbed now, while it still shows the error; scaling and encoding happen in the background
+        try:
+            screenshot = ImageGrab.grab()
+        except OSError as exc:
+            screenshot = f"Screenshot could not be taken: {exc}"
+        trace = "".join(traceback.format_exception(exception))
+        outgoing.put((record, trace, screenshot))
+        return True
+
+    def close(self, timeout: float = 30) -> dict:
+        """Mail the last digest, wait up to timeout seconds for the mails to be sent and close the
+        SMTP connection. The reporter starts over on the next report. Returns the counts."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            outgoing = self._outgoing
+        if thread is not None:
+            outgoing.put(_STOP)
+            thread.join(timeout)
+        with self._lock:
+            self._errors.clear()
+            return self.stats()
 
-def send_error_screenshot(to_address: str | list[str], exception: Exception, process_name: str):
+    def stats(self) -> dict:
+        """The counters of mails and errors, and the last delivery failure."""
+        return dict(self.counts, last_failure=self.last_failure)
+
+    def _start(self) -> queue.Queue:
+        """Start the sender thread, with a queue of its own, if it isn't running, and return its queue.
+        Called with the lock held."""
+        if self._thread is None:
+            self._outgoing = queue.Queue()
+            self._thread = threading.Thread(target=self._run, args=(self._outgoing, config.ERROR_DIGEST_INTERVAL_SECONDS),
+                                            name="error-reports", daemon=True)
+            self._thread.start()
+        return self._outgoing
+
+    def _run(self, outgoing: queue.Queue, digest_interval: float) -> None:
+        next_digest = time.monotonic() + digest_interval
+        while True:
+            try:
+                item = outgoing.get(timeout=max(0.0, next_digest - time.monotonic()))
+            except queue.Empty:
+                item = _DIGEST
+            if item is _DIGEST or item is _STOP:
+                for message in self._digest_messages():
+                    self._deliver(message, "digest_mails")
+                next_digest = time.monotonic() + digest_interval
+                if item is _STOP:
+                    self._disconnect()
+                    return
+            else:
+                self._deliver(self._screenshot_message(*item), "screenshot_mails")
+
+    def _screenshot_message(self, record: ErrorRecord, trace: str, screenshot: Image.Image | str) -> EmailMessage:
+        msg = EmailMessage()
+        msg['to'] = record.to_address
+        msg['from'] = config.SCREENSHOT_SENDER
+        msg['subject'] = f"Error screenshot: {record.process_name}"
+
+        if isinstance(screenshot, str):
+            image_html = f"<p>{escape(screenshot)}</p>"
+        else:
+            image_html = '<img src="cid:screenshot" alt="Screenshot">'
+        html_message = f"""
+        <html>
+            <body>
+                <p>Error type: {escape(record.error_type)}</p>
+                <p>Error message: {escape(record.message)}</p>
+                <pre>{escape(trace)}</pre>
+                <p>Repeats of this error (fingerprint {record.fingerprint}) are sent in a digest.</p>
+                {image_html}
+            </body>
+        </html>
+        """
+        msg.set_content("Please enable HTML to view this message.")
+        msg.add_alternative(html_message, subtype='html')
+        if not isinstance(screenshot, str):
+            image = encode_screenshot(screenshot)
+            self.counts["screenshot_bytes"] += len(image)
+            msg.get_payload()[1].add_related(image, maintype="image", subtype="jpeg", cid="<screenshot>")
+        return msg
+
+    def _digest_messages(self) -> list[EmailMessage]:
+        """One digest mail per recipient and process, with the repeats since the last digest."""
+        groups: dict[tuple, list[ErrorRecord]] = {}
+        with self._lock:
+            for record in self._errors.values():
+                if record.pending:
+                    recipients = tuple(record.to_address) if isinstance(record.to_address, list) else record.to_address
+                    groups.setdefault((recipients, record.process_name), []).append(
+                        ErrorRecord(**vars(record)))
+                    record.pending = 0
+
+        messages = []
+        for (to_address, process_name), records in groups.items():
+            rows = "".join(
+                f"<tr><td>{record.pending}</td><td>{record.count}</td><td>{escape(record.error_type)}</td>"
+                f"<td>{escape(record.message)}</td><td>{record.first_seen:%H:%M:%S}</td>"
+                f"<td>{record.last_seen:%H:%M:%S}</td><td>{record.fingerprint}</td></tr>"
+                for record in records
+            )
+            msg = EmailMessage()
+            msg['to'] = list(to_address) if isinstance(to_address, tuple) else to_address
+            msg['from'] = config.SCREENSHOT_SENDER
+            msg['subject'] = f"Error digest: {process_name} ({sum(record.pending for record in records)} repeated errors)"
+            html_message = f"""
+            <html>
+                <body>
+                    <p>These errors were seen again since the last report. The first occurrence of each was sent with a screenshot.</p>
+                    <table border="1">
+                        <tr><th>Repeats</th><th>Total</th><th>Error type</th><th>First error message</th>
+                            <th>First seen</th><th>Last seen</th><th>Fingerprint</th></tr>
+                        {rows}
+                    </table>
+                </body>
+            </html>
+            """
+            msg.set_content("Please enable HTML to view this message.")
+            msg.add_alternative(html_message, subtype='html')
+            messages.append(msg)
+        return messages
+
+    def _deliver(self, msg: EmailMessage, counter: str) -> None:
+        """Send over the open SMTP connection. If the server has dropped it, reconnect and try once more."""
+        for attempt in range(2):
+            try:
+                if self._smtp is None:
+                    self._connect()
+                self._smtp.send_message(msg)
+                self.counts[counter] += 1
+                return
+            except (smtplib.SMTPException, OSError) as exc:
+                self._disconnect()
+                if attempt:
+                    self.counts["failed_mails"] += 1
+                    self.last_failure = repr(exc)
+
+    def _connect(self) -> None:
+        smtp = smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT, timeout=30)
+        if config.SMTP_STARTTLS:
+            smtp.starttls()
+        self._smtp = smtp
+        self.counts["smtp_connections"] += 1
+
+    def _disconnect(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+
+REPORTER = ErrorReporter()
+
+
+def send_error_screenshot(to_address: str | list[str], exception: Exception, process_name: str) -> bool:
     """Sends an email with an error report, including a screenshot, when an exception occurs.
+    Repeats of an error already reported are collected into a digest instead. The mail is sent
+    in the background; REPORTER.close() at the end of the run waits for it.
     Configuration details such as SMTP server, port, sender email, etc., should be set in 'config' module.
 
     Args:
         to_address: Email address or list of addresses to send the error report.
         exception: The exception that triggered the error.
         process_name: Name of the process from OpenOrchestrator.
-    """
-    # Create message
-    msg = EmailMessage()
-    msg['to'] = to_address
-    msg['from'] = config.SCREENSHOT_SENDER
-    msg['subject'] = f"Error screenshot: {process_name}"
-
-    # Take screenshot and convert to base64
-    screenshot = ImageGrab.grab()
-    buffer = BytesIO()
-    screenshot.save(buffer, format='PNG')
-    screenshot_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-    # Create an HTML message with the exception and screenshot
-    html_message = f"""
-    <html>
-        <body>
-            <p>Error type: {type(exception).__name__}</p>
-            <p>Error message: {exception}</p>
-            <p>{traceback.format_exc()}</p>
-            <img src="data:image/png;base64,{screenshot_base64}" alt="Screenshot">
-        </body>
-    </html>
-    """
 
-    msg.set_content("Please enable HTML to view this message.")
-    msg.add_alternative(html_message, subtype='html')
-
-    # Send message
-    with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as smtp:
-        smtp.starttls()
-        smtp.send_message(msg)
+    Returns:
+        True if the error is mailed with a screenshot, False if it is a repeat.
+    """
+    return REPORTER.report(to_address, exception, process_name)
@@ -13,24 +13,26 @@ class BusinessError(Exception):
     """An empty exception used to identify errors caused by breaking business rules"""
 
 
-def handle_error(message: str, error: Exception, queue_element: QueueElement | None, orchestrator_connection: OrchestratorConnection) -> None:
+def handle_error(message: str, error: Exception, queue_element: QueueElement | list[QueueElement] | None, orchestrator_connection: OrchestratorConnection) -> None:
     """Handles an error caught during the process.
     Logs an error to OpenOrchestrator.
-    Marks the queue element (if any) as failed.
-    Sends an error screenshot by email.
+    Marks the queue element(s) (if any) as failed.
+    Sends an error screenshot by email, or counts the error for the next digest if it is a repeat.
 
     Args:
         message: A message to prepend to the error message.
         error: The exception that should be handled.
-        queue_element: The queue element to fail, if any.
+        queue_element: The queue element or batch of queue elements to fail, if any.
         orchestrator_connection: A connection to OpenOrchestrator.
     """
     error_msg = f"{message}: {repr(error)}\n\nTrace:\n{traceback.format_exc()}"
     error_email = orchestrator_connection.get_constant(config.ERROR_EMAIL).value
 
     orchestrator_connection.log_error(error_msg)
-    if queue_element:
-        orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.FAILED, error_msg)
+    queue_elements = queue_element if isinstance(queue_element, list) else [queue_element]
+    for element in queue_elements:
+        if element:
+            orchestrator_connection.set_queue_element_status(element.id, QueueStatus.FAILED, error_msg)
     error_screenshot.send_error_screenshot(error_email, error, orchestrator_connection.process_name)
 
 
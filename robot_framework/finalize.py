@@ -0,0 +1,96 @@
+"""This module buffers the FakturaStatus/Ordrenummer write-back and flushes it in one transaction."""
+
+from robot_framework.sql_connection import ConnectionManager
+from spans import span
+
+
+FINALIZE_SQL = """
+    UPDATE [VejmanKassen].[dbo].[VejmanFakturering]
+    SET FakturaStatus = 'Faktureret',
+        FakturaDato        = CAST(GETDATE() AS date),
+        Ordrenummer        = ?
+    WHERE ID = ? AND FakturaStatus = 'TilFakturering'
+"""
+
+# Looks up what a flush left behind when the UPDATE touched fewer rows than it was given
+WRITTEN_SQL = """
+    SELECT ID, Ordrenummer
+    FROM [VejmanKassen].[dbo].[VejmanFakturering]
+    WHERE FakturaStatus = 'Faktureret' AND ID IN ({})
+"""
+# Stay well below SQL Server's 2100 parameters per statement
+ID_CHUNK_SIZE = 1000
+
+
+class FinalizeWriter:
+    """Collects (ID, Ordrenummer) pairs for invoices SAP has saved and writes them with one executemany.
+
+    The writer must be flushed before the invoices are sent, before a reset and on shutdown,
+    so a row is never left as TilFakturering once its order exists in SAP.
+    A row that is no longer TilFakturering is not updated. The flush still commits the others,
+    and the skipped pairs are kept for pop_not_updated, so the caller can fail or log them.
+    """
+
+    def __init__(self, connection_manager: ConnectionManager, sql: str = FINALIZE_SQL):
+        self.connection_manager = connection_manager
+        self.sql = sql
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_not_updated = 0
+        self._pending: list[tuple[str, object]] = []  # (Ordrenummer, ID) in parameter order
+        self._not_updated: list[tuple[str, object]] = []
+
+    def add(self, sql_id, ordernumber: str) -> None:
+        """Buffer a finished row."""
+        self._pending.append((ordernumber, sql_id))
+
+    def pending(self) -> list[tuple[str, object]]:
+        """The buffered (Ordrenummer, ID) pairs."""
+        return list(self._pending)
+
+    def pop_not_updated(self) -> list[tuple[str, object]]:
+        """The (Ordrenummer, ID) pairs whose row wasn't TilFakturering any more when they were flushed,
+        since the last call."""
+        not_updated, self._not_updated = self._not_updated, []
+        return not_updated
+
+    def flush(self) -> int:
+        """Write all buffered rows in one transaction. Returns the number of rows written."""
+        if not self._pending:
+            return 0
+
+        with span("sql.finalize"):
+            conn = self.connection_manager.get()
+            cursor = conn.cursor()
+            if hasattr(cursor, "fast_executemany"):
+                cursor.fast_executemany = True
+            try:
+                cursor.executemany(self.sql, self._pending)
+                # The driver may not know the count after executemany (-1); then look the rows up too
+                not_updated = [] if cursor.rowcount == len(self._pending) else self._find_not_updated(cursor)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        written = len(self._pending) - len(not_updated)
+        self._pending = []
+        self._not_updated += not_updated
+        self.flushes += 1
+        self.rows_written += written
+        self.rows_not_updated += len(not_updated)
+        return written
+
+    def _find_not_updated(self, cursor) -> list[tuple[str, object]]:
+        """The pending pairs whose row doesn't have their Ordrenummer after the UPDATE, in the same transaction."""
+        written = set()
+        for start in range(0, len(self._pending), ID_CHUNK_SIZE):
+            ids = [sql_id for _, sql_id in self._pending[start:start + ID_CHUNK_SIZE]]
+            cursor.execute(WRITTEN_SQL.format(", ".join("?" * len(ids))), *ids)
+            written.update((str(row.Ordrenummer), str(row.ID)) for row in cursor.fetchall())
+        return [(ordernumber, sql_id) for ordernumber, sql_id in self._pending if (str(ordernumber), str(sql_id)) not in written]
+
+    def stats(self) -> dict:
+        """Counters for the run."""
+        return {"flushes": self.flushes, "rows_written": self.rows_written, "rows_not_updated": self.rows_not_updated,
+                "pending": len(self._pending)}
@@ -12,6 +12,7 @@ from robot_framework import reset
 from robot_framework.exceptions import BusinessError, handle_error, log_exception
 from robot_framework import process
 from robot_framework import config
+from robot_framework import error_screenshot
 
 
 def main():
@@ -40,6 +41,7 @@ def main():
             error_count += 1
             handle_error(f"Process Error #{error_count}", error, None, orchestrator_connection)
 
+    orchestrator_connection.log_info(f"Error reports: {error_screenshot.REPORTER.close()}")
     reset.clean_up(orchestrator_connection)
     reset.close_all(orchestrator_connection)
     reset.kill_all(orchestrator_connection)
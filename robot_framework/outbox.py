@@ -0,0 +1,159 @@
+"""This module contains a durable outbox for notifications that don't have to block the SAP work."""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+
+class Outbox:
+    """A SQLite-backed queue of notifications drained by a background thread.
+
+    Each item has a kind, e.g. "vejman" or "pez", and a JSON payload that is passed to the
+    handler registered for that kind. Items are written to disk before enqueue() returns,
+    so anything not yet sent is picked up again by the next run after a crash.
+    At most `concurrency` handlers run at once. A failing item is retried with exponential
+    backoff and marked failed after `max_attempts`.
+    """
+
+    def __init__(self, path: str, handlers: dict[str, Callable[[dict], None]], concurrency: int = 2,
+                 max_attempts: int = 5, backoff: float = 2.0, poll_interval: float = 0.5):
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.sent = 0
+        self.retried = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        # Items that were being sent when the last run died are sent again
+        self._db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        self._db.commit()
+
+        self._in_flight = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="outbox")
+        self._thread = None
+
+    def enqueue(self, kind: str, payload: dict) -> None:
+        """Store a notification durably. It is sent in the background."""
+        if kind not in self.handlers:
+            raise ValueError(f"No outbox handler for '{kind}'")
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outbox (kind, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload, default=str), now, now),
+            )
+            self._db.commit()
+        self._wake.set()
+
+    def start(self) -> None:
+        """Start the background dispatcher."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, drain_timeout: float = 60.0) -> None:
+        """Wait up to drain_timeout for the due items to be sent, then stop the background workers.
+        Anything left stays in the outbox for the next run."""
+        deadline = time.monotonic() + drain_timeout
+        while self._thread is not None and time.monotonic() < deadline and self._has_due_or_in_flight():
+            time.sleep(self.poll_interval)
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=True)
+
+    def close(self) -> None:
+        """Close the SQLite file. Call stop() first."""
+        with self._lock:
+            self._db.close()
+
+    def pop_failed(self) -> list[tuple[str, dict, str]]:
+        """Remove the items that ran out of attempts and return them as (kind, payload, last_error)."""
+        with self._lock:
+            rows = self._db.execute("SELECT id, kind, payload, last_error FROM outbox WHERE status = 'failed'").fetchall()
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(row[0],) for row in rows])
+            self._db.commit()
+        return [(kind, json.loads(payload), last_error) for _, kind, payload, last_error in rows]
+
+    def stats(self) -> dict:
+        """Counters for the run and the number of items per status."""
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {"sent": self.sent, "retried": self.retried, **counts}
+
+    def _has_due_or_in_flight(self) -> bool:
+        with self._lock:
+            (due,) = self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?", (time.time(),)
+            ).fetchone()
+            return due > 0 or self._in_flight > 0
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            for item in self._claim_due():
+                self._executor.submit(self._deliver, *item)
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _claim_due(self) -> list[tuple[int, str, str, int]]:
+        with self._lock:
+            free = self.concurrency - self._in_flight
+            if free <= 0:
+                return []
+            rows = self._db.execute(
+                "SELECT id, kind, payload, attempts FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), free),
+            ).fetchall()
+            for row in rows:
+                self._db.execute("UPDATE outbox SET status = 'sending' WHERE id = ?", (row[0],))
+            self._db.commit()
+            self._in_flight += len(rows)
+            return rows
+
+    def _deliver(self, item_id: int, kind: str, payload: str, attempts: int) -> None:
+        try:
+            self.handlers[kind](json.loads(payload))
+        # Any error is stored on the item and retried.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as error:
+            attempts += 1
+            status = "failed" if attempts >= self.max_attempts else "pending"
+            with self._lock:
+                self._db.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (status, attempts, time.time() + self.backoff * 2 ** (attempts - 1), repr(error), item_id),
+                )
+                self._db.commit()
+                if status == "pending":
+                    self.retried += 1
+        else:
+            with self._lock:
+                self._db.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+                self._db.commit()
+                self.sent += 1
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._wake.set()
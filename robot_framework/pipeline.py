@@ -0,0 +1,142 @@
+"""This module contains the threads and bounded queues that let the robot's stages overlap."""
+
+import queue
+import threading
+from typing import Callable
+
+import spans
+
+# Put on a queue when the stage before it has no more items
+END = object()
+
+
+class StageQueue:
+    """A bounded queue between two stages. The depth is sampled on every put."""
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self.puts = 0
+        self.max_depth = 0
+        self._depth_total = 0
+
+    def put(self, item) -> None:
+        """Add an item, blocking while the queue is full."""
+        self._queue.put(item)
+        depth = self._queue.qsize()
+        self.puts += 1
+        self._depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def get(self, block: bool = True, timeout: float | None = None):
+        """Take the next item. Raises queue.Empty if there is none within the timeout, or none at all when block is False."""
+        return self._queue.get(block, timeout)
+
+    def drain(self) -> list:
+        """Take every item that is in the queue right now."""
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def stats(self) -> dict:
+        """Max and average depth seen when items were added."""
+        return {
+            "queue": self.name, "maxsize": self.maxsize, "puts": self.puts, "max_depth": self.max_depth,
+            "avg_depth": round(self._depth_total / self.puts, 2) if self.puts else None,
+        }
+
+
+class StageTimer:
+    """Splits a stage's time into busy, idle (waiting for input) and blocked (waiting for room in the next queue).
+    The time goes into the spans pipeline.<stage>.<kind>; the timer itself only counts items."""
+
+    KINDS = ("busy", "idle", "blocked")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+
+    def measure(self, kind: str) -> spans.span:
+        """Time the with-block as busy, idle or blocked."""
+        return spans.span(f"pipeline.{self.name}.{kind}")
+
+    def stats(self) -> dict:
+        """Items handled and the seconds per kind recorded in the spans."""
+        recorded = spans.summary()
+        return {"stage": self.name, "items": self.items,
+                **{f"{kind}_s": recorded.get(f"pipeline.{self.name}.{kind}", {}).get("total_s", 0.0) for kind in self.KINDS}}
+
+
+class Stage(threading.Thread):
+    """A pipeline stage running in its own thread.
+
+    A source stage has no input queue; it calls produce() until it returns None and then
+    puts END on its output. A sink stage has no output queue; it calls handle(item) for every
+    item until END arrives. An error stops the stage and is kept in `error`, after END
+    has been passed on so the next stage doesn't wait for ever.
+    """
+
+    def __init__(self, name: str, handler: Callable, inbox: StageQueue | None = None, outbox: StageQueue | None = None):
+        super().__init__(name=f"stage-{name}", daemon=True)
+        if (inbox is None) == (outbox is None):
+            raise ValueError("A stage is either a source (outbox only) or a sink (inbox only)")
+        self.handler = handler
+        self.inbox = inbox
+        self.outbox = outbox
+        self.timer = StageTimer(name)
+        self.error: Exception | None = None
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        try:
+            if self.inbox is None:
+                self._run_source()
+            else:
+                self._run_sink()
+        # The error is reported by the thread that owns the pipeline.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as error:
+            self.error = error
+            if self.outbox is not None:
+                self.outbox.put(END)
+
+    def _run_source(self) -> None:
+        while not self._stopping.is_set():
+            with self.timer.measure("busy"):
+                item = self.handler()
+            if item is None:
+                break
+            self.timer.items += 1
+            with self.timer.measure("blocked"):
+                self.outbox.put(item)
+        self.outbox.put(END)
+
+    def _run_sink(self) -> None:
+        while True:
+            with self.timer.measure("idle"):
+                item = self.inbox.get()
+            if item is END:
+                return
+            with self.timer.measure("busy"):
+                self.handler(item)
+            self.timer.items += 1
+
+    def stop_source(self) -> list:
+        """Stop a source stage and return the items it had produced that nobody took."""
+        self._stopping.set()
+        leftover = []
+        while self.is_alive():
+            leftover += self.outbox.drain()
+            self.join(0.1)
+        leftover += self.outbox.drain()
+        return [item for item in leftover if item is not END]
+
+    def finish_sink(self) -> None:
+        """Let a sink stage handle what is queued and wait for it to stop."""
+        if self.is_alive():
+            self.inbox.put(END)
+            self.join()
@@ -0,0 +1,165 @@
+"""This module reads ahead in the queue and fetches the VejmanFakturering rows of upcoming queue elements in bulk."""
+
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+import json
+import time
+from typing import TYPE_CHECKING
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+from OpenOrchestrator.database.queues import QueueElement
+
+from robot_framework.sql_connection import ConnectionManager
+from spans import span
+
+if TYPE_CHECKING:
+    import pyodbc
+
+# SQL Server allows 2100 parameters per statement
+MAX_IDS_PER_QUERY = 1000
+
+
+@dataclass
+class PreparedElement:
+    """A queue element together with its VejmanFakturering row.
+    row is None when the row is no longer TilFakturering, or when the element is a duplicate of
+    one already handed out in this run, and the element should be skipped."""
+    queue_element: QueueElement
+    sql_id: object
+    vejmanid: str
+    row: pyodbc.Row | None
+    fetched_at: float
+    duplicate: bool = False
+
+
+def prepare_elements(cursor: pyodbc.Cursor, queue_elements: list[QueueElement]) -> list[PreparedElement]:
+    """Fetch the pending rows for the given queue elements with one WHERE ID IN (...) query per chunk."""
+    parsed = []
+    for queue_element in queue_elements:
+        faktura = json.loads(queue_element.data)
+        parsed.append((queue_element, faktura.get("ID"), faktura.get("VejmanID")))
+
+    rows = fetch_pending_rows(cursor, [sql_id for _, sql_id, _ in parsed])
+    fetched_at = time.monotonic()
+    return [
+        PreparedElement(queue_element, sql_id, vejmanid, rows.get(str(sql_id)), fetched_at)
+        for queue_element, sql_id, vejmanid in parsed
+    ]
+
+
+def fetch_pending_rows(cursor: pyodbc.Cursor, sql_ids: list) -> dict:
+    """Fetch the rows among sql_ids that are still TilFakturering, keyed by str(ID)."""
+    rows = {}
+    for start in range(0, len(sql_ids), MAX_IDS_PER_QUERY):
+        chunk = sql_ids[start:start + MAX_IDS_PER_QUERY]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"""
+            SELECT *
+            FROM [VejmanKassen].[dbo].[VejmanFakturering]
+            WHERE ID IN ({placeholders}) AND FakturaStatus = 'TilFakturering'
+        """, *chunk)
+        for row in cursor.fetchall():
+            rows[str(row.ID)] = row
+    return rows
+
+
+class Prefetcher:
+    """Pulls queue elements up to `lookahead` ahead of processing and prepares them in bulk.
+
+    Rows can change status while they wait in the look-ahead buffer. Before a batch is
+    handed out, any row fetched more than `max_age` seconds ago is checked again, in one
+    query for the whole batch, so elements that are no longer TilFakturering are still skipped.
+    The robot's own write-back can't be seen that way while the element is still in the buffer,
+    so an element whose SQL ID has already been taken in this run is skipped as a duplicate.
+    """
+
+    def __init__(self, orchestrator_connection: OrchestratorConnection, connection_manager: ConnectionManager,
+                 queue_name: str, lookahead: int, max_age: float, max_elements: int):
+        self.orchestrator_connection = orchestrator_connection
+        self.connection_manager = connection_manager
+        self.queue_name = queue_name
+        self.lookahead = lookahead
+        self.max_age = max_age
+        self.max_elements = max_elements
+        self.pulled = 0
+        self.prefetch_queries = 0
+        self.revalidations = 0
+        self.duplicates = 0
+        self._taken_ids: set[str] = set()
+        self._buffer: deque[PreparedElement] = deque()
+        self._unprepared: list[QueueElement] = []
+        self._queue_empty = False
+
+    def next_batch(self, size: int) -> list[PreparedElement]:
+        """Get the next batch of up to `size` prepared elements. An empty list means the queue is done."""
+        if len(self._buffer) < size:
+            self._fill(max(size, self.lookahead))
+
+        batch = [self._buffer.popleft() for _ in range(min(size, len(self._buffer)))]
+        stale = [element for element in batch if element.row is not None and time.monotonic() - element.fetched_at > self.max_age]
+        if stale:
+            try:
+                self._revalidate(stale)
+            except Exception:
+                self._buffer.extendleft(reversed(batch))
+                raise
+        return batch
+
+    def buffered(self) -> list[PreparedElement]:
+        """The prepared elements waiting in the look-ahead buffer."""
+        return list(self._buffer)
+
+    def remaining(self) -> list[QueueElement]:
+        """The queue elements that have been pulled from the queue but not handed out."""
+        return self._unprepared + [element.queue_element for element in self._buffer]
+
+    def stats(self) -> dict:
+        """Counters for the run."""
+        return {"pulled": self.pulled, "prefetch_queries": self.prefetch_queries, "revalidations": self.revalidations,
+                "duplicates": self.duplicates}
+
+    def _fill(self, target: int) -> None:
+        # Elements from a fill that failed to prepare are retried first
+        new_elements, self._unprepared = self._unprepared, []
+        while not self._queue_empty and len(self._buffer) + len(new_elements) < target and self.pulled < self.max_elements:
+            queue_element = self.orchestrator_connection.get_next_queue_element(self.queue_name)
+            if not queue_element:
+                self.orchestrator_connection.log_info("Queue empty.")
+                self._queue_empty = True
+                break
+            self.pulled += 1
+            new_elements.append(queue_element)
+
+        if new_elements:
+            try:
+                with span("sql.prefetch"):
+                    cursor = self.connection_manager.get().cursor()
+                    prepared = prepare_elements(cursor, new_elements)
+            except Exception:
+                self._unprepared = new_elements
+                raise
+            self.prefetch_queries += 1
+            self._mark_duplicates(prepared)
+            self._buffer.extend(prepared)
+
+    def _mark_duplicates(self, prepared: list[PreparedElement]) -> None:
+        """Skip the elements whose SQL ID is already in the buffer or has been handed out in this run."""
+        for element in prepared:
+            key = str(element.sql_id)
+            if key in self._taken_ids and element.row is not None:
+                element.row = None
+                element.duplicate = True
+                self.duplicates += 1
+            self._taken_ids.add(key)
+
+    def _revalidate(self, elements: list[PreparedElement]) -> None:
+        with span("sql.revalidate"):
+            cursor = self.connection_manager.get().cursor()
+            rows = fetch_pending_rows(cursor, [element.sql_id for element in elements])
+        now = time.monotonic()
+        for element in elements:
+            element.row = rows.get(str(element.sql_id))
+            element.fetched_at = now
+        self.revalidations += 1
@@ -1,104 +1,529 @@
 """This module contains the main process of the robot."""
 
+from __future__ import annotations
+
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
-from OpenOrchestrator.database.queues import QueueElement
-import pyodbc
+from OpenOrchestrator.database.queues import QueueElement, QueueStatus
+from dataclasses import dataclass, field
 from datetime import datetime
-import json
-import os
+import time
+from typing import Callable, TYPE_CHECKING
 
-from create_invoices import run_zfi_fakturagrundlag, generate_csv, create_debitors
-from generate_invoice_csv import generate_invoice_csv
+from create_invoices import (run_zfi_fakturagrundlag, generate_csv, create_debitors, map_order_numbers, is_cvr,
+                             duplicate_ids, OrderMappingError)
+from generate_invoice_csv import generate_batch_invoice_csv
 from send_invoices import send_invoice
-from update_vejman import update_case
-from pez_client import PEZClient
+from sap_sessions import SessionPool, get_session, return_to_start, scripting_errors
+from spans import span
+from update_vejman import VejmanClient, VejmanConfig
+from pez_client import PEZClient, PEZConfig, TokenStore
+from robot_framework.sql_connection import ConnectionManager
+from robot_framework.prefetch import PreparedElement, Prefetcher, prepare_elements
+from robot_framework.finalize import FinalizeWriter
+from robot_framework.debitor_store import DebitorStore, normalize_debitor
+from robot_framework.outbox import Outbox
+from robot_framework.workspace import Workspace
+
+if TYPE_CHECKING:
+    import pyodbc
+
+
+@dataclass
+class PendingInvoice:
+    """An invoice that has been created in SAP and written back to SQL, but not yet sent."""
+    queue_element: QueueElement
+    vejmanid: str
+    row: pyodbc.Row
+    ordernumber: str
+
+
+@dataclass
+class SendStage:
+    """Defers the ZVF04 send so one pass covers every invoice created since the last send.
+
+    The stage is due after every batch when interval_seconds is 0, otherwise when the
+    oldest pending invoice has waited that long. It is always due when the date has
+    changed, since ZVF04 is filtered on the invoice date.
+    """
+    interval_seconds: float = 0
+    pending: list[PendingInvoice] = field(default_factory=list)
+    invoice_date: datetime | None = None
+    _first_pending_at: float | None = None
+
+    def add(self, invoice: PendingInvoice) -> None:
+        """Queue an invoice for the next send."""
+        if not self.pending:
+            self._first_pending_at = time.monotonic()
+            self.invoice_date = datetime.today()
+        self.pending.append(invoice)
+
+    def is_due(self) -> bool:
+        """Whether the pending invoices should be sent now."""
+        if not self.pending:
+            return False
+        if self.invoice_date.date() != datetime.today().date():
+            return True
+        return time.monotonic() - self._first_pending_at >= self.interval_seconds
+
+    def pending_elements(self) -> list[QueueElement]:
+        """The queue elements waiting for the next send."""
+        return [invoice.queue_element for invoice in self.pending]
+
+    def clear(self) -> None:
+        """Forget all pending invoices."""
+        self.pending = []
+        self.invoice_date = None
+        self._first_pending_at = None
+
+
+@dataclass
+class RunContext:
+    """State shared by every queue element in one robot run."""
+    connection_manager: ConnectionManager
+    send_stage: SendStage
+    finalize_writer: FinalizeWriter
+    debitor_store: DebitorStore
+    vejman_client: VejmanClient
+    pez_client: PEZClient
+    outbox: Outbox
+    workspace: Workspace
+
+    @classmethod
+    def create(cls, orchestrator_connection: OrchestratorConnection, *, send_interval_seconds: float = 0,
+               debitor_store_path: str | None = None, outbox_path: str = ":memory:",
+               outbox_concurrency: int = 2, outbox_max_attempts: int = 5,
+               pez_token_path: str | None = None, workspace_root: str = "workspace",
+               keep_failed_files: bool = False, connect: Callable[[], object] | None = None,
+               vejman_config: VejmanConfig | None = None, pez_config: PEZConfig | None = None) -> "RunContext":
+        """Create the run's state with a SQL connection to VejmanKassen, or to what connect opens.
+        The notification outbox is started right away, so items left by an earlier run are sent too.
+        If a step fails, the SQL connection is closed again before the error is raised."""
+        connection_manager = ConnectionManager(connect) if connect else ConnectionManager.from_orchestrator(orchestrator_connection)
+        try:
+            debitor_store = DebitorStore(debitor_store_path)
+            with span("sql.seed_debitors"):
+                debitor_store.seed_from_sql(connection_manager.get().cursor())
+            vejman_client = VejmanClient(orchestrator_connection.get_credential("VejmanToken").password, vejman_config)
+            pez_cred = orchestrator_connection.get_credential("PEZUI")
+            pez_client = PEZClient(pez_cred.username, pez_cred.password, pez_config, TokenStore(pez_token_path))
+            workspace = Workspace(workspace_root, keep_failed_files)
+            workspace.open()
+            # Started last, since its worker threads are the one thing that outlives a failed setup
+            outbox = Outbox(outbox_path, {
+                "vejman": lambda payload: send_vejman_notification(vejman_client, payload),
+                "pez": lambda payload: send_pez_notification(pez_client, payload),
+            }, concurrency=outbox_concurrency, max_attempts=outbox_max_attempts)
+            outbox.start()
+        except Exception:
+            connection_manager.close()
+            raise
+        return cls(connection_manager, SendStage(send_interval_seconds), FinalizeWriter(connection_manager),
+                   debitor_store, vejman_client, pez_client, outbox, workspace)
+
+    def drain_outbox(self, orchestrator_connection: OrchestratorConnection, drain_timeout: float = 60.0) -> None:
+        """Let the outbox send what it can within drain_timeout and log the notifications that gave up."""
+        self.outbox.stop(drain_timeout)
+        for kind, payload, last_error in self.outbox.pop_failed():
+            orchestrator_connection.log_error(f"Notifikation ({kind}) kunne ikke sendes og skal udføres manuelt: {payload}. Sidste fejl: {last_error}")
+
+    def close(self, drain_timeout: float = 60.0) -> None:
+        """Write anything still buffered, let the outbox drain, close the SQL and HTTP connections and the workspace."""
+        try:
+            self.finalize_writer.flush()
+        finally:
+            self.outbox.stop(drain_timeout)
+            self.outbox.close()
+            self.connection_manager.close()
+            self.vejman_client.close()
+            self.pez_client.close()
+            self.workspace.close()
+
+    def stats(self) -> dict:
+        """Counters for the run, per component."""
+        return {
+            "sql_connection": self.connection_manager.stats(),
+            "finalize": self.finalize_writer.stats(),
+            "debitors": self.debitor_store.stats(),
+            "vejman": self.vejman_client.stats(),
+            "pez": self.pez_client.stats(),
+            "outbox": self.outbox.stats(),
+            "workspace": self.workspace.stats(),
+        }
 
 
-# pylint: disable-next=unused-argument
 def process(orchestrator_connection: OrchestratorConnection, queue_element: QueueElement | None = None) -> None:
     """Do the primary process of the robot."""
-    vejmantoken = orchestrator_connection.get_credential("VejmanToken").password
+    run = RunContext.create(orchestrator_connection)
+    try:
+        prepared = prepare_elements(run.connection_manager.get().cursor(), [queue_element])
+        process_batch(orchestrator_connection, prepared, run)
+        send_pending(orchestrator_connection, run)
+        run.drain_outbox(orchestrator_connection)
+    finally:
+        run.close()
+
+
+@dataclass
+class BatchWork:
+    """A batch whose invoice file has been written and that is ready for ZFI_FAKTURAGRUNDLAG."""
+    elements: list[QueueElement]
+    invoices: list[tuple]  # (sql_id, vejmanid, row)
+    fakturafil: str
+    debitors: list[str]
+    # Set in the main thread once every debitor is known to exist, so the ZFI test run can be skipped
+    debitors_known: bool = False
+
+
+@dataclass
+class PreparedBatch:
+    """A batch from the prepare stage: its elements, the written invoice file (None if there was
+    nothing to invoice) or the error from writing it, and the look-ahead buffer at that time."""
+    batch: list[PreparedElement]
+    work: BatchWork | None
+    error: Exception | None
+    lookahead: list[PreparedElement]
 
-    sql_server = orchestrator_connection.get_constant("SqlServer").value
-    conn_string = "DRIVER={SQL Server};"+f"SERVER={sql_server};DATABASE=VejmanKassen;Trusted_Connection=yes;"
-    conn = pyodbc.connect(conn_string)
+
+@dataclass
+class BatchResult:
+    """What SAP did for a batch: the order number per SQL row ID and the debitors created on the way."""
+    ordernumbers: dict
+    created_debitors: list[str]
+
+
+def process_batch(orchestrator_connection: OrchestratorConnection, prepared: list[PreparedElement], run: RunContext) -> dict:
+    """Process several queue elements with a single ZFI_FAKTURAGRUNDLAG upload.
+
+    All pending rows are written to one multi-record CSV, tested and updated once in SAP,
+    and the saved order numbers are mapped back to their rows. The rows are buffered in the
+    run's finalize writer and the invoices are left in its send stage for send_pending.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        prepared: The queue elements to invoice together, with their prefetched rows.
+            Elements without a row are no longer TilFakturering and are skipped.
+        run: The state shared across the robot run.
+
+    Returns:
+        A dict mapping each invoiced SQL row ID to its order number.
+    """
+    work = prepare_batch(orchestrator_connection, prepared, run.connection_manager, run.workspace)
+    if work is None:
+        return {}
+    create_batch_debitors(orchestrator_connection, run, work)
+    try:
+        result = run_batch_in_sap(orchestrator_connection, work, run.workspace)
+    except Exception:
+        run.workspace.release(work.fakturafil, failed=True)
+        raise
+    return finish_batch(run, work, result)
+
+
+def process_batches(orchestrator_connection: OrchestratorConnection, works: list[BatchWork],
+                    run: RunContext, session_pool: SessionPool) -> list[Exception | None]:
+    """Process several prepared batches at once, each on its own SAP session.
+
+    Debitors are created and the results are booked in this thread, since the run's state
+    is not shared between threads. Only ZFI_FAKTURAGRUNDLAG runs in the session pool's workers;
+    they share the orchestrator connection and the workspace, which are safe to use from several threads.
+
+    Returns:
+        None or the error per batch, in the order of the batches.
+    """
+    for work in works:
+        create_batch_debitors(orchestrator_connection, run, work)
+
+    errors: list[Exception | None] = [None] * len(works)
+    with span("sap.batches"):
+        results = session_pool.map(lambda session, work: run_batch_in_sap(orchestrator_connection, work, run.workspace, session), works)
+    for index, (work, (result, error)) in enumerate(zip(works, results)):
+        if error is not None:
+            errors[index] = error
+            run.workspace.release(work.fakturafil, failed=True)
+            continue
+        try:
+            finish_batch(run, work, result)
+        # The error is reported for this batch only.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as finish_error:
+            errors[index] = finish_error
+    return errors
+
+
+def prepare_next(orchestrator_connection: OrchestratorConnection, prefetcher: Prefetcher,
+                 connection_manager: ConnectionManager, workspace: Workspace, batch_size: int) -> PreparedBatch | None:
+    """Take the next batch from the prefetcher and write its invoice file. Returns None when the queue is done.
+    Used by the prepare stage, so it only touches SQL through its own connection manager."""
+    batch = prefetcher.next_batch(batch_size)
+    if not batch:
+        return None
+    try:
+        work = prepare_batch(orchestrator_connection, batch, connection_manager, workspace)
+    # The error belongs to this batch and is handled by the SAP stage.
+    # pylint: disable-next = broad-exception-caught
+    except Exception as error:
+        return PreparedBatch(batch, None, error, prefetcher.buffered())
+    return PreparedBatch(batch, work, None, prefetcher.buffered())
+
+
+def prepare_batch(orchestrator_connection: OrchestratorConnection, prepared: list[PreparedElement],
+                  connection_manager: ConnectionManager, workspace: Workspace) -> BatchWork | None:
+    """Write the invoice file of a batch to the workspace. Returns None if no element in the batch has anything to invoice."""
+    conn = connection_manager.get()
     cursor = conn.cursor()
-    
-    faktura = json.loads(queue_element.data)
-    sql_id = faktura.get("ID")
-    vejmanid = faktura.get("VejmanID")
-    orchestrator_connection.log_info(f"Running for SQL row with ID: {sql_id} - {vejmanid}")
-
-    cursor.execute("""
-        SELECT *
-        FROM [VejmanKassen].[dbo].[VejmanFakturering]
-        WHERE ID = ? AND FakturaStatus = 'TilFakturering'
-    """, sql_id)
-    row = cursor.fetchone()
-    fakturafil = generate_invoice_csv(orchestrator_connection, conn, cursor, row)
-
-    ordernumber = None
-
-    success, debitorsororder = run_zfi_fakturagrundlag(fakturafil, orchestrator_connection)
-    # Output file name based on date
+
+    invoices = []  # (sql_id, vejmanid, row)
+    invoiced_elements = []
+    for element in prepared:
+        orchestrator_connection.log_info(f"Running for SQL row with ID: {element.sql_id} - {element.vejmanid}")
+        if element.duplicate:
+            orchestrator_connection.log_info(f"SQL række {element.sql_id} er allerede taget af et andet køelement i kørslen, springer over")
+            continue
+        if element.row is None:
+            orchestrator_connection.log_info(f"SQL række {element.sql_id} er ikke længere TilFakturering, springer over")
+            continue
+        invoices.append((element.sql_id, element.vejmanid, element.row))
+        invoiced_elements.append(element.queue_element)
+
+    if not invoices:
+        return None
+    # SAP's result list can only be paired with distinct rows, so never upload a row twice
+    duplicates = duplicate_ids([row.ID for _, _, row in invoices])
+    if duplicates:
+        raise RuntimeError(f"SQL række-ID'er forekommer flere gange i samme batch: {duplicates}")
+
+    rows = [row for _, _, row in invoices]
+    with span("prepare.invoice_file"):
+        fakturafil = generate_batch_invoice_csv(orchestrator_connection, conn, cursor, rows, workspace.folder)
+    debitors = sorted({normalize_debitor(row.CvrNr) for row in rows})
+    return BatchWork(invoiced_elements, invoices, fakturafil, debitors)
+
+
+def create_batch_debitors(orchestrator_connection: OrchestratorConnection, run: RunContext, work: BatchWork) -> None:
+    """Create the batch's unknown debitors before the first upload, saving a failed ZFI test and a retest.
+    When every debitor is known to exist afterwards, the batch goes straight to the ZFI update."""
+    create_unknown_debitors(orchestrator_connection, run, run.debitor_store.unknown(work.debitors), work.invoices[0][0])
+    work.debitors_known = not run.debitor_store.unknown(work.debitors, count=False)
+
+
+def leave_transaction(orchestrator_connection: OrchestratorConnection) -> None:
+    """Take the first SAP session back to the start screen after a failed step, so the next one starts from there."""
+    try:
+        if return_to_start(get_session()):
+            return
+    except scripting_errors():
+        pass
+    orchestrator_connection.log_info("SAP-sessionen kom ikke tilbage til startskærmen, næste trin starter fra den aktuelle skærm")
+
+
+def run_batch_in_sap(orchestrator_connection: OrchestratorConnection, work: BatchWork, workspace: Workspace, session=None) -> BatchResult:
+    """Upload a batch's invoice file with ZFI_FAKTURAGRUNDLAG on the given SAP session.
+    Debitors SAP reports as missing are created and the upload is tried once more.
+    Only touches SAP, so it can run in a session pool worker."""
+    first_id = work.invoices[0][0]
+    created = []
+    with span("sap.zfi_fakturagrundlag"):
+        success, debitorsororder = run_zfi_fakturagrundlag(work.fakturafil, orchestrator_connection, session,
+                                                           test=not work.debitors_known)
+    if not success:
+        orchestrator_connection.log_info(f"Debitor ikke oprettet for SQL række(r) fra: {first_id}, forsøger at oprette")
+        create_missing_debitors(orchestrator_connection, debitorsororder, first_id, workspace, session)
+        created = debitorsororder
+        # The missing debitors exist now, so the retry goes straight to the update
+        with span("sap.zfi_fakturagrundlag"):
+            success, debitorsororder = run_zfi_fakturagrundlag(work.fakturafil, orchestrator_connection, session, test=False)
     if not success:
-        orchestrator_connection.log_info(f"Debitor ikke oprettet for SQL række: {sql_id}, forsøger at oprette")
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # remove last 3 digits → milliseconds
-        filename = f"{sql_id}_Debitorer_CSV_{timestamp}.csv"
-        debitor_csv = generate_csv(debitorsororder, filename)
-        create_debitors(debitor_csv, orchestrator_connection)
-        os.remove(debitor_csv)
-        success, debitorsororder = run_zfi_fakturagrundlag(fakturafil, orchestrator_connection)
-    if success:
-        orchestrator_connection.log_info("Debitor oprettet")
-        if len(debitorsororder) == 1:
-            ordernumber = debitorsororder[0]  # Extract the only item
-        else:
-            raise RuntimeError("Flere ordrenumre fundet, der burde kun være et.")
-    else:
         raise RuntimeError("Fejlede indlæsning efter debitoroprettelse")
+    orchestrator_connection.log_info("Debitor oprettet")
+    try:
+        ordernumbers = map_order_numbers(debitorsororder, [row.ID for _, _, row in work.invoices])
+    except OrderMappingError as error:
+        # The orders are saved in SAP, so log them before the batch fails; the invoice file is kept as failed
+        orchestrator_connection.log_error(str(error))
+        raise
+    return BatchResult(ordernumbers, created)
 
-    orchestrator_connection.log_info(f"Afsender faktura for {sql_id} med ordrenummer {ordernumber}")       
-    send_invoice(orchestrator_connection)
-    cursor.execute("""
-        UPDATE [VejmanKassen].[dbo].[VejmanFakturering]
-        SET FakturaStatus = 'Faktureret',
-            FakturaDato        = CAST(GETDATE() AS date),
-            Ordrenummer        = ?
-        WHERE ID = ?
-    """, ordernumber, sql_id)
-    conn.commit()
-    os.remove(fakturafil)
-    if not vejmanid == "Henstilling":
-        update_case(vejmanid, vejmantoken)
-    else:
-        # Extract fields from SQL row
-        pez_uuid = row.PEZUUID
-        tilladelsestype = row.TilladelsesType
-        totalpris = row.TotalPris
-        startdato = row.Startdato
-        slutdato = row.Slutdato
-        antal_dage = row.AntalDage
 
-        # --- PEZ comment if case came from PEZ ---
-        if pez_uuid:
-            pez_client = None
-            pez_cred = orchestrator_connection.get_credential("PEZUI")
+def finish_batch(run: RunContext, work: BatchWork, result: BatchResult) -> dict:
+    """Book a batch SAP has saved: buffer the SQL write-back and queue the invoices for sending.
+
+    Returns:
+        A dict mapping each invoiced SQL row ID to its order number.
+    """
+    ordernumbers = result.ordernumbers
+    run.debitor_store.add(result.created_debitors, created=True)
+    run.debitor_store.add(work.debitors)
+
+    for sql_id, _, row in work.invoices:
+        run.finalize_writer.add(sql_id, ordernumbers[row.ID])
+    run.workspace.release(work.fakturafil)
+
+    for queue_element, (_, vejmanid, row) in zip(work.elements, work.invoices):
+        run.send_stage.add(PendingInvoice(queue_element, vejmanid, row, ordernumbers[row.ID]))
+
+    return {row.ID: ordernumbers[row.ID] for _, _, row in work.invoices}
+
+
+def create_missing_debitors(orchestrator_connection: OrchestratorConnection, debitors: list[str], first_id,
+                            workspace: Workspace, session=None) -> dict:
+    """Create the given debitors in SAP with ZFIE_OPRETDEB, on the given session or the first one.
+    The debitor file is written to the workspace and kept there as failed if SAP doesn't accept it.
+
+    Returns:
+        A dict of debitor -> result line for the debitors SAP's result list could be tied to.
+    """
+    # Output file name based on date
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]  # remove last 3 digits → milliseconds
+    filename = f"{first_id}_Debitorer_CSV_{timestamp}.csv"
+    debitor_csv = generate_csv(debitors, workspace.path(filename))
+    try:
+        with span("sap.zfie_opretdeb"):
+            results = create_debitors(debitor_csv, orchestrator_connection, debitors, session)
+    except Exception:
+        workspace.release(debitor_csv, failed=True)
+        raise
+    workspace.release(debitor_csv)
+    return results
+
 
-            if pez_cred:
-                pez_client = PEZClient(pez_cred.username, pez_cred.password)
+def create_debitors_ahead(orchestrator_connection: OrchestratorConnection, run: RunContext, prepared: list[PreparedElement]) -> None:
+    """Create the unknown debitors of every prepared element in one ZFIE_OPRETDEB run, see create_unknown_debitors."""
+    debitors = set()
+    for element in prepared:
+        if element.row is None:
+            continue
+        try:
+            debitors.add(normalize_debitor(element.row.CvrNr))
+        except (TypeError, ValueError):
+            continue
+    create_unknown_debitors(orchestrator_connection, run, debitors, "Samlet")
 
-            orchestrator_connection.log_info(f"Sending PEZ comment for UUID {pez_uuid}")
 
-            comment = pez_client.format_faktura_comment(
+def create_unknown_debitors(orchestrator_connection: OrchestratorConnection, run: RunContext, debitors, first_id) -> None:
+    """Create the given debitors that aren't known to exist in one deduplicated ZFIE_OPRETDEB run.
+
+    Only numbers that pass the local CVR check and haven't been tried this run are created.
+    Anything else is left to the normal flow, where ZFI_FAKTURAGRUNDLAG reports the debitors
+    that are really missing. If the run fails, the first session is taken back to the start screen.
+    """
+    store = run.debitor_store
+    candidates = [
+        debitor for debitor in store.unknown(sorted(set(debitors)), count=False)
+        if is_cvr(debitor) and debitor not in store.attempted
+    ]
+    if not candidates:
+        return
+    store.attempted.update(candidates)
+
+    orchestrator_connection.log_info(f"Opretter {len(candidates)} ukendte debitor(er) samlet: {candidates}")
+    try:
+        results = create_missing_debitors(orchestrator_connection, candidates, first_id, run.workspace)
+    # Some of them probably exist already; the normal flow finds the ones that are really missing.
+    # pylint: disable-next = broad-exception-caught
+    except Exception as error:
+        orchestrator_connection.log_info(f"Samlet debitoroprettelse fejlede ({error}), fortsætter med almindelig indlæsning")
+        leave_transaction(orchestrator_connection)
+        return
+
+    # Every result line has been validated as created, so all candidates exist now
+    store.add(candidates, created=True)
+    unmatched = [debitor for debitor in candidates if debitor not in results]
+    if unmatched:
+        orchestrator_connection.log_info(f"Resultatlinjer kunne ikke knyttes til debitor(er): {unmatched}")
+    for debitor, line in results.items():
+        orchestrator_connection.log_info(f"Debitor {debitor}: {line}")
+
+
+def send_pending(orchestrator_connection: OrchestratorConnection, run: RunContext) -> list[QueueElement]:
+    """Send every pending invoice in one ZVF04 pass and queue the notifications of their cases.
+    The finalize writer is flushed first, so SQL knows about every order before it is sent.
+    An invoice whose row the writer couldn't update is failed first, see fail_not_updated.
+    An order ZVF04 doesn't list is not sent; its queue element is failed with a message saying
+    so, while the others are sent and notified as usual.
+
+    Returns:
+        The queue elements whose invoices were sent.
+    """
+    send_stage = run.send_stage
+    if not send_stage.pending:
+        return []
+
+    run.finalize_writer.flush()
+    fail_not_updated(orchestrator_connection, run)
+    if not send_stage.pending:
+        return []
+
+    orders = [invoice.ordernumber for invoice in send_stage.pending]
+    orchestrator_connection.log_info(f"Afsender {len(orders)} faktura(er) med ordrenumre {orders}")
+    with span("sap.zvf04"):
+        matched = send_invoice(orchestrator_connection, expected_orders=orders, invoice_date=send_stage.invoice_date)
+
+    pending = list(send_stage.pending)
+    send_stage.clear()
+    sent = [invoice for invoice in pending if invoice.ordernumber in matched]
+    for invoice in pending:
+        if invoice.ordernumber not in matched and invoice.queue_element is not None:
+            orchestrator_connection.set_queue_element_status(
+                invoice.queue_element.id, QueueStatus.FAILED,
+                f"Ordre {invoice.ordernumber} er oprettet i SAP og SQL, men blev ikke fundet i ZVF04 og er ikke sendt. "
+                "Fakturaen skal sendes og sagen opdateres manuelt.")
+    for invoice in sent:
+        notify_case(orchestrator_connection, run, invoice.vejmanid, invoice.row, invoice.ordernumber)
+    return [invoice.queue_element for invoice in sent]
+
+
+def fail_not_updated(orchestrator_connection: OrchestratorConnection, run: RunContext) -> None:
+    """Fail the pending invoices whose SQL row the finalize writer found no longer TilFakturering.
+    Their orders exist in SAP and ZVF04 sends them with the rest, so they are logged to be checked
+    for a double invoice by hand. Their cases are not notified."""
+    not_updated = {str(sql_id): ordernumber for ordernumber, sql_id in run.finalize_writer.pop_not_updated()}
+    if not not_updated:
+        return
+    orchestrator_connection.log_error(f"SQL rækker var ikke længere TilFakturering og er ikke opdateret. (ID: Ordrenummer): {not_updated}")
+    remaining = []
+    for invoice in run.send_stage.pending:
+        if str(invoice.row.ID) not in not_updated:
+            remaining.append(invoice)
+        elif invoice.queue_element is not None:
+            orchestrator_connection.set_queue_element_status(
+                invoice.queue_element.id, QueueStatus.FAILED,
+                f"Ordre {invoice.ordernumber} er oprettet i SAP, men SQL række {invoice.row.ID} var ikke længere "
+                "TilFakturering og er ikke opdateret. Ordren sendes med ZVF04; tjek om sagen er faktureret to gange.")
+    if remaining:
+        run.send_stage.pending = remaining
+    else:
+        run.send_stage.clear()
+
+
+def notify_case(orchestrator_connection: OrchestratorConnection, run: RunContext, vejmanid, row: pyodbc.Row, ordernumber: str) -> None:
+    """Queue the notification telling Vejman or PEZ that the invoice for a row has been sent.
+    The run's outbox sends it in the background."""
+    if not vejmanid == "Henstilling":
+        run.outbox.enqueue("vejman", {"case_id": vejmanid})
+    else:
+        # --- PEZ comment if case came from PEZ ---
+        pez_uuid = row.PEZUUID
+        if pez_uuid:
+            comment = PEZClient.format_faktura_comment(
                 order_number=ordernumber,
-                tilladelsestype=tilladelsestype,
-                totalpris=totalpris,
-                startdato=startdato,
-                slutdato=slutdato,
-                antal_dage=antal_dage
+                tilladelsestype=row.TilladelsesType,
+                totalpris=row.TotalPris,
+                startdato=row.Startdato,
+                slutdato=row.Slutdato,
+                antal_dage=row.AntalDage
             )
+            orchestrator_connection.log_info(f"Queueing PEZ comment for UUID {pez_uuid}")
+            run.outbox.enqueue("pez", {"case_uuid": pez_uuid, "comment": comment})
+
+
+@span("vejman.update_case")
+def send_vejman_notification(vejman_client: VejmanClient, payload: dict) -> None:
+    """Outbox handler: mark a Vejman case as invoiced. Raises if Vejman didn't confirm, so the item is retried."""
+    if not vejman_client.update_case(payload["case_id"]):
+        raise RuntimeError(f"Vejman bekræftede ikke opdateringen af sag {payload['case_id']}")
 
-            pez_client.add_internal_comment(pez_uuid, comment)
 
-            orchestrator_connection.log_info("PEZ comment added successfully")
+@span("pez.comment")
+def send_pez_notification(pez_client: PEZClient, payload: dict) -> None:
+    """Outbox handler: add the invoice comment to a PEZ case."""
+    pez_client.add_internal_comment(payload["case_uuid"], payload["comment"])
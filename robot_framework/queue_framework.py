@@ -4,6 +4,10 @@
 # pylint: disable=duplicate-code
 
 import sys
+from dataclasses import dataclass, field
+from queue import Empty
+import threading
+from typing import Callable
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 from OpenOrchestrator.database.queues import QueueStatus
@@ -13,6 +17,16 @@ from robot_framework import reset
 from robot_framework.exceptions import handle_error, BusinessError, log_exception
 from robot_framework import process
 from robot_framework import config
+from robot_framework import error_screenshot
+from robot_framework.prefetch import Prefetcher
+from robot_framework.pipeline import END, Stage, StageQueue, StageTimer
+from robot_framework.sql_connection import ConnectionManager
+from generate_invoice_csv import TEKSTER_CACHE
+from sap_sessions import SessionPool
+from update_vejman import VejmanConfig
+from pez_client import PEZConfig
+import sap_screen
+import spans
 
 
 def main():
@@ -23,41 +37,314 @@ def main():
     orchestrator_connection.log_trace("Robot Framework started.")
     initialize.initialize(orchestrator_connection)
 
-    queue_element = None
+    stats = run_queue(orchestrator_connection)
+
+    reset.clean_up(orchestrator_connection)
+    reset.close_all(orchestrator_connection)
+    reset.kill_all(orchestrator_connection)
+
+    if config.FAIL_ROBOT_ON_TOO_MANY_ERRORS and stats["errors"] == config.MAX_RETRY_COUNT:
+        raise RuntimeError("Process failed too many times.")
+
+
+def run_queue(orchestrator_connection: OrchestratorConnection, connect: Callable[[], object] | None = None,
+              vejman_config: VejmanConfig | None = None, pez_config: PEZConfig | None = None) -> dict:
+    """Work through the queue with the retry loop, then shut the run's pipeline and connections down.
+    The run's state and pipeline are set up inside the retry loop, so a failure there is handled
+    like any other process error and the next attempt tries again.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        connect: Opens a SQL connection. Defaults to VejmanKassen on the SqlServer constant.
+        vejman_config: Settings for the Vejman client. Defaults to the production Vejman.
+        pez_config: Settings for the PEZ client. Defaults to the production PEZ.
+
+    Returns:
+        The run's counters, per component, as they are logged. "errors" is the number of process errors.
+    """
+    # The pipeline stages and the SAP session pool's workers log and update queue elements from their own threads
+    orchestrator_connection = SharedConnection(orchestrator_connection)
+    session_pool = SessionPool(config.SAP_SESSION_COUNT)
+    run: process.RunContext | None = None
+    pipeline: QueuePipeline | None = None
+
     error_count = 0
-    task_count = 0
     # Retry loop
     for _ in range(config.MAX_RETRY_COUNT):
         try:
+            if run is None:
+                run = process.RunContext.create(
+                    orchestrator_connection, send_interval_seconds=config.SEND_INTERVAL_SECONDS,
+                    debitor_store_path=config.KNOWN_DEBITORS_FILE, outbox_path=config.OUTBOX_FILE,
+                    outbox_concurrency=config.OUTBOX_CONCURRENCY, outbox_max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+                    pez_token_path=config.PEZ_TOKEN_FILE, workspace_root=config.WORKSPACE_FOLDER,
+                    keep_failed_files=config.KEEP_FAILED_FILES, connect=connect, vejman_config=vejman_config, pez_config=pez_config,
+                )
+            if pipeline is None:
+                pipeline = QueuePipeline.start(orchestrator_connection, connect)
             reset.reset(orchestrator_connection)
+            session_pool.open()
+            start_prepare_stage(orchestrator_connection, run, pipeline)
+            work_queue(orchestrator_connection, run, session_pool, pipeline)
+            break  # Break retry loop
 
-            # Queue loop
-            while task_count < config.MAX_TASK_COUNT:
-                task_count += 1
-                queue_element = orchestrator_connection.get_next_queue_element(config.QUEUE_NAME)
+        # We actually want to catch all exceptions possible here.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as error:
+            error_count += 1
+            handle_process_error(orchestrator_connection, run, pipeline, error, error_count)
 
-                if not queue_element:
-                    orchestrator_connection.log_info("Queue empty.")
-                    break  # Break queue loop
+    returned = return_unprocessed(orchestrator_connection, run, pipeline) if run is not None and pipeline is not None else 0
+    return shut_down(orchestrator_connection, run, session_pool, pipeline,
+                     {"errors": error_count, "returned_to_queue": returned})
 
-                try:
-                    process.process(orchestrator_connection, queue_element)
-                    orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.DONE)
 
-                except BusinessError as error:
-                    handle_error("Business Error", error, queue_element, orchestrator_connection)
+class SharedConnection:  # pylint: disable=too-few-public-methods
+    """An OrchestratorConnection for several threads: its methods are called one at a time."""
 
-            break  # Break retry loop
+    def __init__(self, orchestrator_connection: OrchestratorConnection):
+        self._connection = orchestrator_connection
+        self._lock = threading.Lock()
 
-        # We actually want to catch all exceptions possible here.
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if not callable(attribute):
+            return attribute
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+
+@dataclass
+class QueuePipeline:  # pylint: disable=too-many-instance-attributes
+    """The stages around the SAP work: the prepare stage prefetches and writes the invoice files of the next
+    batches on its own SQL connection, the SAP work runs on the calling thread, and the done stage marks
+    finished queue elements. in_flight holds the queue elements that fail if the current step raises."""
+    prefetcher: Prefetcher
+    prepare_connection: ConnectionManager
+    prepared_queue: StageQueue
+    done_queue: StageQueue
+    done_stage: Stage
+    sap_timer: StageTimer
+    prepare_stage: Stage | None = None
+    queue_done: bool = False
+    in_flight: list = field(default_factory=list)
+
+    @classmethod
+    def start(cls, orchestrator_connection: OrchestratorConnection, connect: Callable[[], object] | None = None) -> "QueuePipeline":
+        """Set the stages up and start the done stage. The prepare stage is started by start_prepare_stage."""
+        prepare_connection = ConnectionManager(connect) if connect else ConnectionManager.from_orchestrator(orchestrator_connection)
+        prefetcher = Prefetcher(orchestrator_connection, prepare_connection, config.QUEUE_NAME,
+                                config.PREFETCH_LOOKAHEAD, config.PREFETCH_MAX_AGE_SECONDS, config.MAX_TASK_COUNT)
+        done_queue = StageQueue("done", config.PIPELINE_QUEUE_SIZE)
+        done_stage = Stage("done", lambda elements: mark_done(orchestrator_connection, elements), inbox=done_queue)
+        done_stage.start()
+        return cls(prefetcher, prepare_connection, StageQueue("prepared", config.PIPELINE_QUEUE_SIZE), done_queue,
+                   done_stage, StageTimer("sap"))
+
+    def take_prepared(self, count: int) -> tuple[list, Exception | None]:
+        """Wait for the next prepared batch and take up to count - 1 more that are ready, one per SAP session.
+        At the end of the prepared batches, returns the prepare stage's error or marks the queue as done."""
+        with self.sap_timer.measure("idle"):
+            items = [self.prepared_queue.get()]
+        # Give the other SAP sessions whatever is ready, without waiting for more
+        while items[-1] is not END and len(items) < count:
+            try:
+                items.append(self.prepared_queue.get(block=False))
+            except Empty:
+                break
+        source_error = None
+        if items[-1] is END:
+            items.pop()
+            source_error = self.prepare_stage.error
+            self.queue_done = source_error is None
+        return items, source_error
+
+
+def start_prepare_stage(orchestrator_connection: OrchestratorConnection, run: process.RunContext, pipeline: QueuePipeline) -> None:
+    """(Re)start the prepare stage if it isn't running, e.g. after a prefetch error."""
+    if pipeline.queue_done or (pipeline.prepare_stage is not None and pipeline.prepare_stage.is_alive()):
+        return
+    pipeline.prepare_connection.invalidate()
+    pipeline.prepare_stage = Stage("prepare", lambda: process.prepare_next(orchestrator_connection, pipeline.prefetcher, pipeline.prepare_connection, run.workspace, config.BATCH_SIZE),
+                                   outbox=pipeline.prepared_queue)
+    pipeline.prepare_stage.start()
+
+
+def work_queue(orchestrator_connection: OrchestratorConnection, run: process.RunContext, session_pool: SessionPool,
+               pipeline: QueuePipeline) -> None:
+    """Queue loop: run the prepared batches on the SAP sessions until the queue is empty, and send the
+    invoices whenever the send stage is due and once more at the end. Raises the first process error."""
+    while not pipeline.queue_done:
+        pipeline.in_flight = []
+        items, source_error = pipeline.take_prepared(session_pool.size)
+        if items:
+            pipeline.in_flight = [element.queue_element for item in items for element in item.batch]
+            with pipeline.sap_timer.measure("busy"):
+                process_error, failed_elements = process_items(orchestrator_connection, run, session_pool, items, pipeline.done_queue)
+            pipeline.sap_timer.items += len(items)
+            if process_error is not None:
+                pipeline.in_flight = failed_elements
+                raise process_error
+
+        if source_error is not None:
+            raise source_error
+
+        if run.send_stage.is_due():
+            send_invoices(orchestrator_connection, run, pipeline)
+
+    # Send whatever is left before leaving the queue loop
+    send_invoices(orchestrator_connection, run, pipeline)
+
+
+def send_invoices(orchestrator_connection: OrchestratorConnection, run: process.RunContext, pipeline: QueuePipeline) -> None:
+    """Send the pending invoices and pass the sent queue elements on to the done stage."""
+    pipeline.in_flight = run.send_stage.pending_elements()
+    pipeline.done_queue.put(process.send_pending(orchestrator_connection, run))
+    pipeline.in_flight = []
+
+
+def handle_process_error(orchestrator_connection: OrchestratorConnection, run: process.RunContext | None,
+                         pipeline: QueuePipeline | None, error: Exception, error_count: int) -> None:
+    """Fail the queue elements the error hit and leave the run ready for the next attempt.
+    run or pipeline is None when setting it up failed; no queue element has been taken then."""
+    if run is None or pipeline is None:
+        handle_error(f"Process Error #{error_count}", error, None, orchestrator_connection)
+        return
+    # Invoices waiting to be sent are in an unknown state after an error
+    failed_elements = pipeline.in_flight + [element for element in run.send_stage.pending_elements() if element not in pipeline.in_flight]
+    run.send_stage.clear()
+    pipeline.in_flight = []
+    # Start the next attempt on a fresh SQL connection
+    run.connection_manager.invalidate()
+    handle_error(f"Process Error #{error_count}", error, failed_elements, orchestrator_connection)
+    # Orders SAP has already saved must reach SQL before the next reset
+    flush_finalize_writer(run, orchestrator_connection)
+
+
+def return_unprocessed(orchestrator_connection: OrchestratorConnection, run: process.RunContext, pipeline: QueuePipeline) -> int:
+    """Put the queue elements the run took but never reached back in the queue as new: the batches the
+    prepare stage had ready and the elements still in the look-ahead buffer. SAP and SQL haven't been
+    touched for them, so the next run can take them again. Returns the number of elements put back."""
+    leftover = pipeline.prepare_stage.stop_source() if pipeline.prepare_stage is not None else []
+    for item in leftover:
+        if item.work is not None:
+            run.workspace.release(item.work.fakturafil)
+    unprocessed = [element.queue_element for item in leftover for element in item.batch] + pipeline.prefetcher.remaining()
+    for queue_element in unprocessed:
+        orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.NEW, "Ikke behandlet, robotten stoppede før elementet nåede frem. Lagt tilbage i køen.")
+    return len(unprocessed)
+
+
+def shut_down(orchestrator_connection: OrchestratorConnection, run: process.RunContext | None, session_pool: SessionPool,
+              pipeline: QueuePipeline | None, stats: dict) -> dict:
+    """Let the done stage finish, write back and send what is left, close the run's connections
+    and add the counters of every component to stats, which are logged and returned.
+    run and pipeline are None if they were never set up."""
+    if pipeline is not None:
+        pipeline.done_stage.finish_sink()
+    if run is not None:
+        flush_finalize_writer(run, orchestrator_connection)
+        run.drain_outbox(orchestrator_connection, config.OUTBOX_DRAIN_SECONDS)
+        stats["run"] = run.stats()
+        run.outbox.close()
+        run.connection_manager.close()
+        run.vejman_client.close()
+        run.pez_client.close()
+        run.workspace.close()
+    else:
+        stats["run"] = {}
+
+    timers, queues, prefetch = [], [], {}
+    if pipeline is not None:
+        pipeline.prepare_connection.close()
+        timers = [stage.timer for stage in (pipeline.prepare_stage, pipeline.done_stage) if stage is not None] + [pipeline.sap_timer]
+        queues = [pipeline.prepared_queue.stats(), pipeline.done_queue.stats()]
+        prefetch = pipeline.prefetcher.stats()
+    stats.update({
+        "prefetch": prefetch,
+        "stages": [timer.stats() for timer in timers],
+        "queues": queues,
+        "tekster_cache": TEKSTER_CACHE.stats(),
+        "sap_snapshots": dict(sap_screen.STATS, com_calls_saved=sap_screen.com_calls_saved()),
+        "spans": spans.summary(),
+        "error_reports": error_screenshot.REPORTER.close(),
+    })
+    log_stats(orchestrator_connection, stats)
+    session_pool.shutdown()
+    return stats
+
+
+def log_stats(orchestrator_connection: OrchestratorConnection, stats: dict) -> None:
+    """Log the run's counters and its spans, which hold all of its timings, and write the performance report."""
+    counters = {name: value for name, value in stats.items() if name not in ("stages", "spans")}
+    counters["stage_items"] = {stage["stage"]: stage["items"] for stage in stats["stages"]}
+    orchestrator_connection.log_info(f"Run counters: {counters}")
+    orchestrator_connection.log_info("Spans:\n" + spans.format_summary(stats["spans"]))
+    if config.PERFORMANCE_REPORT_FOLDER:
+        try:
+            report = spans.write_report(config.PERFORMANCE_REPORT_FOLDER)
+            orchestrator_connection.log_info(f"Performance report: {report}")
+        except OSError as exc:
+            orchestrator_connection.log_error(f"Performance report kunne ikke skrives: {exc}")
+
+
+def process_items(orchestrator_connection: OrchestratorConnection, run: process.RunContext, session_pool: SessionPool,
+                  items: list[process.PreparedBatch], done_queue: StageQueue) -> tuple[Exception | None, list]:
+    """Run the SAP work for prepared batches, one per session, and settle every batch on its own.
+    Skipped elements go to the done stage and business errors fail their own batch.
+
+    Returns:
+        The first other error, if any, and the queue elements of the batches that failed with such errors.
+    """
+    works = [item.work for item in items if item.work is not None]
+    try:
+        # Create the unknown debitors of these batches and everything in the look-ahead buffer in one go
+        process.create_debitors_ahead(orchestrator_connection, run, [element for item in items for element in item.batch] + items[-1].lookahead)
+        work_errors = process.process_batches(orchestrator_connection, works, run, session_pool)
+        run.finalize_writer.flush()
+    except BusinessError as error:
+        work_errors = [error] * len(works)
+    error_by_work = {id(work): error for work, error in zip(works, work_errors)}
+
+    pending = run.send_stage.pending_elements()
+    process_error, failed_elements = None, []
+    for item in items:
+        batch_elements = [element.queue_element for element in item.batch]
+        error = item.error or (error_by_work[id(item.work)] if item.work is not None else None)
+        if isinstance(error, BusinessError):
+            handle_error("Business Error", error, batch_elements, orchestrator_connection)
+        elif error is not None:
+            process_error = process_error or error
+            failed_elements += batch_elements
+        else:
+            # Elements that were skipped have nothing to send and are done right away
+            done_queue.put([queue_element for queue_element in batch_elements if queue_element not in pending])
+    return process_error, failed_elements
+
+
+def mark_done(orchestrator_connection: OrchestratorConnection, queue_elements: list) -> None:
+    """Done stage handler: mark queue elements as done. A failure is logged, so the stage keeps running."""
+    for queue_element in queue_elements:
+        try:
+            orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.DONE)
         # pylint: disable-next = broad-exception-caught
         except Exception as error:
-            error_count += 1
-            handle_error(f"Process Error #{error_count}", error, queue_element, orchestrator_connection)
+            orchestrator_connection.log_error(f"Kunne ikke markere køelement {queue_element.id} som færdigt: {error!r}")
 
-    reset.clean_up(orchestrator_connection)
-    reset.close_all(orchestrator_connection)
-    reset.kill_all(orchestrator_connection)
 
-    if config.FAIL_ROBOT_ON_TOO_MANY_ERRORS and error_count == config.MAX_RETRY_COUNT:
-        raise RuntimeError("Process failed too many times.")
+def flush_finalize_writer(run: process.RunContext, orchestrator_connection: OrchestratorConnection) -> None:
+    """Flush the buffered SQL write-back. If that fails, or rows were no longer TilFakturering, log the rows
+    so they can be fixed by hand."""
+    pending = run.finalize_writer.pending()
+    try:
+        run.finalize_writer.flush()
+    # The rows are logged instead, so the error must not stop the robot from shutting down.
+    # pylint: disable-next = broad-exception-caught
+    except Exception as error:
+        orchestrator_connection.log_error(f"Kunne ikke skrive ordrenumre tilbage til VejmanFakturering ({error!r}). (Ordrenummer, ID): {pending}")
+    not_updated = run.finalize_writer.pop_not_updated()
+    if not_updated:
+        orchestrator_connection.log_error(f"SQL rækker var ikke længere TilFakturering og er ikke opdateret; ordrerne findes i SAP. (Ordrenummer, ID): {not_updated}")
@@ -1,16 +1,32 @@
 """This module handles resetting the state of the computer so the robot can work with a clean slate."""
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
-from initialize_sap import initialize_sap
+from initialize_sap import initialize_sap, probe_sap_session, ShortcutCache
+from robot_framework import config
+import spans
 import subprocess
+import time
+
 
 def reset(orchestrator_connection: OrchestratorConnection) -> None:
-    """Clean up, close/kill all programs and start them again. """
+    """Clean up and make sure SAP is ready.
+    A healthy SAP session is reused as is. Only if the probe fails are all programs killed and started again."""
     orchestrator_connection.log_trace("Resetting.")
+    t0 = time.perf_counter()
     clean_up(orchestrator_connection)
-    close_all(orchestrator_connection)
-    kill_all(orchestrator_connection)
-    open_all(orchestrator_connection)
+
+    opus_user = orchestrator_connection.get_credential("OpusBruger").username
+    if probe_sap_session(opus_user):
+        path = "reuse"
+    else:
+        close_all(orchestrator_connection)
+        kill_all(orchestrator_connection)
+        open_all(orchestrator_connection)
+        path = "full"
+
+    elapsed = time.perf_counter() - t0
+    spans.record(f"reset.{path}", elapsed)
+    orchestrator_connection.log_info(f"Reset: {'genbrugte SAP-session' if path == 'reuse' else 'fuld genstart'} på {elapsed:.1f} s")
 
 
 def clean_up(orchestrator_connection: OrchestratorConnection) -> None:
@@ -35,6 +51,7 @@ def kill_all(orchestrator_connection: OrchestratorConnection) -> None:
 def open_all(orchestrator_connection: OrchestratorConnection) -> None:
     """Open all programs used by the robot."""
     orchestrator_connection.log_trace("Opening all applications.")
-    sap_running = initialize_sap(orchestrator_connection)
+    shortcut_cache = ShortcutCache(config.SAP_SHORTCUT_CACHE_FOLDER, config.SAP_SHORTCUT_VALIDITY_SECONDS)
+    sap_running = initialize_sap(orchestrator_connection, shortcut_cache)
     if not sap_running:
         raise Exception("SAP failed to launch succesfully")
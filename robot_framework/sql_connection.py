@@ -0,0 +1,87 @@
+"""This module contains a manager that keeps one SQL connection alive across queue elements."""
+
+import time
+from typing import Callable
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+
+
+class ConnectionManager:
+    """Hands out a single health-checked database connection and reconnects when it fails.
+
+    The connection is created by the given factory, so any DB-API connection works,
+    e.g. sqlite3.connect(":memory:") in place of SQL Server.
+    """
+
+    def __init__(self, connect: Callable[[], object], health_check_interval: float = 30.0):
+        """
+        Args:
+            connect: A function that opens a new connection.
+            health_check_interval: Seconds a connection may go unused before it is checked with SELECT 1.
+        """
+        self._connect = connect
+        self.health_check_interval = health_check_interval
+        self.connects = 0
+        self.reuses = 0
+        self.failed_checks = 0
+        self._conn = None
+        self._last_used = 0.0
+
+    @classmethod
+    def from_orchestrator(cls, orchestrator_connection: OrchestratorConnection) -> "ConnectionManager":
+        """Create a manager for the VejmanKassen database on the SqlServer constant."""
+        # Imported here so the manager can be used without the ODBC driver, e.g. with SQLite
+        import pyodbc  # pylint: disable=import-outside-toplevel
+
+        sql_server = orchestrator_connection.get_constant("SqlServer").value
+        conn_string = "DRIVER={SQL Server};"+f"SERVER={sql_server};DATABASE=VejmanKassen;Trusted_Connection=yes;"
+        return cls(lambda: pyodbc.connect(conn_string))
+
+    def get(self):
+        """Get a working connection, reusing the current one if it is still healthy."""
+        if self._conn is not None and not self._is_healthy():
+            self.failed_checks += 1
+            self.invalidate()
+
+        if self._conn is None:
+            self._conn = self._connect()
+            self.connects += 1
+        else:
+            self.reuses += 1
+
+        self._last_used = time.monotonic()
+        return self._conn
+
+    def invalidate(self) -> None:
+        """Close and forget the current connection, e.g. after a database error. The next get() reconnects."""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            # The connection is being thrown away, so any error closing it is irrelevant.
+            # pylint: disable-next = broad-exception-caught
+            except Exception:
+                pass
+        self._conn = None
+
+    def close(self) -> None:
+        """Close the connection at the end of the run."""
+        self.invalidate()
+
+    def stats(self) -> dict:
+        """Counters for the run."""
+        return {"connects": self.connects, "reuses": self.reuses, "failed_checks": self.failed_checks}
+
+    def _is_healthy(self) -> bool:
+        if time.monotonic() - self._last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            # Don't leave the check's transaction open on the shared connection
+            self._conn.commit()
+            return True
+        # Any error means the connection can't be trusted.
+        # pylint: disable-next = broad-exception-caught
+        except Exception:
+            return False
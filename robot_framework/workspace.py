@@ -0,0 +1,111 @@
+"""This module contains the per-run folder the robot writes its invoice and debitor files to."""
+
+import glob
+import os
+import shutil
+import threading
+import time
+
+import psutil
+
+# Files earlier versions of the robot left in the working directory
+LEGACY_PATTERNS = ("*_Fakturaer_*.csv", "*_Debitorer_CSV_*.csv")
+
+
+class Workspace:  # pylint: disable=too-many-instance-attributes
+    """A folder per robot run under `root`, e.g. root/run_20260101-120000_1234.
+
+    Opening the workspace sweeps what crashed runs left behind, closing it removes the run's
+    folder. A file is released when the robot is done with it: it is deleted, or moved to
+    root/failed if its step failed and keep_failed is set, so the input can be replayed.
+    Kept files are deleted after retention_days. Files are released one at a time, since the
+    prepare stage and the SAP session pool's workers release files from their own threads.
+    """
+
+    def __init__(self, root: str, keep_failed: bool = False, retention_days: float = 14):
+        self.root = os.path.abspath(root)
+        self.keep_failed = keep_failed
+        self.retention_days = retention_days
+        self.failed_folder = os.path.join(self.root, "failed")
+        self.folder = os.path.join(self.root, f"run_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}")
+        self.removed = 0
+        self.kept = 0
+        self.swept = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Workspace":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Sweep old runs and create this run's folder."""
+        self.sweep()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, filename: str) -> str:
+        """The absolute path of a file in this run's folder."""
+        return os.path.join(self.folder, filename)
+
+    def release(self, path: str, failed: bool = False) -> None:
+        """Delete a file the robot is done with, or keep it in the failed folder."""
+        with self._lock:
+            if not os.path.exists(path):
+                return
+            if failed and self.keep_failed:
+                os.makedirs(self.failed_folder, exist_ok=True)
+                shutil.move(path, os.path.join(self.failed_folder, os.path.basename(path)))
+                self.kept += 1
+            else:
+                os.remove(path)
+                self.removed += 1
+
+    def close(self) -> None:
+        """Release what is left in this run's folder as failed and remove the folder."""
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            self.release(os.path.join(self.folder, name), failed=True)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def sweep(self) -> None:
+        """Clean up after runs that didn't close their workspace, e.g. because the robot crashed.
+
+        Folders of runs whose process is gone are released as failed, like files left in the
+        working directory by earlier versions. Kept files past the retention are deleted.
+        """
+        leftovers = []
+        for run_folder in glob.glob(os.path.join(self.root, "run_*")):
+            if run_folder == self.folder or _owner_alive(run_folder):
+                continue
+            leftovers += [os.path.join(run_folder, name) for name in os.listdir(run_folder)]
+            leftovers.append(run_folder)
+        for pattern in LEGACY_PATTERNS:
+            leftovers += glob.glob(pattern)
+
+        for path in leftovers:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                self.release(path, failed=True)
+                self.swept += 1
+
+        cutoff = time.time() - self.retention_days * 24 * 60 * 60
+        for path in glob.glob(os.path.join(self.failed_folder, "*")):
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def stats(self) -> dict:
+        """Counters for the run."""
+        return {"removed": self.removed, "kept": self.kept, "swept": self.swept}
+
+
+def _owner_alive(run_folder: str) -> bool:
+    """Whether the process that created a run folder is still running."""
+    try:
+        pid = int(run_folder.rsplit("_", 1)[1])
+    except ValueError:
+        return False
+    return pid != os.getpid() and psutil.pid_exists(pid)
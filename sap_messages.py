@@ -0,0 +1,234 @@
+"""
+Parsing of the result screens of ZFI_FAKTURAGRUNDLAG and ZFIE_OPRETDEB.
+
+Every message grammar the robot understands is registered once, compiled at import time, in PATTERNS.
+Fixed phrases that only have to be found somewhere in a text are kept as lowercase strings,
+since a substring test is cheaper than a regex search.
+The parse functions take the label texts of a screen (ScreenSnapshot.labels()), go through
+them once and return a typed result. Deciding what to log and raise stays with the caller.
+"""
+
+from dataclasses import dataclass, field
+import re
+
+PATTERNS: dict[str, re.Pattern] = {}
+
+
+def register(name: str, pattern: str, flags: int = 0) -> re.Pattern:
+    """Compile a message grammar and add it to the registry under name."""
+    if name in PATTERNS:
+        raise ValueError(f"SAP message pattern '{name}' is already registered")
+    PATTERNS[name] = re.compile(pattern, flags)
+    return PATTERNS[name]
+
+
+# ZFI_FAKTURAGRUNDLAG
+FILE_OK = "input filen er fejlfri - klar til opdatering."
+ERROR_LIST_HEADER = "fejlliste vedr. indlæsning"
+ERROR_COLUMNS = "række fejltekst"
+ORDER_SAVED = register("order_saved", r"^KMD\s+Standardordre\s+(\d+)\s+gemt$", re.IGNORECASE)
+DEBITOR_INACTIVE = register(
+    "debitor_inactive", r"^(?:Ordregiver|Fakturamodtager)\s+(\d{10,})\s+er ikke aktiv i Salgsområde\s+\d+(?:\s\d+)*\.?$"
+)
+
+# ZFIE_OPRETDEB
+ALL_OK = "alt er ok"
+NOT_CORRECT = "ikke korrekt"
+# Spelled the way SAP shows it
+DEBITOR_CREATED = "Følgende debitorer er operttet korrekt"
+
+
+@dataclass(frozen=True)
+class ZfiTestResult:
+    """The test run of ZFI_FAKTURAGRUNDLAG. ok means the file can be updated; otherwise the
+    debitors SAP reported as not active, and error rows that are not about debitors.
+    Immutable, so every OK screen can share one result."""
+    ok: bool
+    inactive_debitors: tuple[str, ...] = ()
+    unexpected_rows: tuple[str, ...] = ()
+    unpaired: str | None = None
+
+
+FILE_OK_RESULT = ZfiTestResult(True)
+
+
+@dataclass
+class ZfiUpdateResult:
+    """The update run of ZFI_FAKTURAGRUNDLAG: the saved order numbers in file order,
+    and any other non-empty text after the 'Række Fejltekst' header."""
+    found_header: bool
+    order_ids: list[str] = field(default_factory=list)
+    unexpected: list[str] = field(default_factory=list)
+
+
+@dataclass
+class DebitorUpdateResult:
+    """The update run of ZFIE_OPRETDEB: the result lines after the '1' marker,
+    and the ones among them that don't say the debitor was created."""
+    found_marker: bool
+    lines: list[str] = field(default_factory=list)
+    not_created: list[str] = field(default_factory=list)
+
+
+def _debitor_number(raw_id: str) -> str:
+    """SAP reports debitors padded to 10 digits; the robot uses them without a leading '00'."""
+    return raw_id[2:] if raw_id.startswith("00") else raw_id
+
+
+def parse_zfi_test(labels: list[str]) -> ZfiTestResult:
+    """Read the result of a ZFI_FAKTURAGRUNDLAG test run.
+
+    The error list is a header, the column titles and then pairs of (row number, message).
+    """
+    # SAP shows the OK message as the first label, so a prefix test settles the common case
+    if labels and labels[0][:len(FILE_OK)].lower() == FILE_OK:
+        return FILE_OK_RESULT
+    # One lowercase copy of the screen; the newline keeps a match inside one label
+    if FILE_OK in "\n".join(labels).lower():
+        return FILE_OK_RESULT
+
+    items = [text.strip() for text in labels if text.strip()]
+    start = 0
+    if items and ERROR_LIST_HEADER in items[0].lower():
+        start = 1
+    if len(items) > start + 1 and ERROR_COLUMNS in items[start + 1].lower():
+        start += 2
+
+    inactive, unexpected_rows = {}, []
+    match_inactive = DEBITOR_INACTIVE.match
+    for index in range(start, len(items) - 1, 2):
+        row_number, message = items[index], items[index + 1]
+        match = match_inactive(message)
+        if match:
+            inactive[_debitor_number(match.group(1))] = None
+        else:
+            unexpected_rows.append(f"Række {row_number}: {message}")
+    unpaired = items[-1] if (len(items) - start) % 2 else None
+    return ZfiTestResult(False, tuple(inactive), tuple(unexpected_rows), unpaired)
+
+
+def parse_zfi_update(labels: list[str]) -> ZfiUpdateResult:
+    """Read the result of a ZFI_FAKTURAGRUNDLAG update run: every non-empty line after
+    'Række Fejltekst' must be 'KMD Standardordre <nr> gemt'."""
+    try:
+        split_idx = labels.index("Række Fejltekst")
+    except ValueError:
+        return ZfiUpdateResult(found_header=False)
+
+    result = ZfiUpdateResult(found_header=True)
+    match_order = ORDER_SAVED.match
+    for text in labels[split_idx + 1:]:
+        if text == "":  # empty is allowed, skip it
+            continue
+        match = match_order(text)
+        if match:
+            result.order_ids.append(match.group(1))
+        else:
+            result.unexpected.append(text)
+    return result
+
+
+def debitor_test_ok(labels: list[str]) -> bool:
+    """Whether a ZFIE_OPRETDEB test run says the file is fine."""
+    ok = False
+    for text in labels:
+        lowered = text.lower()
+        if NOT_CORRECT in lowered:
+            return False
+        ok = ok or ALL_OK in lowered
+    return ok
+
+
+def parse_debitor_update(labels: list[str]) -> DebitorUpdateResult:
+    """Read the result of a ZFIE_OPRETDEB update run: the lines after the marker '1'
+    ("      1" stripped) must all say the debitor was created."""
+    try:
+        marker_index = labels.index("1")
+    except ValueError:
+        return DebitorUpdateResult(found_marker=False)
+
+    lines = labels[marker_index + 1:]
+    return DebitorUpdateResult(
+        found_marker=True, lines=lines, not_created=[line for line in lines if DEBITOR_CREATED not in line]
+    )
+
+
+# Label lists as ScreenSnapshot.labels() returns them, recorded from the SAP screens
+RECORDED_SCREENS = {
+    "zfi_test_ok": ["Input filen er fejlfri - klar til opdatering.", ""],
+    "zfi_test_inactive": [
+        "Fejlliste vedr. indlæsning", "", "Fil: 2026-03-01_10-15-02-113_Fakturaer_4711.csv", "Række Fejltekst",
+        "1", "Ordregiver 0012345678 er ikke aktiv i Salgsområde 0020 20 20.",
+        "1", "Fakturamodtager 0012345678 er ikke aktiv i Salgsområde 0020 20 20.",
+        "3", "Ordregiver 1234567890 er ikke aktiv i Salgsområde 0020 20 20",
+    ],
+    "zfi_update": ["Opdatering", "Række Fejltekst"] + [f"KMD Standardordre {4500000 + n} gemt" for n in range(25)] + [""],
+    "opretdeb_test": ["Test af debitorfil", "Alt er OK", ""],
+    "opretdeb_update": ["Debitoroprettelse", "1"] + [
+        f"Følgende debitorer er operttet korrekt: {12345600 + n}" for n in range(10)
+    ],
+}
+
+
+if __name__ == "__main__":
+    # Check against and micro-benchmark with the old per-call parsing in create_invoices
+    import timeit
+
+    def legacy_zfi_test(texts):
+        """ZFI test parsing as create_invoices did it before sap_messages."""
+        combined = " | ".join(texts)
+        if "Input filen er fejlfri - klar til opdatering.".strip().lower() in combined.lower():
+            return True, []
+        items = [p.strip() for p in combined.split('|') if p.strip()]
+        if items and "fejlliste vedr. indlæsning" in items[0].lower():
+            items = items[1:]
+        if items and "række fejltekst" in items[1].lower():
+            items = items[2:]
+        rows = []
+        i = 0
+        while i + 1 < len(items):
+            rows.append((items[i], items[i + 1]))
+            i += 2
+        valid_patterns = [
+            r"^Ordregiver\s+(\d{10,})\s+er ikke aktiv i Salgsområde\s+\d+(?:\s\d+)*\.?$",
+            r"^Fakturamodtager\s+(\d{10,})\s+er ikke aktiv i Salgsområde\s+\d+(?:\s\d+)*\.?$"
+        ]
+        extracted_ids = set()
+        for _, message in rows:
+            for pattern in valid_patterns:
+                match = re.match(pattern, message)
+                if match:
+                    raw_id = match.group(1)
+                    extracted_ids.add(raw_id[2:] if raw_id.startswith("00") else raw_id)
+                    break
+        return False, sorted(extracted_ids)
+
+    def legacy_zfi_update(texts):
+        """ZFI update parsing as create_invoices did it before sap_messages."""
+        after = texts[texts.index("Række Fejltekst") + 1:]
+        pat = re.compile(r"^KMD\s+Standardordre\s+(\d+)\s+gemt$", re.IGNORECASE)
+        return [m.group(1) for m in (pat.match(text) for text in after if text != "") if m]
+
+    def zfi_test_outcome(texts):
+        """parse_zfi_test's result in the shape legacy_zfi_test returns."""
+        result = parse_zfi_test(texts)
+        return result.ok, sorted(result.inactive_debitors)
+
+    assert zfi_test_outcome(RECORDED_SCREENS["zfi_test_inactive"]) == (False, ["12345678", "1234567890"])
+    # (screen, old parser, new parser, new result in the old parser's shape)
+    CASES = [
+        ("zfi_test_ok", legacy_zfi_test, parse_zfi_test, zfi_test_outcome),
+        ("zfi_test_inactive", legacy_zfi_test, parse_zfi_test, zfi_test_outcome),
+        ("zfi_update", legacy_zfi_update, parse_zfi_update, lambda texts: parse_zfi_update(texts).order_ids),
+    ]
+    NUMBER = 20_000
+    for screen, legacy, new, outcome in CASES:
+        screen_labels = RECORDED_SCREENS[screen]
+        assert legacy(screen_labels) == outcome(screen_labels), screen
+        legacy_time = timeit.timeit(lambda parse=legacy, texts=screen_labels: parse(texts), number=NUMBER)
+        new_time = timeit.timeit(lambda parse=new, texts=screen_labels: parse(texts), number=NUMBER)
+        print(f"{screen:18} old: {legacy_time / NUMBER * 1e6:6.2f} µs  new: {new_time / NUMBER * 1e6:6.2f} µs "
+              f"(old/new {legacy_time / new_time:.1f}x)")
+
+    assert debitor_test_ok(RECORDED_SCREENS["opretdeb_test"])
+    assert not parse_debitor_update(RECORDED_SCREENS["opretdeb_update"]).not_created
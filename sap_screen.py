@@ -0,0 +1,131 @@
+"""Snapshots of SAP GUI screens, so the parsers don't read the same COM properties again and again.
+
+ScreenSnapshot.capture reads the Id and Text of every child of a container once. The control
+type is taken from the Id prefix where possible. The parsers in create_invoices, send_invoices
+and sap_messages then work on the snapshot's lists and indexes. STATS counts the COM reads a
+run made and the ones the snapshots saved.
+"""
+
+import re
+
+from sap_sessions import scripting_errors
+
+# Id prefixes that identify the control type, so Type doesn't have to be read over COM
+TYPE_BY_PREFIX = {
+    "lbl": "GuiLabel",
+    "txt": "GuiTextField",
+    "ctxt": "GuiCTextField",
+    "pwd": "GuiPasswordField",
+    "chk": "GuiCheckBox",
+    "rad": "GuiRadioButton",
+    "btn": "GuiButton",
+    "cmb": "GuiComboBox",
+    "box": "GuiBox",
+    "tbl": "GuiTableControl",
+}
+
+LBL_RE = re.compile(r".*/lbl\[(\d+),(\d+)\]$")
+_PREFIX_RE = re.compile(r"([a-z]+)[^/]*$")
+
+# Run totals of property reads (Id, Text, Type) over COM. com_calls is what the snapshots
+# actually read; reads_served is what reading each value from the controls would have cost.
+STATS = {"com_calls": 0, "reads_served": 0}
+
+
+def com_calls_saved() -> int:
+    """How many COM property reads the snapshots have saved so far in this run."""
+    return STATS["reads_served"] - STATS["com_calls"]
+
+
+class ScreenSnapshot:
+    """
+    The children of a SAP GUI container, read once.
+    Every child's Id and Text are read over COM exactly once and kept in parallel lists.
+    The type comes from the Id prefix where possible, otherwise Type is read once too.
+    Lookups by lbl[col,row] and by text are served from indexes.
+    """
+
+    __slots__ = ("ids", "types", "texts", "_cells", "_by_text")
+
+    def __init__(self, ids: list[str], types: list[str], texts: list[str]):
+        self.ids = ids
+        self.types = types
+        self.texts = texts
+        self._cells = {}
+        self._by_text = {}
+        for index, (child_id, text) in enumerate(zip(ids, texts)):
+            m = LBL_RE.match(child_id)
+            if m:
+                self._cells[(int(m.group(1)), int(m.group(2)))] = index
+            self._by_text.setdefault(text, []).append(index)
+
+    @classmethod
+    def capture(cls, container) -> "ScreenSnapshot":
+        """Read all children of a container, e.g. session.findById("wnd[0]/usr")."""
+        ids, types, texts = [], [], []
+        calls = 0
+        for child in container.Children:
+            child_id = child.Id
+            calls += 1
+            m = _PREFIX_RE.search(child_id)
+            child_type = TYPE_BY_PREFIX.get(m.group(1)) if m else None
+            if child_type is None:
+                try:
+                    child_type = child.Type
+                except scripting_errors():
+                    child_type = ""
+                calls += 1
+            try:
+                text = (child.Text or "").strip()
+            except scripting_errors():
+                text = ""
+            calls += 1
+            ids.append(child_id)
+            types.append(child_type)
+            texts.append(text)
+        STATS["com_calls"] += calls
+        return cls(ids, types, texts)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def labels(self) -> list[str]:
+        """Texts of all labels (children with 'lbl' in their Id), in screen order."""
+        result = [text for child_id, text in zip(self.ids, self.texts) if "lbl" in child_id]
+        STATS["reads_served"] += len(self.ids) + len(result)  # Id of every child, Text of each label
+        return result
+
+    def texts_of_type(self, child_type: str) -> list[str]:
+        """Texts of all children of the given type, in screen order."""
+        result = [text for t, text in zip(self.types, self.texts) if t == child_type]
+        STATS["reads_served"] += len(self.ids) + len(result)  # Type of every child, Text of each match
+        return result
+
+    def cells(self) -> list[tuple[int, int, str, str]]:
+        """All lbl[col,row] labels as (col, row, text, id)."""
+        result = [(col, row, self.texts[index], self.ids[index]) for (col, row), index in self._cells.items()]
+        STATS["reads_served"] += len(self.ids) + 2 * len(result)  # Id of every child, Id and Text of each cell
+        return result
+
+    def cell(self, col: int, row: int) -> str | None:
+        """Text of the label at lbl[col,row], or None if there is none."""
+        index = self._cells.get((col, row))
+        if index is None:
+            return None
+        STATS["reads_served"] += 1
+        return self.texts[index]
+
+    def non_grid_labels(self) -> list[tuple[str, str]]:
+        """(id, text) of labels that are not in the lbl[col,row] grid."""
+        grid = set(self._cells.values())
+        result = [
+            (self.ids[index], self.texts[index])
+            for index in range(len(self.ids))
+            if "lbl" in self.ids[index] and index not in grid
+        ]
+        STATS["reads_served"] += 2 * len(result)  # Id and Text of each label
+        return result
+
+    def find_text(self, text: str) -> list[str]:
+        """Ids of all children with exactly this text."""
+        return [self.ids[index] for index in self._by_text.get(text, [])]
@@ -0,0 +1,158 @@
+"""SAP GUI sessions for the SAP modules, and a pool to run work on several sessions at once.
+
+SAP allows several sessions per connection. COM objects can't be passed between threads,
+so the pool hands out session ids ("/app/con[0]/ses[1]") and every worker thread looks its
+session up in its own COM apartment.
+
+Where the scripting engine comes from is up to the provider. The default is the SAP GUI
+running on this workstation; set_provider() swaps in another, e.g. fake_sap.FakeSapGui
+to run the SAP steps without SAP.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from sap_wait import wait_ready
+
+# SAP doesn't allow more sessions per connection than this
+MAX_SESSIONS = 6
+
+
+class SapGuiProvider:
+    """The SAP GUI on this workstation, over COM."""
+
+    def application(self):
+        """The scripting engine (GuiApplication)."""
+        # Imported here so the SAP modules can be imported where pywin32 isn't installed
+        import win32com.client  # pylint: disable=import-outside-toplevel
+        return win32com.client.GetObject("SAPGUI").GetScriptingEngine
+
+    def init_thread(self) -> None:
+        """Prepare a worker thread to use the scripting engine."""
+        import pythoncom  # pylint: disable=import-outside-toplevel
+        pythoncom.CoInitialize()
+
+    def error_types(self) -> tuple[type, ...]:
+        """The exceptions a scripting call raises when SAP or a control isn't there."""
+        import pywintypes  # pylint: disable=import-outside-toplevel
+        return (pywintypes.com_error, AttributeError)
+
+
+_provider = SapGuiProvider()
+
+
+def set_provider(provider) -> object:
+    """Use provider for every SAP session from now on and return the one it replaces.
+    A provider has application() and init_thread() like SapGuiProvider."""
+    global _provider  # pylint: disable=global-statement
+    previous, _provider = _provider, provider
+    return previous
+
+
+def get_application():
+    """The scripting engine of the current provider."""
+    return _provider.application()
+
+
+def scripting_errors() -> tuple[type, ...]:
+    """The exceptions that mean a session isn't usable: the provider's scripting errors, and
+    TimeoutError from a session that doesn't get ready."""
+    return _provider.error_types() + (TimeoutError,)
+
+
+def return_to_start(session, timeout: float = 10.0) -> bool:
+    """Leave whatever transaction a session is in with /n. Returns False if the session is busy,
+    has a popup open or doesn't get back to its main window."""
+    if session.Busy or session.ActiveWindow.Name != "wnd[0]":
+        return False
+    session.findById("wnd[0]/tbar[0]/okcd").text = "/n"
+    session.findById("wnd[0]").sendVKey(0)
+    wait_ready(session, timeout=timeout, step="session nulstil")
+    return session.ActiveWindow.Name == "wnd[0]"
+
+
+def get_session(session_id: str | None = None):
+    """The session with the given id, or the first session of the first connection."""
+    application = get_application()
+    if session_id is None:
+        return application.Children(0).Children(0)
+    return application.findById(session_id)
+
+
+class SessionPool:
+    """
+    N sessions on the logged in SAP connection, each owned by one worker thread.
+    open() runs after every reset: the first session has been checked by the reset, the other
+    sessions are sent back to their start screen, or closed if they can't be, and the missing
+    ones are created. map() runs one item per session and returns every item's result or error,
+    so they stay tied to the right item.
+    """
+
+    def __init__(self, size: int = 1):
+        if not 1 <= size <= MAX_SESSIONS:
+            raise ValueError(f"SAP session count must be between 1 and {MAX_SESSIONS}, got {size}")
+        self.size = size
+        self.session_ids: list[str] = []
+        self.reopened = 0
+        self._executor = None
+
+    def open(self, timeout: float = 60.0) -> list[str]:
+        """Make sure the connection has `size` sessions at their start screen and return their ids."""
+        connection = get_application().Children(0)
+        first = connection.Children(0)
+        # Sessions an error left in a transaction or behind a popup are reset, or closed and opened again
+        for index in range(min(connection.Children.Count, self.size) - 1, 0, -1):
+            session = connection.Children(index)
+            try:
+                usable = return_to_start(session)
+            except scripting_errors():
+                usable = False
+            if not usable:
+                connection.CloseSession(session.Id)
+                self.reopened += 1
+        while connection.Children.Count < self.size:
+            count = connection.Children.Count
+            first.createSession()
+            deadline = time.monotonic() + timeout
+            while connection.Children.Count <= count:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"SAP didn't open session {count + 1} within {timeout} seconds")
+                time.sleep(0.1)
+        self.session_ids = [connection.Children(i).Id for i in range(self.size)]
+        for session_id in self.session_ids:
+            wait_ready(connection.findById(session_id), step="session åbn")
+
+        if self._executor is None and self.size > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="sap", initializer=_provider.init_thread)
+        return self.session_ids
+
+    def map(self, fn, items: list) -> list[tuple[object, BaseException | None]]:
+        """Run fn(session, item) for every item, each on its own session.
+
+        A single item is run on the first session in the calling thread. Otherwise fn runs in
+        the worker threads at the same time, so what it shares with them must be thread safe.
+
+        Returns:
+            (result, None) or (None, error) per item, in the order of the items.
+        """
+        if len(items) > max(len(self.session_ids), 1):
+            raise ValueError(f"{len(items)} items but only {len(self.session_ids)} SAP sessions")
+        if len(items) <= 1 or self._executor is None:
+            return [self._call(fn, session_id, item) for session_id, item in zip(self.session_ids or [None], items)]
+        futures = [self._executor.submit(self._call, fn, session_id, item) for session_id, item in zip(self.session_ids, items)]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _call(fn, session_id, item):
+        try:
+            return fn(get_session(session_id), item), None
+        # The error belongs to this item and is returned with it.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as error:
+            return None, error
+
+    def shutdown(self) -> None:
+        """Stop the worker threads. The sessions close with SAP."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
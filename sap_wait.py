@@ -0,0 +1,73 @@
+"""Readiness waits shared by every SAP GUI module.
+
+A wait checks the session's Busy flag and, if asked, that an element can be found.
+The first checks follow right after each other and the delay then grows up to
+MAX_DELAY, so quick screens return at once while slow ones are not polled hard.
+How long each wait took is recorded in the span sap_wait.<step>. The backoff state lives
+in each call, so workers on different sessions wait independently.
+"""
+
+import time
+
+import spans
+
+# Delays between checks: immediate retries first, then backing off to MAX_DELAY
+FIRST_DELAYS = (0.0, 0.01, 0.02, 0.05, 0.1)
+MAX_DELAY = 0.25
+
+
+def _delays():
+    yield from FIRST_DELAYS
+    while True:
+        yield MAX_DELAY
+
+
+def _record(step: str, elapsed: float, timed_out: bool = False) -> None:
+    spans.record(f"sap_wait.{step}", elapsed, timed_out)
+
+
+def _scripting_errors() -> tuple[type, ...]:
+    # Imported here, since sap_sessions uses the waits. Only looked up when a read has failed.
+    from sap_sessions import scripting_errors  # pylint: disable=import-outside-toplevel
+    return scripting_errors()
+
+
+def _is_busy(session) -> bool:
+    try:
+        return bool(session.Busy)
+    except _scripting_errors():
+        # Busy can't be read while SAP is switching screens
+        return True
+
+
+def wait_ready(session, timeout: float = 60.0, step: str = "ready") -> float:
+    """Wait until the SAP session is not busy. Returns the seconds waited."""
+    t0 = time.perf_counter()
+    delays = _delays()
+    while True:
+        if not _is_busy(session):
+            elapsed = time.perf_counter() - t0
+            _record(step, elapsed)
+            return elapsed
+        if time.perf_counter() - t0 > timeout:
+            _record(step, time.perf_counter() - t0, timed_out=True)
+            raise TimeoutError("SAP session stayed busy for too long.")
+        time.sleep(next(delays))
+
+
+def wait_for_element(session, element_id: str, timeout: float = 10, step: str | None = None):
+    """Wait until the session is not busy and the element exists, then return it."""
+    t0 = time.perf_counter()
+    delays = _delays()
+    while True:
+        if not _is_busy(session):
+            try:
+                el = session.findById(element_id)
+                _record(step or element_id, time.perf_counter() - t0)
+                return el
+            except _scripting_errors():
+                pass
+        if time.perf_counter() - t0 > timeout:
+            _record(step or element_id, time.perf_counter() - t0, timed_out=True)
+            raise TimeoutError(f"Element {element_id} not found after {timeout} seconds")
+        time.sleep(next(delays))
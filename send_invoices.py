@@ -1,24 +1,12 @@
-import win32com.client
 from datetime import datetime
-import time
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
-import re
 from collections import defaultdict, OrderedDict
 
-# --- Helpers ---
-def wait_ready(session, timeout=60.0, poll=0.1):
-    """Wait until SAP session is not busy or timeout."""
-    t0 = time.time()
-    while True:
-        try:
-            if not session.Busy:
-                return
-        except Exception:
-            pass
-        if time.time() - t0 > timeout:
-            raise TimeoutError("SAP session stayed busy for too long.")
-        time.sleep(poll)
+from sap_screen import ScreenSnapshot
+from sap_wait import wait_for_element, wait_ready
+from sap_sessions import get_session
 
+# --- Helpers ---
 def press_with_tooltip(session, btn_id: str, expected_tooltip_substring: str):
     """Verify tooltip contains expected text, then press."""
     btn = session.findById(btn_id)
@@ -31,12 +19,62 @@ def norm_header(s: str) -> str:
         # Normalize headers like "Opret. d." -> "Opret. d." (keep dots), but trim/space-normalize
         return " ".join((s or "").strip().split())
 
-def send_invoice(orchestrator_connection: OrchestratorConnection):
+# Headers the order number column of ZVF04 can have, normalized like is_fejl does
+ORDER_HEADERS = ("ordre", "ordrenr", "ordrenummer", "salgsordre", "salgsdok", "salgsbilag")
+
+
+def order_header(column_names):
+    """The header of the column holding the order number, or None if the table has none."""
+    for name in column_names:
+        if name.lower().strip(".:") in ORDER_HEADERS:
+            return name
+    return None
+
+
+def is_fejl_header(name: str) -> bool:
+    """Whether a header is the Fejl column (case-insensitive, punctuation tolerant)."""
+    return name.lower().strip(".:") == "fejl"
+
+
+def missing_columns(column_names, need_order_column: bool) -> list[str]:
+    """The columns send_invoice reads that the ZVF04 header row doesn't have."""
+    missing = [] if any(is_fejl_header(name) for name in column_names) else ["Fejl"]
+    if need_order_column and order_header(column_names) is None:
+        missing.append("ordrenummer")
+    return missing
+
+
+def match_orders(table_rows, expected_orders, order_column):
+    """Ties each expected order number to the ZVF04 row that lists it in the order number column.
+    Order numbers are compared without leading zeros, since SAP pads them."""
+    wanted = {str(order).strip().lstrip("0"): order for order in expected_orders}
+    matched = {}
+    for record in table_rows:
+        key = (record.get(order_column) or "").strip().lstrip("0")
+        if key in wanted and wanted[key] not in matched:
+            matched[wanted[key]] = record
+    return matched
+
+
+def send_invoice(orchestrator_connection: OrchestratorConnection, expected_orders=None, invoice_date: datetime | None = None, session=None):
+    """Sends every invoice the robot user created on the invoice date in one ZVF04 pass.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        expected_orders: Order numbers that should be in the ZVF04 list. Each one is tied back to
+            its row by the order number column. The list is sent as a whole, so a missing order
+            is logged and left out of the result instead of failing the orders that were sent.
+            The columns are checked before anything is sent; if the table can't be read after
+            saving, the problem is logged and every expected order counts as sent.
+        invoice_date: The date the invoices were created. Defaults to today.
+        session: The SAP session to use. Defaults to the first session.
+
+    Returns:
+        A dict mapping each expected order number that was found to its ZVF04 row
+        (an empty row if the table couldn't be read after saving).
+    """
     # --- SAP session ---
-    SapGuiAuto = win32com.client.GetObject("SAPGUI")
-    application = SapGuiAuto.GetScriptingEngine
-    connection = application.Children(0)
-    session = connection.Children(0)
+    session = session or get_session()
 
     # --- Get robot username from Orchestrator (you already have this available) ---
     RobotCredential = orchestrator_connection.get_credential("OpusBruger")
@@ -46,11 +84,11 @@ def send_invoice(orchestrator_connection: OrchestratorConnection):
     session.findById("wnd[0]/tbar[0]/okcd").text = "ZVF04"
     session.findById("wnd[0]").sendVKey(0)
     session.findById("wnd[0]").sendVKey(0)  # Enter
-    wait_ready(session)
+    wait_ready(session, step="ZVF04 åbn")
 
     # --- Fill fields ---
-    today = datetime.today().strftime("%d.%m.%Y")  # dd.MM.yyyy
-    date_field = session.findById("wnd[0]/usr/ctxtP_FKDAT")
+    today = (invoice_date or datetime.today()).strftime("%d.%m.%Y")  # dd.MM.yyyy
+    date_field = wait_for_element(session, "wnd[0]/usr/ctxtP_FKDAT")
     date_field.text = today
     date_field.caretPosition = len(today)
 
@@ -60,38 +98,30 @@ def send_invoice(orchestrator_connection: OrchestratorConnection):
 
     # Press the "Execute/Check" type button (btn[8]) on the app toolbar
     session.findById("wnd[0]/tbar[1]/btn[8]").press()
-    wait_ready(session)
+    wait_ready(session, step="ZVF04 udfør")
+
+    # --- Check the columns before anything is sent: after Gem the invoices are out either way ---
+    listed = ScreenSnapshot.capture(session.findById("wnd[0]/usr")).cells()
+    listed_headers = [norm_header(text) for _, row, text, _ in sorted(listed) if row == 1]
+    missing = missing_columns(listed_headers, expected_orders is not None)
+    if missing:
+        orchestrator_connection.log_error(f"ZVF04-listen mangler kolonnerne {missing}, intet er sendt. Header-række: {listed_headers}")
+        raise RuntimeError(f"ZVF04-listen mangler kolonnerne {missing}, intet er sendt. Header-række: {listed_headers}")
 
-        
     # --- Verify and press "Marker alle (F5)" -> btn[5] ---
     press_with_tooltip(session, "wnd[0]/tbar[1]/btn[5]", "Marker alle   (F5)")
-    wait_ready(session)
+    wait_ready(session, step="ZVF04 marker alle")
 
     # --- Verify and press "Gem (Ctrl+S)" -> btn[11] ---
     press_with_tooltip(session, "wnd[0]/tbar[0]/btn[11]", "Gem   (Ctrl+S)")
-    wait_ready(session)
-
-    container = session.findById("/app/con[0]/ses[0]/wnd[0]/usr")
+    wait_ready(session, step="ZVF04 gem")
 
-    LBL_RE = re.compile(r".*/lbl\[(\d+),(\d+)\]$")
+    container = session.findById("wnd[0]/usr")
+    snapshot = ScreenSnapshot.capture(container)
 
-
-    cells = []          # (col:int, row:int, text:str, id:str)
-    non_table_labels = []
-
-    for child in container.Children:
-        if "lbl" in child.Id:
-            m = LBL_RE.match(child.Id)
-            if not m:
-                # Label under usr but not in the lbl[i,j] grid -> not part of table
-                non_table_labels.append((child.Id, getattr(child, "Text", "").strip()))
-                continue
-            col, row = int(m.group(1)), int(m.group(2))
-            try:
-                text = (child.Text or "").strip()
-            except Exception:
-                text = ""
-            cells.append((col, row, text, child.Id))
+    cells = snapshot.cells()          # (col:int, row:int, text:str, id:str)
+    # Labels under usr but not in the lbl[i,j] grid -> not part of table
+    non_table_labels = snapshot.non_grid_labels()
     for col, row, text, _ in sorted(cells, key=lambda x: (x[1], x[0])):
         orchestrator_connection.log_info(f"[{col},{row}] '{text}'")
     # Make sure we only have table labels 
@@ -138,12 +168,9 @@ def send_invoice(orchestrator_connection: OrchestratorConnection):
     column_names = [headers[c] for c in sorted_cols]
 
     # Find Fejl column (case-insensitive, punctuation tolerant)
-    def is_fejl(h):
-        return h.lower().strip(".:") == "fejl"
-
     fejl_col = None
     for c in sorted_cols:
-        if is_fejl(headers[c]):
+        if is_fejl_header(headers[c]):
             fejl_col = c
             break
 
@@ -186,6 +213,23 @@ def send_invoice(orchestrator_connection: OrchestratorConnection):
             + (" ..." if len(bad_fejl) > 10 else "")
         )
 
+    # Tie the rows back to the orders created during the run
+    matched_orders = {}
+    if expected_orders is not None:
+        order_column = order_header(column_names)
+        if order_column is None:
+            # The list had the column before Gem, so the invoices are sent; failing them now would hide that
+            orchestrator_connection.log_error(f"Ordrekolonnen blev ikke fundet i header-rækken efter afsendelse: {column_names}. "
+                                              f"Ordrerne regnes som sendt: {list(expected_orders)}")
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+            session.findById("wnd[0]/tbar[0]/btn[12]").press()
+            return {order: OrderedDict() for order in expected_orders}
+        matched_orders = match_orders(table_rows, expected_orders, order_column)
+        missing = [order for order in expected_orders if order not in matched_orders]
+        if missing:
+            orchestrator_connection.log_error(f"Ordrenumre blev ikke fundet i ZVF04 og er ikke sendt: {missing}")
+        orchestrator_connection.log_info(f"{len(matched_orders)} ordre(r) fundet og afsendt i ZVF04 ud af {len(table_rows)} række(r)")
+
     # print("Tabel verificeret (kun grid-labels, korrekt header/data-rækker).")
     # print(f"Kolonner: {column_names}")
     # print(f"Antal rækker: {len(table_rows)}")
@@ -195,4 +239,4 @@ def send_invoice(orchestrator_connection: OrchestratorConnection):
     #     orchestrator_connection.log_info(f"Row {idx}: {dict(rec)}")
     session.findById("wnd[0]/tbar[0]/btn[12]").press()
     session.findById("wnd[0]/tbar[0]/btn[12]").press()
-
+    return matched_orders
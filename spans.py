@@ -0,0 +1,170 @@
+"""Timing spans for the robot's stages, aggregated in memory into one summary per run.
+
+Wrap a stage in `with span("sap.zfi_fakturagrundlag"):` or decorate a function with
+`@span("initialize_sap.launch")`. Each span records its duration into a histogram under its
+name; nothing is kept per call, so a span costs two clock reads and a short locked update.
+Names are dotted, the first part being the system the time was spent in: sql, sap, sap_wait,
+vejman, pez, prepare, reset, initialize_sap or pipeline (a stage's busy, idle and blocked time).
+
+summary() gives count, errors, total and mean, p50/p95 (estimated from the histogram) and max
+per span. write_report() writes it to a JSON file for the run and appends it to a CSV file,
+so runs can be compared over time.
+"""
+
+from bisect import bisect_left
+import csv
+import functools
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds. The last bucket takes everything above.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+BUCKET_LABELS = tuple(f"le_{bound:g}s" for bound in BUCKETS) + (f"gt_{BUCKETS[-1]:g}s",)
+CSV_FIELDS = ("run", "span", "count", "errors", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms")
+
+
+class _Histogram:  # pylint: disable=too-few-public-methods
+    __slots__ = ("count", "errors", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket holding the p'th percentile, capped at the largest value seen."""
+        rank = p / 100 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+
+_histograms: dict[str, _Histogram] = {}
+_lock = threading.Lock()
+
+
+def record(name: str, seconds: float, error: bool = False) -> None:
+    """Add a duration to the span's histogram, e.g. one measured elsewhere."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.count += 1
+        histogram.errors += error
+        histogram.total += seconds
+        histogram.max = max(histogram.max, seconds)
+        histogram.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+class span:  # pylint: disable=invalid-name
+    """Time a with-block or, as a decorator, every call of a function. A block that raises counts as an error."""
+
+    __slots__ = ("name", "_t0")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._t0 = 0.0
+
+    def __enter__(self) -> "span":
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        record(self.name, time.perf_counter() - self._t0, exc_type is not None)
+
+    def __call__(self, function):
+        name = self.name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                record(name, time.perf_counter() - t0, error)
+        return wrapper
+
+
+def summary() -> dict:
+    """Per span, sorted by name: count, errors, total seconds, mean/p50/p95/max in ms and the histogram."""
+    with _lock:
+        return {
+            name: {
+                "count": histogram.count, "errors": histogram.errors, "total_s": round(histogram.total, 3),
+                "mean_ms": round(histogram.total / histogram.count * 1000, 1),
+                "p50_ms": round(histogram.percentile(50) * 1000, 1),
+                "p95_ms": round(histogram.percentile(95) * 1000, 1),
+                "max_ms": round(histogram.max * 1000, 1),
+                "histogram": {label: n for label, n in zip(BUCKET_LABELS, histogram.buckets) if n},
+            }
+            for name, histogram in sorted(_histograms.items())
+        }
+
+
+def reset() -> None:
+    """Forget all spans, e.g. between benchmark runs in one process."""
+    with _lock:
+        _histograms.clear()
+
+
+def write_report(folder: str, run_name: str | None = None) -> str:
+    """Write the summary to folder/<run>.json and append one row per span to folder/spans.csv.
+    Returns the path of the JSON file."""
+    run_name = run_name or time.strftime("%Y%m%d-%H%M%S")
+    spans = summary()
+    os.makedirs(folder, exist_ok=True)
+    json_path = os.path.join(folder, f"{run_name}.json")
+    with open(json_path, "w", encoding="utf-8") as file:
+        json.dump({"run": run_name, "spans": spans}, file, indent=2)
+
+    csv_path = os.path.join(folder, "spans.csv")
+    new_file = not os.path.exists(csv_path)
+    with open(csv_path, "a", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, CSV_FIELDS, extrasaction="ignore", delimiter=";")
+        if new_file:
+            writer.writeheader()
+        writer.writerows({"run": run_name, "span": name, **values} for name, values in spans.items())
+    return json_path
+
+
+def format_summary(spans: dict | None = None) -> str:
+    """The summary as one line per span, for the orchestrator log."""
+    spans = summary() if spans is None else spans
+    return "\n".join(
+        f"{name}: {values['count']}x, {values['total_s']} s i alt, p50 {values['p50_ms']} ms, "
+        f"p95 {values['p95_ms']} ms, max {values['max_ms']} ms" + (f", {values['errors']} fejl" if values["errors"] else "")
+        for name, values in spans.items()
+    )
+
+
+if __name__ == "__main__":
+    # Overhead of a span on the hot path
+    import timeit
+
+    NUMBER = 200_000
+
+    def timed_block():
+        """An empty block timed with the context manager."""
+        with span("benchmark.block"):
+            pass
+
+    @span("benchmark.decorated")
+    def decorated():
+        """An empty function timed with the decorator."""
+
+    base = timeit.timeit(lambda: None, number=NUMBER)
+    block = timeit.timeit(timed_block, number=NUMBER)
+    call = timeit.timeit(decorated, number=NUMBER)
+    print(f"with span(): {(block - base) / NUMBER * 1e6:.2f} µs per span")
+    print(f"@span:       {(call - base) / NUMBER * 1e6:.2f} µs per call")
+    print(format_summary())
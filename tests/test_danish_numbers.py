@@ -0,0 +1,50 @@
+"""Golden output of danish_numbers, as the locale path and PEZClient's old formatting gave it."""
+
+import pytest
+
+from danish_numbers import format_amount, format_decimal, format_number
+
+# (value, decimals, expected) for format_decimal, as the locale path formatted them
+GOLDEN_DECIMALS = [
+    (0, None, "0"), (7, None, "7"), (-3, None, "-3"), (1234567, None, "1234567"),
+    (12, 3, "12,000"), (31, 3, "31,000"), (5, 2, "5,00"),
+    (19.0, None, "19"), (-2.0, None, "-2"), (0.0, None, "0"), (1234567.0, None, "1234567"),
+    (12.5, None, "12,50"), (3.25, None, "3,25"), (0.1, None, "0,10"), (-0.5, None, "-0,50"),
+    (1234.5678, None, "1234,57"), (2.675, None, "2,67"), (1e-7, None, "0,00"),
+    (12.5, 2, "12,50"), (19.0, 2, "19,00"), (31.0, 3, "31,000"), (0.0005, 3, "0,001"), (1.5, 0, "2"),
+    (round(12.5 * 3.25, 2), 2, "40,62"), (round(7.3 * 19.99, 2), 2, "145,93"),
+    ("12,5", None, "12,5"), (None, None, ""),
+]
+
+# (value, expected) for format_amount, as PEZClient's replace("X") trick formatted them
+GOLDEN_AMOUNTS = [
+    (0, "0,00"), (12.5, "12,50"), (999.999, "1.000,00"), (1234.5, "1.234,50"),
+    (1234567.891, "1.234.567,89"), (-1234.5, "-1.234,50"), ("1234,5", "1.234,50"), ("87.25", "87,25"),
+]
+
+
+@pytest.mark.parametrize("value, decimals, expected", GOLDEN_DECIMALS)
+def test_format_decimal(value, decimals, expected):
+    assert format_decimal(value, decimals) == expected
+
+
+@pytest.mark.parametrize("value, expected", GOLDEN_AMOUNTS)
+def test_format_amount(value, expected):
+    assert format_amount(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", GOLDEN_AMOUNTS)
+def test_golden_amounts_match_the_old_pez_formatting(value, expected):
+    legacy = f"{float(str(value).replace(',', '.')):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    assert legacy == expected
+
+
+def test_format_decimal_none_placeholder():
+    assert format_decimal(None, none="-") == "-"
+
+
+@pytest.mark.parametrize("value, decimals, grouping, expected", [
+    (1234.5, 2, False, "1234,50"), (1234.5, 2, True, "1.234,50"), (-1234567.0, 0, True, "-1.234.567"), (0.125, 1, True, "0,1"),
+])
+def test_format_number(value, decimals, grouping, expected):
+    assert format_number(value, decimals, grouping) == expected
@@ -0,0 +1,136 @@
+"""ErrorReporter against the local SMTP stand-in."""
+
+from io import BytesIO
+import socket
+import time
+
+from PIL import Image, ImageDraw
+import pytest
+
+from benchmarks.local_services import LocalSmtpServer
+from robot_framework import config, error_screenshot
+from robot_framework.error_screenshot import ErrorReporter, fingerprint
+
+PROCESS = "VejmanKassenSAP"
+
+
+@pytest.fixture(autouse=True)
+def fake_screen(monkeypatch):
+    """A 2560x1440 screen showing SAP, in place of the real screen grab."""
+    def grab():
+        image = Image.new("RGB", (2560, 1440), "white")
+        ImageDraw.Draw(image).text((40, 40), "SAP Easy Access", fill="black")
+        return image
+    monkeypatch.setattr(error_screenshot.ImageGrab, "grab", grab)
+
+
+@pytest.fixture(name="smtp")
+def fixture_smtp(monkeypatch):
+    """A local SMTP server that drops idle connections after half a second, set up in config."""
+    with LocalSmtpServer(idle_timeout=0.5) as server:
+        host, port = server.address
+        monkeypatch.setattr(config, "SMTP_SERVER", host)
+        monkeypatch.setattr(config, "SMTP_PORT", port)
+        monkeypatch.setattr(config, "SMTP_STARTTLS", False)
+        yield server
+
+
+def error_for(element_id) -> RuntimeError:
+    """The same error for every element, raised from one place."""
+    try:
+        raise RuntimeError(f"SAP svarede ikke for element {element_id}")
+    except RuntimeError as error:
+        return error
+
+
+def subjects(server: LocalSmtpServer) -> list[str]:
+    """The subjects of the mails the server received, in order."""
+    return [message["subject"] for _, _, message in server.messages]
+
+
+def test_fingerprint_ignores_numbers_but_not_the_error_type():
+    assert fingerprint(error_for(1)) == fingerprint(error_for(2))
+    assert fingerprint(error_for(1)) != fingerprint(ValueError("SAP svarede ikke for element 1"))
+
+
+def test_first_occurrence_is_mailed_with_a_screenshot_and_repeats_in_the_digest(smtp, monkeypatch):
+    monkeypatch.setattr(config, "ERROR_DIGEST_INTERVAL_SECONDS", 60)
+    reporter = ErrorReporter()
+
+    mailed = [reporter.report("robot@localhost", error_for(element), PROCESS) for element in range(50)]
+    try:
+        {}["missing"]
+    except KeyError as error:
+        mailed.append(reporter.report(["robot@localhost", "ops@localhost"], error, PROCESS))
+    counts = reporter.close()
+
+    assert sum(mailed) == 2
+    assert subjects(smtp) == [
+        f"Error screenshot: {PROCESS}", f"Error screenshot: {PROCESS}", f"Error digest: {PROCESS} (49 repeated errors)",
+    ]
+    assert [recipients for _, recipients, _ in smtp.messages][1] == ["robot@localhost", "ops@localhost"]
+    assert counts["errors"] == 2 and counts["repeats"] == 49 and counts["failed_mails"] == 0
+    assert counts["smtp_connections"] == 1
+
+    image_part = next(part for part in smtp.messages[0][2].walk() if part.get_content_type() == "image/jpeg")
+    screenshot = Image.open(BytesIO(image_part.get_content()))
+    assert screenshot.width == config.SCREENSHOT_MAX_WIDTH
+
+
+def test_digest_is_sent_every_interval_and_at_close(smtp, monkeypatch):
+    monkeypatch.setattr(config, "ERROR_DIGEST_INTERVAL_SECONDS", 1)
+    reporter = ErrorReporter()
+
+    for element in range(4):
+        reporter.report("robot@localhost", error_for(element), PROCESS)
+    # Past the digest interval and the server's idle timeout
+    time.sleep(1.5)
+    for element in range(4, 6):
+        reporter.report("robot@localhost", error_for(element), PROCESS)
+    counts = reporter.close()
+
+    assert subjects(smtp) == [
+        f"Error screenshot: {PROCESS}", f"Error digest: {PROCESS} (3 repeated errors)",
+        f"Error digest: {PROCESS} (2 repeated errors)",
+    ]
+    # The server dropped the idle connection, so the reporter connected again
+    assert counts["smtp_connections"] == 2 and counts["failed_mails"] == 0
+
+
+def test_screen_grab_failure_is_reported_in_the_mail(smtp, monkeypatch):
+    def grab():
+        raise OSError("no display")
+    monkeypatch.setattr(error_screenshot.ImageGrab, "grab", grab)
+    reporter = ErrorReporter()
+
+    assert reporter.report("robot@localhost", error_for(1), PROCESS)
+    reporter.close()
+
+    message = smtp.messages[0][2]
+    assert "Screenshot could not be taken: no display" in message.get_body(("html",)).get_content()
+    assert not any(part.get_content_type() == "image/jpeg" for part in message.walk())
+
+
+def test_unreachable_server_is_counted_not_raised(monkeypatch):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        host, port = listener.getsockname()
+    monkeypatch.setattr(config, "SMTP_SERVER", host)
+    monkeypatch.setattr(config, "SMTP_PORT", port)
+    reporter = ErrorReporter()
+
+    assert reporter.report("robot@localhost", error_for(1), PROCESS)
+    counts = reporter.close()
+
+    assert counts["failed_mails"] == 1 and counts["screenshot_mails"] == 0
+    assert "ConnectionRefusedError" in counts["last_failure"]
+
+
+def test_send_error_screenshot_reports_through_the_shared_reporter(smtp, monkeypatch):
+    monkeypatch.setattr(error_screenshot, "REPORTER", ErrorReporter())
+
+    assert error_screenshot.send_error_screenshot("robot@localhost", error_for(1), PROCESS)
+    assert not error_screenshot.send_error_screenshot("robot@localhost", error_for(2), PROCESS)
+    error_screenshot.REPORTER.close()
+
+    assert subjects(smtp) == [f"Error screenshot: {PROCESS}", f"Error digest: {PROCESS} (1 repeated errors)"]
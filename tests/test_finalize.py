@@ -0,0 +1,24 @@
+"""FinalizeWriter against the SQLite stand-in for VejmanKassen."""
+
+from benchmarks.local_services import LocalSql
+from robot_framework.finalize import FinalizeWriter
+from robot_framework.sql_connection import ConnectionManager
+
+
+def test_rows_no_longer_til_fakturering_are_kept_for_the_caller(tmp_path):
+    sql = LocalSql(str(tmp_path / "vejmankassen.sqlite3"))
+    sql.insert("VejmanFakturering", [
+        {"ID": 1, "VejmanID": "500001", "FakturaStatus": "TilFakturering", "Ordrenummer": None},
+        {"ID": 2, "VejmanID": "500002", "FakturaStatus": "Faktureret", "Ordrenummer": "4500000001"},
+    ])
+    writer = FinalizeWriter(ConnectionManager(sql.connect))
+    writer.add(1, "4500000002")
+    writer.add(2, "4500000003")
+
+    assert writer.flush() == 1
+    assert writer.pop_not_updated() == [("4500000003", 2)]
+    assert not writer.pop_not_updated()
+    assert writer.stats() == {"flushes": 1, "rows_written": 1, "rows_not_updated": 1, "pending": 0}
+
+    rows = sql.connect().cursor().execute("SELECT ID, Ordrenummer FROM [VejmanKassen].[dbo].[VejmanFakturering] ORDER BY ID").fetchall()
+    assert [(row.ID, row.Ordrenummer) for row in rows] == [(1, "4500000002"), (2, "4500000001")]
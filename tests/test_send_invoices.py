@@ -0,0 +1,64 @@
+"""send_invoice against the fake SAP."""
+
+from datetime import date
+
+import pytest
+
+from fake_sap import ZVF04_COLUMNS, FakeSapGui
+from benchmarks.local_services import LocalCredential, LocalOrchestrator
+from send_invoices import send_invoice
+import sap_sessions
+
+
+@pytest.fixture(name="sap")
+def fixture_sap():
+    """A fake SAP with two unsent orders the robot created today, used for every session."""
+    sap = FakeSapGui(user="ROBOT")
+    today = date.today().strftime("%d.%m.%Y")
+    sap.orders.update({
+        "4500000001": ["ROBOT", today, "0012345678", False],
+        "4500000002": ["ROBOT", today, "0011111111", False],
+    })
+    previous = sap_sessions.set_provider(sap)
+    yield sap
+    sap_sessions.set_provider(previous)
+
+
+@pytest.fixture(name="orchestrator")
+def fixture_orchestrator():
+    """An orchestrator with the SAP user send_invoice lists the orders for."""
+    return LocalOrchestrator(credentials={"OpusBruger": LocalCredential("robot", "")}, constants={})
+
+
+def test_every_expected_order_is_sent_and_matched(sap, orchestrator):
+    sent = send_invoice(orchestrator, ["4500000001", "4500000002"])
+
+    assert list(sent) == ["4500000001", "4500000002"]
+    assert sent["4500000001"]["Debitor"] == "0012345678"
+    assert sap.stats()["sent"] == 2 and sap.stats()["open_orders"] == 0
+
+
+def test_missing_order_is_logged_and_left_out(sap, orchestrator):
+    sent = send_invoice(orchestrator, ["4500000001", "4500000009"])
+
+    assert list(sent) == ["4500000001"]
+    assert sap.stats()["sent"] == 2
+    assert any("4500000009" in message for message in orchestrator.logs["error"])
+
+
+def test_unknown_order_header_stops_before_anything_is_sent(sap, orchestrator):
+    sap.zvf04_columns = ((1, "Dokument"),) + ZVF04_COLUMNS[1:]
+
+    with pytest.raises(RuntimeError, match="intet er sendt"):
+        send_invoice(orchestrator, ["4500000001", "4500000002"])
+
+    assert sap.stats()["sent"] == 0 and sap.stats()["open_orders"] == 2
+
+
+def test_missing_fejl_column_stops_before_anything_is_sent(sap, orchestrator):
+    sap.zvf04_columns = ZVF04_COLUMNS[:-1]
+
+    with pytest.raises(RuntimeError, match="Fejl"):
+        send_invoice(orchestrator)
+
+    assert sap.stats()["sent"] == 0
@@ -0,0 +1,79 @@
+"""ConnectionManager against the SQLite stand-in for VejmanKassen."""
+
+import pytest
+
+from benchmarks.local_services import LocalSql
+from robot_framework.sql_connection import ConnectionManager
+
+
+@pytest.fixture(name="sql")
+def fixture_sql(tmp_path):
+    """VejmanKassen in a SQLite file with one row to invoice and one already invoiced."""
+    sql = LocalSql(str(tmp_path / "vejmankassen.sqlite3"))
+    sql.insert("VejmanFakturering", [
+        {"ID": 1, "VejmanID": "500001", "FakturaStatus": "TilFakturering"},
+        {"ID": 2, "VejmanID": "500002", "FakturaStatus": "Faktureret"},
+    ])
+    return sql
+
+
+def test_connection_is_reused_without_a_check_within_the_interval(sql):
+    manager = ConnectionManager(sql.connect, health_check_interval=60)
+    first = manager.get()
+    statements = sql.statements
+
+    assert manager.get() is first
+    assert sql.statements == statements
+    assert manager.stats() == {"connects": 1, "reuses": 1, "failed_checks": 0}
+
+
+def test_idle_connection_is_checked_and_reused_when_healthy(sql):
+    manager = ConnectionManager(sql.connect, health_check_interval=0)
+    first = manager.get()
+    statements = sql.statements
+
+    assert manager.get() is first
+    # SELECT 1 and the commit that ends its transaction
+    assert sql.statements == statements + 2
+    assert manager.stats() == {"connects": 1, "reuses": 1, "failed_checks": 0}
+
+
+def test_broken_connection_is_replaced(sql):
+    manager = ConnectionManager(sql.connect, health_check_interval=0)
+    first = manager.get()
+    first.close()
+
+    second = manager.get()
+
+    assert second is not first
+    assert manager.stats() == {"connects": 2, "reuses": 0, "failed_checks": 1}
+    rows = second.cursor().execute("SELECT ID FROM [VejmanKassen].[dbo].[VejmanFakturering] WHERE FakturaStatus = ?", "TilFakturering").fetchall()
+    assert [row.ID for row in rows] == [1]
+
+
+def test_invalidate_reconnects_on_the_next_get(sql):
+    manager = ConnectionManager(sql.connect)
+    first = manager.get()
+
+    manager.invalidate()
+
+    assert manager.get() is not first
+    assert manager.stats()["connects"] == 2
+
+
+def test_invalidate_ignores_errors_closing_the_old_connection():
+    class BrokenConnection:  # pylint: disable=too-few-public-methods
+        """A connection whose server is gone."""
+
+        def close(self):
+            """Closing fails, as over a dropped connection."""
+            raise OSError("connection already gone")
+
+    manager = ConnectionManager(BrokenConnection)
+    manager.get()
+
+    manager.invalidate()
+    manager.close()
+
+    assert isinstance(manager.get(), BrokenConnection)
+    assert manager.stats()["connects"] == 2
@@ -0,0 +1,99 @@
+"""VejmanClient against the local Vejman stand-in."""
+
+import socket
+
+import pytest
+import requests
+
+from benchmarks.local_services import LocalHttpServices
+from update_vejman import VejmanClient, VejmanConfig
+import spans
+
+
+class FlakyServices(LocalHttpServices):
+    """The local Vejman, answering 503 to the first `failures` getcase requests."""
+
+    def __init__(self, failures: int, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def answer(self, method, url, headers, body):
+        if "/getcase" in url and self.failures:
+            self.failures -= 1
+            return 503, {"error": "Service Unavailable"}
+        return super().answer(method, url, headers, body)
+
+
+@pytest.fixture(autouse=True)
+def reset_spans():
+    """Every test starts without recorded spans."""
+    spans.reset()
+
+
+def make_client(base_url: str, **config) -> VejmanClient:
+    """A client for base_url that retries without waiting."""
+    return VejmanClient("local-token", VejmanConfig(base_url=base_url, backoff=0, **config))
+
+
+def test_update_case_marks_the_case_as_invoiced():
+    with LocalHttpServices() as services:
+        client = make_client(services.base_url)
+        assert client.update_case("500001")
+        assert client.update_case("500002")
+        client.close()
+
+    assert services.updated_cases == ["500001", "500002"]
+    assert services.stats() == {"getcase": 2, "setcase": 2}
+    assert client.stats() == {"retries": 0}
+    recorded = spans.summary()
+    assert recorded["vejman.http.getcase"]["count"] == 2
+    assert recorded["vejman.http.setcase"]["count"] == 2
+    assert recorded["vejman.http.getcase"]["errors"] == 0
+
+
+def test_server_errors_are_retried():
+    with FlakyServices(failures=2) as services:
+        client = make_client(services.base_url, max_retries=3)
+        assert client.update_case("500001")
+        client.close()
+
+    assert services.updated_cases == ["500001"]
+    assert client.stats() == {"retries": 2}
+    recorded = spans.summary()["vejman.http.getcase"]
+    assert (recorded["count"], recorded["errors"]) == (3, 2)
+
+
+def test_server_error_is_raised_when_the_retries_run_out():
+    with FlakyServices(failures=5) as services:
+        client = make_client(services.base_url, max_retries=1)
+        with pytest.raises(requests.HTTPError):
+            client.get_case("500001")
+        client.close()
+
+    assert client.stats() == {"retries": 1}
+    assert not services.updated_cases
+
+
+def test_read_timeout_is_raised_when_the_retries_run_out():
+    with LocalHttpServices(latency={"getcase": 0.5}) as services:
+        client = make_client(services.base_url, read_timeout=0.05, max_retries=1)
+        with pytest.raises(requests.Timeout):
+            client.get_case("500001")
+        client.close()
+
+    assert client.stats() == {"retries": 1}
+    assert spans.summary()["vejman.http.getcase"]["errors"] == 2
+
+
+def test_connection_error_is_retried_and_raised():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        host, port = listener.getsockname()
+    # Nothing listens on the port any more
+
+    client = make_client(f"http://{host}:{port}", connect_timeout=0.5, max_retries=2)
+    with pytest.raises(requests.ConnectionError):
+        client.get_case("500001")
+    client.close()
+
+    assert client.stats() == {"retries": 2}
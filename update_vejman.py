@@ -1,49 +1,136 @@
+from __future__ import annotations
 
+from dataclasses import dataclass
+from typing import Optional
 import json
-import requests
+import random
+import time
 import urllib.parse
 
-def update_case(case_id, token):
+import requests
+from requests.adapters import HTTPAdapter
+
+import spans
+
+
+@dataclass
+class VejmanConfig:
+    """Where Vejman is and how patiently VejmanClient talks to it."""
+    base_url: str = "https://vejman.vd.dk"
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    max_retries: int = 3
+    backoff: float = 0.5
+    pool_size: int = 4
+
+
+class VejmanClient:
+    """
+    Stateful Vejman client:
+    - Holds one requests.Session() with a connection pool, so case updates reuse the TCP/TLS connection.
+    - Every request has explicit connect/read timeouts.
+    - 5xx responses and connection errors are retried with exponential backoff and jitter.
+    - Every attempt is timed into the spans histogram vejman.http.<call type>.
+    """
+
+    def __init__(self, token: str, config: Optional[VejmanConfig] = None) -> None:
+        self.token = token
+        self.config = config or VejmanConfig()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.retries = 0
+
+    # ---------- Internal helpers ----------
+
+    def _url(self, path: str) -> str:
+        return f"{self.config.base_url}{path}"
+
+    def _request(self, name: str, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request with timeouts, retrying 5xx and connection errors."""
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            retryable, r = True, None
+            try:
+                r = self.session.request(
+                    method, url, timeout=(self.config.connect_timeout, self.config.read_timeout), **kwargs
+                )
+                retryable = r.status_code >= 500
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.config.max_retries:
+                    raise
+            finally:
+                spans.record(f"vejman.http.{name}", time.perf_counter() - t0, error=retryable)
+
+            if not retryable or attempt >= self.config.max_retries:
+                r.raise_for_status()
+                return r
 
-    response = requests.get(f"https://vejman.vd.dk/permissions/getcase?caseid={case_id}&token={token}")
-    response.raise_for_status()
-    json_object = response.json().get('data')
-
-    filtered_data = {k: json_object[k] for k in [
-    "type", "variant", "origin", "state", "year", "serial_number", "authority_reference_number", 
-    "start_date", "end_date", "initials", "visuser_id", "created_date", "created_user", 
-    "modified_date", "modified_user", "connected_case", "bestyrer", "community", 
-    "majorVersion", "minorVersion", "authName", "authEmail", "case_set", "brokerCaseState", "id"
-    ] if k in json_object}
-    # Add "$transaction" and "$changed" nodes
-    filtered_data["authority_reference_number"] = "Faktura sendt"
-    filtered_data["$transaction"] = "update"
-    filtered_data["$changed"] = True
-
-    # Convert the dictionary to a compact JSON string without spaces, ensuring UTF-8 encoding
-    json_data = json.dumps(filtered_data, ensure_ascii=False, separators=(',', ':'))
-
-    # URL-encode the JSON string
-    url_encoded_data = urllib.parse.quote(json_data)
-
-    # Construct the payload string for the POST request
-    payload = f"data={url_encoded_data}"
-
-    
-    # Make the POST request with the encoded data
-    post_url = f"https://vejman.vd.dk/permissions/setcase?token={token}"
-    headers = {
-        'Accept': 'text/javascript, text/html, application/xml, text/xml, */*',
-        'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-    }
-
-    response = requests.post(post_url, headers=headers, data=payload)
-    response.raise_for_status()
-
-    post_response_data = response.json()
-
-    # Check if 'data' key exists in response and compare 'id'
-    if 'data' in post_response_data and post_response_data['data'].get('id') == filtered_data.get('id'):
-        print(f"Case ID {filtered_data['id']}: Data updated successfully!")
-    else:
-        print(f"Case ID {filtered_data['id']}: Failed to update data, no matching ID found.")
\ No newline at end of file
+            attempt += 1
+            self.retries += 1
+            time.sleep(self.config.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    # ---------- Public API ----------
+
+    def get_case(self, case_id) -> dict:
+        """The case's data as Vejman returns it."""
+        response = self._request("getcase", "GET", self._url(f"/permissions/getcase?caseid={case_id}&token={self.token}"))
+        return response.json().get('data')
+
+    def update_case(self, case_id) -> bool:
+        """Marks the case's authority reference number as "Faktura sendt". Returns whether Vejman confirmed the update."""
+        json_object = self.get_case(case_id)
+
+        filtered_data = {k: json_object[k] for k in [
+        "type", "variant", "origin", "state", "year", "serial_number", "authority_reference_number",
+        "start_date", "end_date", "initials", "visuser_id", "created_date", "created_user",
+        "modified_date", "modified_user", "connected_case", "bestyrer", "community",
+        "majorVersion", "minorVersion", "authName", "authEmail", "case_set", "brokerCaseState", "id"
+        ] if k in json_object}
+        # Add "$transaction" and "$changed" nodes
+        filtered_data["authority_reference_number"] = "Faktura sendt"
+        filtered_data["$transaction"] = "update"
+        filtered_data["$changed"] = True
+
+        # Convert the dictionary to a compact JSON string without spaces, ensuring UTF-8 encoding
+        json_data = json.dumps(filtered_data, ensure_ascii=False, separators=(',', ':'))
+
+        # URL-encode the JSON string
+        url_encoded_data = urllib.parse.quote(json_data)
+
+        # Construct the payload string for the POST request
+        payload = f"data={url_encoded_data}"
+
+        # Make the POST request with the encoded data
+        post_url = self._url(f"/permissions/setcase?token={self.token}")
+        headers = {
+            'Accept': 'text/javascript, text/html, application/xml, text/xml, */*',
+            'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+        }
+
+        response = self._request("setcase", "POST", post_url, headers=headers, data=payload)
+        post_response_data = response.json()
+
+        # Check if 'data' key exists in response and compare 'id'; the caller reports a failed update
+        return 'data' in post_response_data and post_response_data['data'].get('id') == filtered_data.get('id')
+
+    def stats(self) -> dict:
+        """Number of retries. Call counts and latencies are in the vejman.http.* spans."""
+        return {"retries": self.retries}
+
+    def close(self) -> None:
+        """Close the session's pooled connections."""
+        self.session.close()
+
+
+def update_case(case_id, token):
+    """Updates a single case with a one-off client. Prefer a shared VejmanClient for more than one case."""
+    client = VejmanClient(token)
+    try:
+        return client.update_case(case_id)
+    finally:
+        client.close()